@@ -79,6 +79,7 @@ class BaseTestRunner(object):
     self.ShutdownHelperToolsForTestSuite()
     if self._cleanup_test_files:
       self.device.old_interface.RemovePushedFiles()
+    self.device.Close()
 
   def LaunchTestHttpServer(self, document_root, port=None,
                            extra_config_contents=None):
@@ -212,6 +212,24 @@ class AdbWrapper(object):
       raise device_errors.AdbCommandFailedError(
           cmd, 'File not found on host: %s' % local, device_serial=str(self))
 
+  def ExecOut(self, command, timeout=_DEFAULT_TIMEOUT,
+              retries=_DEFAULT_RETRIES):
+    """Runs a shell command on the device and returns its raw output.
+
+    Unlike Shell, the output is not mangled by a pty, which makes it suitable
+    to stream binary contents from the device. Requires a device running L or
+    later.
+
+    Args:
+      command: A string with the shell command to run.
+      timeout: (optional) Timeout per try in seconds.
+      retries: (optional) Number of retries to attempt.
+
+    Returns:
+      The output of the shell command as a string.
+    """
+    return self._RunDeviceAdbCmd(['exec-out', command], timeout, retries)
+
   def Shell(self, command, expect_status=0, timeout=_DEFAULT_TIMEOUT,
             retries=_DEFAULT_RETRIES):
     """Runs a shell command on the device.
@@ -44,6 +44,10 @@ class TestAdbWrapper(unittest.TestCase):
     with self.assertRaises(device_errors.AdbCommandFailedError):
         self._adb.Shell('echo test', expect_status=1)
 
+  def testExecOut(self):
+    output = self._adb.ExecOut('echo test')
+    self.assertEqual(output, 'test\n')
+
   def testPushLsPull(self):
     path = self._MakeTempFile('foo')
     device_path = '/data/local/tmp/testfile.txt'
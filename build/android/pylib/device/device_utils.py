@@ -8,6 +8,7 @@ Eventually, this will be based on adb_wrapper.
 """
 # pylint: disable=unused-argument
 
+import base64
 import collections
 import itertools
 import logging
@@ -15,11 +16,17 @@ import multiprocessing
 import os
 import posixpath
 import re
+import select
 import shutil
+import string
+import subprocess
 import sys
 import tempfile
+import threading
 import time
+import uuid
 import zipfile
+import zlib
 
 import pylib.android_commands
 from pylib import cmd_helper
@@ -36,7 +43,9 @@ from pylib.utils import device_temp_file
 from pylib.utils import host_utils
 from pylib.utils import md5sum
 from pylib.utils import parallelizer
+from pylib.utils import reraiser_thread
 from pylib.utils import timeout_retry
+from pylib.utils import watchdog_timer
 from pylib.utils import zip_utils
 
 _DEFAULT_TIMEOUT = 30
@@ -116,29 +125,247 @@ def RestartServer():
     raise device_errors.CommandFailedError('Failed to start adb server')
 
 
+# Parses each line of the output of getprop, e.g. "[ro.build.id]: [KTU84P]".
+_GETPROP_RE = re.compile(r'^\[(?P<name>[^\]]+)\]: \[(?P<value>.*)\]$')
+
+# Parses the output of stat -c '%s %Y %n'.
+_STAT_RE = re.compile(r'^(?P<size>\d+) (?P<mtime>\d+) (?P<path>.+)$')
+
+# Matches the totals line at the end of the output of showmap, e.g.
+# "  1024   512   256     0    64   128   320     8 TOTAL".
+_SHOWMAP_TOTAL_RE = re.compile(r'^\s*((?:\d+\s+){8})TOTAL\s*$')
+
+# Finds all the "key: value" lines in the output of dumpsys battery.
+_BATTERY_INFO_RE = re.compile(r'^\s*(\S.*?): (.*?)\s*$', re.MULTILINE)
+
+# Approximations used by DeviceUtils._ApproximateDuration to choose how to
+# push files. The zip rate is that of zipfile.ZIP_DEFLATED, which always uses
+# the default zlib compression level on Python 2.
+_PUSH_ADB_CALL_PENALTY = 0.1 # seconds
+_PUSH_ADB_PUSH_PENALTY = 0.01 # seconds
+_PUSH_ZIP_PENALTY = 2.0 # seconds
+_PUSH_ZIP_RATE = 10000000.0 # bytes / second
+_PUSH_TRANSFER_RATE = 2000000.0 # bytes / second
+_PUSH_COMPRESSION_RATIO = 2.0 # unitless
+# Files which zip compresses less than this are not worth zipping, e.g. apks
+# or images. The ratio is estimated from the first bytes of the files.
+_PUSH_MIN_COMPRESSION_RATIO = 1.2 # unitless
+_PUSH_COMPRESSION_SAMPLE_SIZE = 256 * 1024 # bytes
+
+# Marks the end of the pm path output in the script run by _InstallProbe.
+_INSTALL_PROBE_SEPARATOR = 'INSTALL_PROBE_SEPARATOR'
+_MEMORY_USAGE_SEPARATOR = 'MEMORY_USAGE_SEPARATOR'
+_JAVA_ASSERTS_SEPARATOR = 'JAVA_ASSERTS_SEPARATOR'
+
+# Prints the pid of each process whose name contains the (quoted) string to be
+# interpolated, as found in the last column of the output of 'ps'. The header
+# row and the shell running the script itself are skipped.
+_FIND_PIDS_SCRIPT = (
+    'ps | { read -r _; while read -r _ pid rest; do '
+    'test "$pid" = $$ || case "${rest##* }" in *%s*) echo $pid;; esac; '
+    'done; }')
+
+
 def _GetTimeStamp():
   """Return a basic ISO 8601 time stamp with the current local time."""
   return time.strftime('%Y%m%dT%H%M%S', time.localtime())
 
 
 def _JoinLines(lines):
-  # makes sure that the last line is also terminated, and is more memory
-  # efficient than first appending an end-line to each line and then joining
-  # all of them together.
-  return ''.join(s for line in lines for s in (line, '\n'))
+  # makes sure that the last line is also terminated. Joining a list with
+  # str.join runs entirely in C, rather than going through a generator that
+  # interleaves lines and end-lines one item at a time.
+  if not isinstance(lines, list):
+    lines = list(lines)
+  if not lines:
+    return ''
+  elif len(lines) == 1:
+    return lines[0] + '\n'
+  else:
+    return '\n'.join(lines) + '\n'
+
+
+# Quoted forms of recently run argument lists, keyed by the tuple of arguments.
+_QUOTED_ARGV_CACHE = {}
+_QUOTED_ARGV_CACHE_MAX_SIZE = 512
+
+
+def _QuoteArgv(args):
+  """Quotes and joins a sequence of arguments into a shell command string.
+
+  Most commands run by this module come from a small set of argument lists,
+  e.g. ['pm', 'path', package], so the quoted result is memoized. The cache is
+  simply dropped when it grows past _QUOTED_ARGV_CACHE_MAX_SIZE entries.
+  """
+  args = tuple(args)
+  quoted = _QUOTED_ARGV_CACHE.get(args)
+  if quoted is None:
+    quoted = ' '.join(cmd_helper.SingleQuote(s) for s in args)
+    if len(_QUOTED_ARGV_CACHE) >= _QUOTED_ARGV_CACHE_MAX_SIZE:
+      _QUOTED_ARGV_CACHE.clear()
+    _QUOTED_ARGV_CACHE[args] = quoted
+  return quoted
+
+
+class _PersistentShell(object):
+  """A long-lived shell process that runs commands written to its stdin.
+
+  Spawning a new 'adb shell' for every command pays the full adb client, adbd
+  and shell startup cost each time. This class keeps a single shell process
+  alive and frames the output of each command with a sentinel line carrying
+  its exit status, so that many commands can be run over the same process.
+  """
+
+  _READ_SIZE = 4096
+
+  def __init__(self, shell_cmd):
+    """_PersistentShell constructor.
+
+    Args:
+      shell_cmd: A list with the command line that starts the shell, e.g.
+        ['adb', '-s', serial, 'shell'].
+    """
+    self._shell_cmd = shell_cmd
+    self._process = None
+    self._buffer = ''
+    self._lock = threading.Lock()
+    self._token = uuid.uuid4().hex
+    self._sentinel = '<<<SENTINEL_%s ' % self._token
+
+  def IsAlive(self):
+    """Checks whether the shell process is running."""
+    return self._process is not None and self._process.poll() is None
+
+  def Close(self):
+    """Terminates the shell process, if running."""
+    if self._process is None:
+      return
+    try:
+      if self._process.poll() is None:
+        self._process.kill()
+      self._process.wait()
+    except OSError:
+      pass
+    self._process = None
+    self._buffer = ''
+
+  def Run(self, command, timeout=None):
+    """Runs a command on the shell.
+
+    Args:
+      command: A string with the shell command to run.
+      timeout: The number of seconds to wait for the command to finish, or
+        None to wait forever.
+
+    Returns:
+      A (status, output) tuple with the exit status and the output of the
+      command, or None if the command was not sent to the shell, e.g. because
+      it is busy running another command or could not be started. The caller
+      may then safely run the command some other way.
+
+    Raises:
+      CommandTimeoutError if the command was sent but did not finish in time.
+      CommandFailedError if the command was sent but the shell exited or its
+        output could not be understood.
+      In both cases the shell is closed, and restarted on the next call.
+    """
+    if not self._lock.acquire(False):
+      return None
+    try:
+      # The command runs in a subshell, so that e.g. 'cd' or 'exit' do not
+      # change the state of the persistent shell itself. Its stdin is
+      # redirected, so that it can't consume the lines that follow it, and so
+      # is its stderr, so that all of its output comes before the sentinel.
+      # The sentinel is assembled by printf so that it never appears in an
+      # echoed command.
+      written = [
+          '( %s ) </dev/null 2>&1' % command,
+          "printf '<<<%%s_%%s %%s>>>\\n' SENTINEL %s \"$?\"" % self._token]
+      try:
+        if not self.IsAlive():
+          self._Start()
+        self._process.stdin.write(''.join(l + '\n' for l in written))
+        self._process.stdin.flush()
+      except (IOError, OSError):
+        logging.warning('Could not write to the persistent shell.')
+        self.Close()
+        return None
+      deadline = None if timeout is None else time.time() + timeout
+      try:
+        return self._ReadResult(written, deadline)
+      except (IOError, OSError, ValueError):
+        self.Close()
+        raise device_errors.CommandFailedError(
+            'Persistent shell out of sync running: %s' % command)
+      except (device_errors.CommandFailedError,
+              device_errors.CommandTimeoutError):
+        self.Close()
+        raise
+    finally:
+      self._lock.release()
+
+  def _ReadResult(self, written, deadline):
+    # A terminal echoes the written lines back before the command runs.
+    echoed = written
+    lines = []
+    while True:
+      line = self._ReadLine(deadline)
+      index = line.find(self._sentinel)
+      if index < 0:
+        if echoed and line == echoed[0]:
+          echoed = echoed[1:]
+        else:
+          echoed = None
+          lines.append(line)
+        continue
+      if index > 0:
+        lines.append(line[:index])
+      status = line[index + len(self._sentinel):].strip().rstrip('>')
+      return int(status), ''.join(l + '\n' for l in lines)
+
+  def _Start(self):
+    self.Close()
+    self._process = subprocess.Popen(
+        self._shell_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+
+  def _ReadLine(self, deadline):
+    fd = self._process.stdout.fileno()
+    while '\n' not in self._buffer:
+      if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+          raise device_errors.CommandTimeoutError(
+              'Timed out waiting for the persistent shell')
+      data = os.read(fd, self._READ_SIZE)
+      if not data:
+        raise device_errors.CommandFailedError(
+            'The persistent shell exited unexpectedly')
+      self._buffer += data
+    line, self._buffer = self._buffer.split('\n', 1)
+    return line.rstrip('\r')
 
 
 class DeviceUtils(object):
 
   _MAX_ADB_COMMAND_LENGTH = 512
   _MAX_ADB_OUTPUT_LENGTH = 32768
-  _VALID_SHELL_VARIABLE = re.compile('^[a-zA-Z_][a-zA-Z0-9_]*$')
+  _LS_CACHE_MAX_SIZE = 1024
+  _LS_CACHE_TTL = 1.0 # seconds
+  # Commands that don't change files, and so keep the listings cached.
+  _READ_ONLY_SHELL_COMMANDS = frozenset(['cat', 'ls', 'stat', 'test'])
+  _VALID_SHELL_VARIABLE_CHARS = frozenset(
+      string.ascii_letters + string.digits + '_')
+
+  # Values that do not change for the lifetime of a device boot, shared by all
+  # instances and keyed by device serial.
+  _GLOBAL_CACHE = {}
 
   # Property in /data/local.prop that controls Java assertions.
   JAVA_ASSERT_PROPERTY = 'dalvik.vm.enableassertions'
 
   def __init__(self, device, default_timeout=_DEFAULT_TIMEOUT,
-               default_retries=_DEFAULT_RETRIES):
+               default_retries=_DEFAULT_RETRIES, persistent_shell=False):
     """DeviceUtils constructor.
 
     Args:
@@ -150,6 +377,9 @@ class DeviceUtils(object):
       default_retries: An integer containing the default number or times an
                        operation should be retried on failure if no explicit
                        value is provided.
+      persistent_shell: A boolean indicating whether shell commands should be
+                        run over a single long-lived 'adb shell' process,
+                        rather than starting a new one for each command.
     """
     self.adb = None
     self.old_interface = None
@@ -168,6 +398,16 @@ class DeviceUtils(object):
     self._default_timeout = default_timeout
     self._default_retries = default_retries
     self._cache = {}
+    # Recent directory listings, as (time, listing) tuples keyed by directory.
+    self._ls_cache = collections.OrderedDict()
+    self._persistent_shell = None
+    if persistent_shell:
+      # Passing a command keeps adb from allocating a terminal, on devices
+      # that support it. Otherwise, the shell reading from a pipe rather than
+      # the terminal at least runs without prompts or line editing.
+      self._persistent_shell = _PersistentShell(
+          [constants.GetAdbPath(), '-s', self.adb.GetDeviceSerial(), 'shell',
+           'cat | sh'])
     assert hasattr(self, decorators.DEFAULT_TIMEOUT_ATTR)
     assert hasattr(self, decorators.DEFAULT_RETRIES_ATTR)
 
@@ -175,6 +415,30 @@ class DeviceUtils(object):
     """Returns the device serial."""
     return self.adb.GetDeviceSerial()
 
+  def Close(self):
+    """Terminates the persistent shell process, if any.
+
+    The instance remains usable; the shell is started again when needed.
+    """
+    if self._persistent_shell:
+      self._persistent_shell.Close()
+
+  @classmethod
+  def InvalidateGlobalCache(cls, serial=None):
+    """Clears the values cached for a device across DeviceUtils instances.
+
+    Args:
+      serial: The serial of the device whose values should be cleared. If
+              None, the values of all devices are cleared.
+    """
+    if serial is None:
+      cls._GLOBAL_CACHE.clear()
+    else:
+      cls._GLOBAL_CACHE.pop(serial, None)
+
+  def _GetGlobalCache(self):
+    return DeviceUtils._GLOBAL_CACHE.setdefault(self.adb.GetDeviceSerial(), {})
+
   @decorators.WithTimeoutAndRetriesFromInstance()
   def IsOnline(self, timeout=None, retries=None):
     """Checks whether the device is online.
@@ -233,16 +497,17 @@ class DeviceUtils(object):
       CommandTimeoutError on timeout.
       DeviceUnreachableError on missing device.
     """
-    if 'needs_su' not in self._cache:
+    global_cache = self._GetGlobalCache()
+    if 'needs_su' not in global_cache:
       try:
         self.RunShellCommand(
             'su -c ls /root && ! ls /root', check_return=True,
             timeout=self._default_timeout if timeout is DEFAULT else timeout,
             retries=self._default_retries if retries is DEFAULT else retries)
-        self._cache['needs_su'] = True
+        global_cache['needs_su'] = True
       except device_errors.AdbCommandFailedError:
-        self._cache['needs_su'] = False
-    return self._cache['needs_su']
+        global_cache['needs_su'] = False
+    return global_cache['needs_su']
 
 
   @decorators.WithTimeoutAndRetriesFromInstance()
@@ -260,8 +525,7 @@ class DeviceUtils(object):
     if self.IsUserBuild():
       raise device_errors.CommandFailedError(
           'Cannot enable root in user builds.', str(self))
-    if 'needs_su' in self._cache:
-      del self._cache['needs_su']
+    DeviceUtils.InvalidateGlobalCache(str(self))
     self.adb.Root()
     self.adb.WaitForDevice()
 
@@ -299,8 +563,9 @@ class DeviceUtils(object):
       CommandTimeoutError on timeout.
       DeviceUnreachableError on missing device.
     """
-    if 'external_storage' in self._cache:
-      return self._cache['external_storage']
+    global_cache = self._GetGlobalCache()
+    if 'external_storage' in global_cache:
+      return global_cache['external_storage']
 
     value = self.RunShellCommand('echo $EXTERNAL_STORAGE',
                                  single_line=True,
@@ -308,19 +573,25 @@ class DeviceUtils(object):
     if not value:
       raise device_errors.CommandFailedError('$EXTERNAL_STORAGE is not set',
                                              str(self))
-    self._cache['external_storage'] = value
+    global_cache['external_storage'] = value
     return value
 
   @decorators.WithTimeoutAndRetriesFromInstance()
-  def GetApplicationPath(self, package, timeout=None, retries=None):
+  def GetApplicationPath(self, package, use_cache=True, timeout=None,
+                         retries=None):
     """Get the path of the installed apk on the device for the given package.
 
     Args:
       package: Name of the package.
+      use_cache: A boolean indicating whether a previously looked up path may
+        be returned, rather than querying the package manager again.
 
     Returns:
       Path to the apk on the device if it exists, None otherwise.
     """
+    app_paths = self._cache.setdefault('app_path', {})
+    if use_cache and package in app_paths:
+      return app_paths[package]
     # 'pm path' is liable to incorrectly exit with a nonzero number starting
     # in Lollipop.
     # TODO(jbudorick): Check if this is fixed as new Android versions are
@@ -330,11 +601,13 @@ class DeviceUtils(object):
     output = self.RunShellCommand(['pm', 'path', package], single_line=True,
                                   check_return=should_check_return)
     if not output:
-      return None
-    if not output.startswith('package:'):
+      app_paths[package] = None
+    elif output.startswith('package:'):
+      app_paths[package] = output[len('package:'):]
+    else:
       raise device_errors.CommandFailedError('pm path returned: %r' % output,
                                              str(self))
-    return output[len('package:'):]
+    return app_paths[package]
 
   @decorators.WithTimeoutAndRetriesFromInstance()
   def WaitUntilFullyBooted(self, wifi=False, timeout=None, retries=None):
@@ -356,15 +629,16 @@ class DeviceUtils(object):
     """
     def sd_card_ready():
       try:
-        self.RunShellCommand(['test', '-d', self.GetExternalStoragePath()],
-                             check_return=True)
+        # Use the variable on the device directly, rather than first looking
+        # up its value with GetExternalStoragePath, to save a round-trip.
+        self.RunShellCommand('test -d "$EXTERNAL_STORAGE"', check_return=True)
         return True
       except device_errors.AdbCommandFailedError:
         return False
 
     def pm_ready():
       try:
-        return self.GetApplicationPath('android')
+        return self.GetApplicationPath('android', use_cache=False)
       except device_errors.CommandFailedError:
         return False
 
@@ -376,11 +650,12 @@ class DeviceUtils(object):
                                                         check_return=False)
 
     self.adb.WaitForDevice()
-    timeout_retry.WaitFor(sd_card_ready)
-    timeout_retry.WaitFor(pm_ready)
-    timeout_retry.WaitFor(boot_completed)
+    # The conditions are independent of each other, so they are polled in
+    # parallel to overlap the latencies of their adb round-trips.
+    conditions = [sd_card_ready, pm_ready, boot_completed]
     if wifi:
-      timeout_retry.WaitFor(wifi_enabled)
+      conditions.append(wifi_enabled)
+    timeout_retry.WaitForAll(conditions)
 
   REBOOT_DEFAULT_TIMEOUT = 10 * _DEFAULT_TIMEOUT
   REBOOT_DEFAULT_RETRIES = _DEFAULT_RETRIES
@@ -407,6 +682,9 @@ class DeviceUtils(object):
 
     self.adb.Reboot()
     self._cache = {}
+    self._ls_cache.clear()
+    DeviceUtils.InvalidateGlobalCache(str(self))
+    self.Close()
     timeout_retry.WaitFor(device_offline, wait_period=1)
     if block:
       self.WaitUntilFullyBooted(wifi=wifi)
@@ -434,16 +712,75 @@ class DeviceUtils(object):
       DeviceUnreachableError on missing device.
     """
     package_name = apk_helper.GetPackageName(apk_path)
-    device_path = self.GetApplicationPath(package_name)
+    # Hash the local APK while the device is being probed.
+    host_md5_thread = reraiser_thread.ReraiserThread(
+        md5sum.CalculateHostMd5Sums, args=[apk_path],
+        name='host-md5-%s' % package_name)
+    host_md5_thread.start()
+    try:
+      device_path, device_md5 = self._InstallProbe(package_name)
+    finally:
+      # Don't leave the thread behind, even if its hash is not needed.
+      host_md5_thread.join()
     if device_path is not None:
-      should_install = bool(self._GetChangedFilesImpl(apk_path, device_path))
+      if device_md5 is not None:
+        host_md5s = host_md5_thread.GetReturnValue()
+        should_install = not host_md5s or host_md5s[0].hash != device_md5
+      else:
+        should_install = bool(
+            self._GetChangedFilesImpl(apk_path, device_path))
       if should_install and not reinstall:
         self.adb.Uninstall(package_name)
     else:
       should_install = True
     if should_install:
+      # Force the path to be looked up again once the package is installed.
+      self._cache.setdefault('app_path', {}).pop(package_name, None)
+      self._ls_cache.clear()
       self.adb.Install(apk_path, reinstall=reinstall)
 
+  def _InstallProbe(self, package):
+    """Looks up the installed APK of a package and its md5 in one shell call.
+
+    Args:
+      package: A string containing the name of the package.
+
+    Returns:
+      A (device_path, device_md5) tuple. device_path is None if the package is
+      not installed. device_md5 is None if it could not be computed on the
+      device, e.g. because the md5sum binary has not been pushed yet or the
+      package is split across several APKs.
+
+    Raises:
+      CommandFailedError if the output of pm path could not be understood.
+    """
+    md5sum_script = md5sum.MD5SUM_DEVICE_SCRIPT_FORMAT.format(
+        path='"$p"', md5sum_lib=md5sum.MD5SUM_DEVICE_LIB_PATH,
+        device_pie_wrapper=self.GetDevicePieWrapper(),
+        md5sum_bin=md5sum.MD5SUM_DEVICE_BIN_PATH)
+    script = (
+        'p=$(pm path %s); echo "$p"; echo %s; p=${p#package:}; '
+        'test -f %s && %s' % (
+            cmd_helper.SingleQuote(package), _INSTALL_PROBE_SEPARATOR,
+            md5sum.MD5SUM_DEVICE_BIN_PATH, md5sum_script))
+    output = self.RunShellCommand(script)
+    if _INSTALL_PROBE_SEPARATOR not in output:
+      raise device_errors.CommandFailedError(
+          'Unexpected output probing %s: %r' % (package, output), str(self))
+    separator_index = output.index(_INSTALL_PROBE_SEPARATOR)
+    pm_lines = [l for l in output[:separator_index] if l]
+    md5_lines = [l for l in output[separator_index + 1:] if l]
+    if not pm_lines:
+      return (None, None)
+    for line in pm_lines:
+      if not line.startswith('package:'):
+        raise device_errors.CommandFailedError(
+            'pm path returned: %r' % '\n'.join(pm_lines), str(self))
+    device_path = pm_lines[0][len('package:'):]
+    if len(pm_lines) != 1 or not md5_lines:
+      return (device_path, None)
+    return (device_path, md5_lines[0].split(None, 1)[0])
+
   @decorators.WithTimeoutAndRetriesFromInstance()
   def RunShellCommand(self, cmd, check_return=False, cwd=None, env=None,
                       as_root=False, single_line=False, timeout=None,
@@ -496,14 +833,36 @@ class DeviceUtils(object):
       CommandTimeoutError on timeout.
       DeviceUnreachableError on missing device.
     """
+    # The command may change any file on the device, unless it is known to
+    # only read files, e.g. as run by FileExists or ReadFile.
+    if (isinstance(cmd, basestring) or not cmd
+        or cmd[0] not in self._READ_ONLY_SHELL_COMMANDS):
+      self._ls_cache.clear()
+
     def env_quote(key, value):
-      if not DeviceUtils._VALID_SHELL_VARIABLE.match(key):
+      if (not key or key[0] in string.digits
+          or not DeviceUtils._VALID_SHELL_VARIABLE_CHARS.issuperset(key)):
         raise KeyError('Invalid shell variable name %r' % key)
       # using double quotes here to allow interpolation of shell variables
       return '%s=%s' % (key, cmd_helper.DoubleQuote(value))
 
+    def run_persistent(cmd):
+      timeout_thread = timeout_retry.CurrentTimeoutThread()
+      result = self._persistent_shell.Run(
+          cmd, timeout_thread.GetRemainingTime() if timeout_thread else None)
+      if result is None:
+        # The command never reached the shell, so it can be run again.
+        return self.adb.Shell(cmd)
+      status, output = result
+      if status != 0:
+        raise device_errors.AdbShellCommandFailedError(
+            cmd, output, status, str(self))
+      return output
+
     def do_run(cmd):
       try:
+        if self._persistent_shell:
+          return run_persistent(cmd)
         return self.adb.Shell(cmd)
       except device_errors.AdbCommandFailedError as exc:
         if check_return:
@@ -511,39 +870,52 @@ class DeviceUtils(object):
         else:
           return exc.output
 
+    def wrap_as_root(cmd):
+      if as_root and self.NeedsSU():
+        # "su -c sh -c" allows using shell features in |cmd|
+        cmd = 'su -c sh -c %s' % cmd_helper.SingleQuote(cmd)
+      return cmd
+
     if not isinstance(cmd, basestring):
-      cmd = ' '.join(cmd_helper.SingleQuote(s) for s in cmd)
+      cmd = _QuoteArgv(cmd)
     if env:
       env = ' '.join(env_quote(k, v) for k, v in env.iteritems())
       cmd = '%s %s' % (env, cmd)
     if cwd:
       cmd = 'cd %s && %s' % (cmd_helper.SingleQuote(cwd), cmd)
-    if as_root and self.NeedsSU():
-      # "su -c sh -c" allows using shell features in |cmd|
-      cmd = 'su -c sh -c %s' % cmd_helper.SingleQuote(cmd)
     if timeout is None:
       timeout = self._default_timeout
 
+    # Large commands are pushed as they are and only the command running the
+    # script is wrapped with su, rather than quoting the whole command.
+    full_cmd = cmd
     if len(cmd) < self._MAX_ADB_COMMAND_LENGTH:
-      output = do_run(cmd)
+      full_cmd = wrap_as_root(cmd)
+    if len(full_cmd) < self._MAX_ADB_COMMAND_LENGTH:
+      output = do_run(full_cmd)
     else:
       with device_temp_file.DeviceTempFile(self.adb, suffix='.sh') as script:
         self._WriteFileWithPush(script.name, cmd)
         logging.info('Large shell command will be run from file: %s ...',
                      cmd[:100])
-        output = do_run('sh %s' % script.name_quoted)
+        output = do_run(wrap_as_root('sh %s' % script.name_quoted))
 
-    output = output.splitlines()
     if single_line:
-      if not output:
-        return ''
-      elif len(output) == 1:
-        return output[0]
+      # Strip a single line terminator and avoid splitting the output in the
+      # common case where there is nothing else to split on.
+      if output.endswith('\r\n'):
+        line = output[:-2]
+      elif output.endswith('\n') or output.endswith('\r'):
+        line = output[:-1]
       else:
-        msg = 'one line of output was expected, but got: %s'
-        raise device_errors.CommandFailedError(msg % output, str(self))
+        line = output
+      if '\n' not in line and '\r' not in line:
+        return line
+      msg = 'one line of output was expected, but got: %s'
+      raise device_errors.CommandFailedError(
+          msg % output.splitlines(), str(self))
     else:
-      return output
+      return output.splitlines()
 
   @decorators.WithTimeoutAndRetriesFromInstance()
   def KillAll(self, process_name, signum=9, as_root=False, blocking=False,
@@ -561,24 +933,29 @@ class DeviceUtils(object):
       timeout: timeout in seconds
       retries: number of retries
 
+    Returns:
+      The number of processes killed.
+
     Raises:
       CommandFailedError if no process was killed.
       CommandTimeoutError on timeout.
       DeviceUnreachableError on missing device.
     """
-    pids = self._GetPidsImpl(process_name)
+    # Looking up the pids, killing the processes and, if blocking, waiting for
+    # them to die all happen in a single shell script rather than taking an
+    # adb round-trip each.
+    find_pids = _FIND_PIDS_SCRIPT % cmd_helper.SingleQuote(process_name)
+    script = 'pids=$(%s); echo $pids; test -z "$pids" || kill -%d $pids' % (
+        find_pids, signum)
+    if blocking:
+      script += (' && while test -n "$(%s)"; do '
+                 'sleep 0.1 2>/dev/null || sleep 1; done' % find_pids)
+    # The pids are echoed on a single line, and passed to a single kill.
+    pids = self.RunShellCommand(
+        script, as_root=as_root, check_return=True, single_line=True).split()
     if not pids:
       raise device_errors.CommandFailedError(
           'No process "%s"' % process_name, str(self))
-
-    cmd = ['kill', '-%d' % signum] + pids.values()
-    self.RunShellCommand(cmd, as_root=as_root, check_return=True)
-
-    if blocking:
-      wait_period = 0.1
-      while self._GetPidsImpl(process_name):
-        time.sleep(wait_period)
-
     return len(pids)
 
   @decorators.WithTimeoutAndRetriesFromInstance()
@@ -692,13 +1069,41 @@ class DeviceUtils(object):
       CommandTimeoutError on timeout.
       DeviceUnreachableError on missing device.
     """
+    self.RunShellCommand(self._ClearApplicationStateScript(package),
+                         check_return=True)
+
+  @decorators.WithTimeoutAndRetriesFromInstance()
+  def ResetAppState(self, package, timeout=None, retries=None):
+    """Close the application and clear all of its state.
+
+    Equivalent to calling ForceStop and then ClearApplicationState, but
+    issues a single shell command.
+
+    Args:
+      package: A string containing the name of the package to reset.
+      timeout: timeout in seconds
+      retries: number of retries
+
+    Raises:
+      CommandTimeoutError on timeout.
+      DeviceUnreachableError on missing device.
+    """
+    self.RunShellCommand(
+        'am force-stop %s && %s' % (
+            cmd_helper.SingleQuote(package),
+            self._ClearApplicationStateScript(package)),
+        check_return=True)
+
+  def _ClearApplicationStateScript(self, package):
+    quoted_package = cmd_helper.SingleQuote(package)
+    if (self.build_version_sdk >=
+        constants.ANDROID_SDK_VERSION_CODES.JELLY_BEAN_MR2):
+      return 'pm clear %s' % quoted_package
     # Check that the package exists before clearing it for android builds below
     # JB MR2. Necessary because calling pm clear on a package that doesn't exist
     # may never return.
-    if ((self.build_version_sdk >=
-         constants.ANDROID_SDK_VERSION_CODES.JELLY_BEAN_MR2)
-        or self.GetApplicationPath(package)):
-      self.RunShellCommand(['pm', 'clear', package], check_return=True)
+    return 'case "$(pm path %s)" in package:*) pm clear %s;; esac' % (
+        quoted_package, quoted_package)
 
   @decorators.WithTimeoutAndRetriesFromInstance()
   def SendKeyEvent(self, keycode, timeout=None, retries=None):
@@ -724,7 +1129,7 @@ class DeviceUtils(object):
   @decorators.WithTimeoutAndRetriesDefaults(
       PUSH_CHANGED_FILES_DEFAULT_TIMEOUT,
       PUSH_CHANGED_FILES_DEFAULT_RETRIES)
-  def PushChangedFiles(self, host_device_tuples, timeout=None,
+  def PushChangedFiles(self, host_device_tuples, strict=False, timeout=None,
                        retries=None):
     """Push files to the device, skipping files that don't need updating.
 
@@ -733,6 +1138,9 @@ class DeviceUtils(object):
         |host_path| is an absolute path of a file or directory on the host
         that should be minimially pushed to the device, and |device_path| is
         an absolute path of the destination on the device.
+      strict: A boolean indicating whether to compare the md5 sums of all
+        files. By default, files whose size and modification time match on
+        the host and the device are assumed to be identical.
       timeout: timeout in seconds
       retries: number of retries
 
@@ -742,38 +1150,41 @@ class DeviceUtils(object):
       DeviceUnreachableError on missing device.
     """
 
-    files = []
-    for h, d in host_device_tuples:
-      if os.path.isdir(h):
-        self.RunShellCommand(['mkdir', '-p', d], check_return=True)
-      files += self._GetChangedFilesImpl(h, d)
+    device_dirs = [d for h, d in host_device_tuples if os.path.isdir(h)]
+    if device_dirs:
+      self.RunShellCommand(['mkdir', '-p'] + device_dirs, check_return=True)
+    files = self._GetChangedFiles(host_device_tuples, strict=strict)
 
     if not files:
       return
 
     size = sum(host_utils.GetRecursiveDiskUsage(h) for h, _ in files)
     file_count = len(files)
-    dir_size = sum(host_utils.GetRecursiveDiskUsage(h)
-                   for h, _ in host_device_tuples)
     dir_file_count = 0
+    dir_size = 0
     for h, _ in host_device_tuples:
-      if os.path.isdir(h):
-        dir_file_count += sum(len(f) for _r, _d, f in os.walk(h))
-      else:
-        dir_file_count += 1
+      count, usage = host_utils.GetRecursiveFileCountAndDiskUsage(h)
+      dir_file_count += count
+      dir_size += usage
 
     push_duration = self._ApproximateDuration(
         file_count, file_count, size, False)
     dir_push_duration = self._ApproximateDuration(
         len(host_device_tuples), dir_file_count, dir_size, False)
-    zip_duration = self._ApproximateDuration(1, 1, size, True)
+    zip_shards = self._GetZipShardCount(file_count)
+    compression_ratio = self._EstimateCompressionRatio(files)
+    zip_duration = self._ApproximateDuration(
+        zip_shards, zip_shards, size, True, zip_jobs=zip_shards,
+        compression_ratio=compression_ratio)
 
     self._InstallCommands()
+    can_zip = (self._commands_installed
+               and compression_ratio >= _PUSH_MIN_COMPRESSION_RATIO)
 
     if dir_push_duration < push_duration and (
-        dir_push_duration < zip_duration or not self._commands_installed):
+        dir_push_duration < zip_duration or not can_zip):
       self._PushChangedFilesIndividually(host_device_tuples)
-    elif push_duration < zip_duration or not self._commands_installed:
+    elif push_duration < zip_duration or not can_zip:
       self._PushChangedFilesIndividually(files)
     else:
       self._PushChangedFilesZipped(files)
@@ -782,41 +1193,161 @@ class DeviceUtils(object):
           as_root=True, check_return=True)
 
   def _GetChangedFilesImpl(self, host_path, device_path):
-    real_host_path = os.path.realpath(host_path)
-    try:
-      real_device_path = self.RunShellCommand(
-          ['realpath', device_path], single_line=True, check_return=True)
-    except device_errors.CommandFailedError:
-      real_device_path = None
-    if not real_device_path:
-      return [(host_path, device_path)]
-
-    host_hash_tuples = md5sum.CalculateHostMd5Sums([real_host_path])
-    device_paths_to_md5 = (
-        real_device_path if os.path.isfile(real_host_path)
-        else ('%s/%s' % (real_device_path, os.path.relpath(p, real_host_path))
-              for _, p in host_hash_tuples))
-    device_hash_tuples = md5sum.CalculateDeviceMd5Sums(
-        device_paths_to_md5, self)
-
-    if os.path.isfile(host_path):
-      if (not device_hash_tuples
-          or device_hash_tuples[0].hash != host_hash_tuples[0].hash):
-        return [(host_path, device_path)]
+    return self._GetChangedFiles([(host_path, device_path)], strict=True)
+
+  def _GetChangedFiles(self, host_device_tuples, strict=False):
+    """Finds the files in |host_device_tuples| that differ on the device.
+
+    Unless |strict| is set, the sizes and modification times of the files are
+    compared first, so that only files with the same size but a different
+    modification time need to be hashed. The md5 sums of all the remaining
+    host and device paths are computed with a single call each, rather than
+    one call per (host_path, device_path) tuple.
+
+    Args:
+      host_device_tuples: A list of (host_path, device_path) tuples, as in
+        PushChangedFiles.
+      strict: A boolean indicating whether to compare the md5 sums of all
+        files, skipping the size and modification time comparison.
+
+    Returns:
+      A list of (host_path, device_path) tuples of the files to push.
+    """
+    real_device_paths = self._ResolveRealPaths(
+        [d for _, d in host_device_tuples])
+
+    to_push = []
+    to_diff = []
+    for (host_path, device_path), real_device_path in zip(
+        host_device_tuples, real_device_paths):
+      if real_device_path:
+        to_diff.append((host_path, os.path.realpath(host_path),
+                        device_path, real_device_path))
       else:
-        return []
-    else:
-      device_tuple_dict = dict((d.path, d.hash) for d in device_hash_tuples)
-      to_push = []
-      for host_hash, host_abs_path in (
-          (h.hash, h.path) for h in host_hash_tuples):
-        device_abs_path = '%s/%s' % (
-            real_device_path, os.path.relpath(host_abs_path, real_host_path))
-        if (device_abs_path not in device_tuple_dict
-            or device_tuple_dict[device_abs_path] != host_hash):
-          to_push.append((host_abs_path, device_abs_path))
+        to_push.append((host_path, device_path))
+    if to_diff and not strict:
+      changed, to_diff = self._FilterChangedFilesByStat(to_diff)
+      to_push.extend(changed)
+    if not to_diff:
       return to_push
 
+    host_hash_tuples = md5sum.CalculateHostMd5Sums(
+        [real_host_path for _, real_host_path, _, _ in to_diff])
+    host_hashes_by_root = []
+    device_paths_to_md5 = []
+    for host_path, real_host_path, _, real_device_path in to_diff:
+      if os.path.isfile(host_path):
+        root_hashes = [(h.hash, h.path, real_device_path)
+                       for h in host_hash_tuples if h.path == real_host_path]
+      else:
+        prefix = real_host_path.rstrip(os.sep) + os.sep
+        root_hashes = [
+            (h.hash, h.path, '%s/%s' % (
+                real_device_path, os.path.relpath(h.path, real_host_path)))
+            for h in host_hash_tuples if h.path.startswith(prefix)]
+      host_hashes_by_root.append(root_hashes)
+      device_paths_to_md5.extend(p for _, _, p in root_hashes)
+
+    device_hashes = dict(
+        (d.path, d.hash) for d in md5sum.CalculateDeviceMd5Sums(
+            device_paths_to_md5, self))
+
+    for (host_path, _, device_path, _), root_hashes in zip(
+        to_diff, host_hashes_by_root):
+      if os.path.isfile(host_path):
+        if (not root_hashes
+            or device_hashes.get(root_hashes[0][2]) != root_hashes[0][0]):
+          to_push.append((host_path, device_path))
+      else:
+        to_push.extend(
+            (host_abs_path, device_abs_path)
+            for host_hash, host_abs_path, device_abs_path in root_hashes
+            if device_hashes.get(device_abs_path) != host_hash)
+    return to_push
+
+  def _FilterChangedFilesByStat(self, to_diff):
+    """Compares the sizes and modification times of files to push.
+
+    Args:
+      to_diff: A list of (host_path, real_host_path, device_path,
+        real_device_path) tuples of files or directories that exist on both
+        the host and the device.
+
+    Returns:
+      A (changed, to_diff) tuple. |changed| is a list of (host_path,
+      device_path) tuples of files that differ in size or are missing on the
+      device. |to_diff| is a list in the same format as the argument with the
+      files, or whole directories, that still need their md5 sums compared.
+    """
+    device_stats = self._StatDeviceFiles([d for _, _, _, d in to_diff])
+    if not device_stats:
+      # Either nothing was found, or stat is not available on the device.
+      return [], to_diff
+    changed = []
+    uncertain = []
+    for host_path, real_host_path, device_path, real_device_path in to_diff:
+      if os.path.isfile(host_path):
+        host_files = [(host_path, device_path, real_device_path)]
+      else:
+        host_files = []
+        for root, _, files in os.walk(real_host_path):
+          for f in files:
+            host_file = os.path.join(root, f)
+            device_file = '%s/%s' % (
+                real_device_path, os.path.relpath(host_file, real_host_path))
+            host_files.append((host_file, device_file, device_file))
+      for host_file, device_file, real_device_file in host_files:
+        host_stat = os.stat(host_file)
+        device_stat = device_stats.get(real_device_file)
+        if device_stat is None or device_stat[0] != host_stat.st_size:
+          changed.append((host_file, device_file))
+        elif device_stat[1] != int(host_stat.st_mtime):
+          uncertain.append((host_file, os.path.realpath(host_file),
+                            device_file, real_device_file))
+    return changed, uncertain
+
+  def _StatDeviceFiles(self, device_paths):
+    """Gets the sizes and modification times of files with one shell call.
+
+    Args:
+      device_paths: A list of paths of files or directories on the device.
+        Directories are listed recursively.
+
+    Returns:
+      A dict mapping the path of each file found to a (size, mtime) tuple.
+      Files are silently left out if stat is not available on the device.
+    """
+    script = '; '.join(
+        "find %s -type f -exec stat -c '%%s %%Y %%n' {} + 2>/dev/null"
+        % cmd_helper.SingleQuote(p) for p in device_paths)
+    stats = {}
+    for line in self.RunShellCommand(script):
+      m = _STAT_RE.match(line)
+      if m:
+        stats[m.group('path')] = (int(m.group('size')), int(m.group('mtime')))
+    return stats
+
+  def _ResolveRealPaths(self, device_paths):
+    """Resolves the real paths of |device_paths| with a single shell call.
+
+    Args:
+      device_paths: A list of paths on the device.
+
+    Returns:
+      A list with the real path of each of |device_paths|, or None for those
+      that could not be resolved (e.g. because they do not exist).
+    """
+    script = '; '.join('echo "$(realpath %s 2>/dev/null)"'
+                       % cmd_helper.SingleQuote(p) for p in device_paths)
+    try:
+      real_paths = self.RunShellCommand(script, check_return=True)
+    except device_errors.CommandFailedError:
+      real_paths = []
+    if len(real_paths) != len(device_paths):
+      logging.warning('Could not resolve the real paths of %s', device_paths)
+      return [None] * len(device_paths)
+    return [p or None for p in real_paths]
+
   def _InstallCommands(self):
     if self._commands_installed is None:
       try:
@@ -828,70 +1359,183 @@ class DeviceUtils(object):
         self._commands_installed = False
 
   @staticmethod
-  def _ApproximateDuration(adb_calls, file_count, byte_count, is_zipping):
+  def _ApproximateDuration(adb_calls, file_count, byte_count, is_zipping,
+                           zip_jobs=1,
+                           compression_ratio=_PUSH_COMPRESSION_RATIO):
     # We approximate the time to push a set of files to a device as:
-    #   t = c1 * a + c2 * f + c3 + b / c4 + b / (c5 * c6), where
+    #   t = c1 * a / p + c2 * f + c3 + b / (c4 * j) + b / (c5 * c6), where
     #     t: total time (sec)
     #     c1: adb call time delay (sec)
     #     a: number of times adb is called (unitless)
+    #     p: number of adb pushes run in parallel, 1 when zipping (unitless)
     #     c2: push time delay (sec)
     #     f: number of files pushed via adb (unitless)
     #     c3: zip time delay (sec)
     #     c4: zip rate (bytes/sec)
+    #     j: number of zip files created in parallel (unitless)
     #     b: total number of bytes (bytes)
     #     c5: transfer rate (bytes/sec)
     #     c6: compression ratio (unitless)
-
-    # All of these are approximations.
-    ADB_CALL_PENALTY = 0.1 # seconds
-    ADB_PUSH_PENALTY = 0.01 # seconds
-    ZIP_PENALTY = 2.0 # seconds
-    ZIP_RATE = 10000000.0 # bytes / second
-    TRANSFER_RATE = 2000000.0 # bytes / second
-    COMPRESSION_RATIO = 2.0 # unitless
-
-    adb_call_time = ADB_CALL_PENALTY * adb_calls
-    adb_push_setup_time = ADB_PUSH_PENALTY * file_count
+    # See the _PUSH_* constants for the values of c1 to c5. c6 is estimated
+    # from the files to push when possible.
+    adb_call_time = _PUSH_ADB_CALL_PENALTY * adb_calls
+    if not is_zipping:
+      adb_call_time /= min(DeviceUtils._MAX_PARALLEL_PUSHES, max(1, adb_calls))
+    adb_push_setup_time = _PUSH_ADB_PUSH_PENALTY * file_count
     if is_zipping:
-      zip_time = ZIP_PENALTY + byte_count / ZIP_RATE
-      transfer_time = byte_count / (TRANSFER_RATE * COMPRESSION_RATIO)
+      zip_time = _PUSH_ZIP_PENALTY + byte_count / (_PUSH_ZIP_RATE * zip_jobs)
+      transfer_time = byte_count / (_PUSH_TRANSFER_RATE * compression_ratio)
     else:
       zip_time = 0
-      transfer_time = byte_count / TRANSFER_RATE
+      transfer_time = byte_count / _PUSH_TRANSFER_RATE
     return adb_call_time + adb_push_setup_time + zip_time + transfer_time
 
+  @staticmethod
+  def _EstimateCompressionRatio(files):
+    """Estimates how much zipping the given files would reduce their size.
+
+    Only the first _PUSH_COMPRESSION_SAMPLE_SIZE bytes of the files are read
+    and compressed, with the fastest zlib compression level.
+
+    Args:
+      files: A list of (host_path, device_path) tuples. Host paths may be
+        directories.
+
+    Returns:
+      The ratio between the size of the sample and its compressed size.
+    """
+    def host_files():
+      for host_path, _ in files:
+        if os.path.isdir(host_path):
+          for root, _, filenames in os.walk(host_path):
+            for f in filenames:
+              yield os.path.join(root, f)
+        else:
+          yield host_path
+
+    sample = []
+    sample_size = 0
+    for host_file in host_files():
+      if sample_size >= _PUSH_COMPRESSION_SAMPLE_SIZE:
+        break
+      with open(host_file, 'rb') as f:
+        data = f.read(_PUSH_COMPRESSION_SAMPLE_SIZE - sample_size)
+      sample.append(data)
+      sample_size += len(data)
+    if not sample_size:
+      return _PUSH_COMPRESSION_RATIO
+    return float(sample_size) / len(zlib.compress(''.join(sample), 1))
+
+  # Maximum number of adb push commands run concurrently when pushing files
+  # individually.
+  _MAX_PARALLEL_PUSHES = 4
+
   def _PushChangedFilesIndividually(self, files):
+    for _, d in files:
+      self._InvalidateLsCache(d)
+    push_jobs = min(self._MAX_PARALLEL_PUSHES, len(files))
+    if push_jobs > 1:
+      def push_files(job_files):
+        for h, d in job_files:
+          self.adb.Push(h, d)
+
+      push_threads = reraiser_thread.ReraiserThreadGroup([
+          reraiser_thread.ReraiserThread(
+              push_files, args=[files[i::push_jobs]],
+              name='push-%d-%s' % (i, str(self)))
+          for i in xrange(push_jobs)])
+      try:
+        push_threads.StartAll()
+        push_threads.JoinAll()
+        return
+      except device_errors.CommandFailedError:
+        logging.warning('Parallel push failed. Retrying sequentially.')
     for h, d in files:
       self.adb.Push(h, d)
 
+  # Below this many files per zip, the files are not split across several
+  # zip files created in parallel.
+  _MIN_FILES_PER_ZIP_SHARD = 32
+
+  @staticmethod
+  def _GetZipShardCount(file_count):
+    return max(1, min(multiprocessing.cpu_count(),
+                      file_count // DeviceUtils._MIN_FILES_PER_ZIP_SHARD))
+
   def _PushChangedFilesZipped(self, files):
     if not files:
       return
 
-    with tempfile.NamedTemporaryFile(suffix='.zip') as zip_file:
-      zip_proc = multiprocessing.Process(
-          target=DeviceUtils._CreateDeviceZip,
-          args=(zip_file.name, files))
-      zip_proc.start()
-      zip_proc.join()
-
-      zip_on_device = '%s/tmp.zip' % self.GetExternalStoragePath()
-      try:
-        self.adb.Push(zip_file.name, zip_on_device)
+    # Compression is CPU bound, so large sets of files are split across
+    # several zip files, each created by its own process. A single zip file is
+    # created in this process, which avoids paying for a fork that would only
+    # be waited on.
+    shard_count = self._GetZipShardCount(len(files))
+    shards = [files[i::shard_count] for i in xrange(shard_count)]
+    zip_files = []
+    zip_procs = []
+    pushed_zips = []
+    try:
+      for shard in shards:
+        zip_file = tempfile.NamedTemporaryFile(suffix='.zip')
+        zip_files.append(zip_file)
+        if shard_count == 1:
+          self._CreateDeviceZip(zip_file.name, shard)
+          continue
+        zip_proc = multiprocessing.Process(
+            target=DeviceUtils._CreateDeviceZip,
+            args=(zip_file.name, shard))
+        zip_procs.append(zip_proc)
+        zip_proc.start()
+
+      external_storage = self.GetExternalStoragePath()
+      if shard_count == 1:
+        zips_on_device = ['%s/tmp.zip' % external_storage]
+      else:
+        zips_on_device = ['%s/tmp%d.zip' % (external_storage, i)
+                          for i in xrange(shard_count)]
+      for _, device_path in files:
+        self._InvalidateLsCache(device_path)
+      for zip_on_device in zips_on_device:
+        self._InvalidateLsCache(zip_on_device)
+      # Each zip file is pushed as soon as it is ready, while the following
+      # ones are still being created.
+      for i, zip_on_device in enumerate(zips_on_device):
+        if zip_procs:
+          zip_procs[i].join()
+          if zip_procs[i].exitcode != 0:
+            raise device_errors.CommandFailedError(
+                'Failed to create zip files to push (exit code %s)'
+                % zip_procs[i].exitcode, str(self))
+        pushed_zips.append(zip_on_device)
+        self.adb.Push(zip_files[i].name, zip_on_device)
+      if shard_count == 1:
         self.RunShellCommand(
-            ['unzip', zip_on_device],
+            ['unzip', zips_on_device[0]],
             as_root=True,
             env={'PATH': '%s:$PATH' % install_commands.BIN_DIR},
             check_return=True)
-      finally:
+      else:
+        # A PATH set through |env| would only apply to the first command of
+        # the chain, so unzip is run by its absolute path instead.
+        self.RunShellCommand(
+            ' && '.join('%s/unzip %s' % (install_commands.BIN_DIR,
+                                         cmd_helper.SingleQuote(z))
+                        for z in zips_on_device),
+            as_root=True,
+            check_return=True)
+    finally:
+      for zip_proc in zip_procs:
         if zip_proc.is_alive():
           zip_proc.terminate()
-        if self.IsOnline():
-          self.RunShellCommand(['rm', zip_on_device], check_return=True)
+      for zip_file in zip_files:
+        zip_file.close()
+      if pushed_zips and self.IsOnline():
+        self.RunShellCommand(['rm'] + pushed_zips, check_return=True)
 
   @staticmethod
   def _CreateDeviceZip(zip_path, host_device_tuples):
-    with zipfile.ZipFile(zip_path, 'w') as zip_file:
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
       for host_path, device_path in host_device_tuples:
         zip_utils.WriteToZipFile(zip_file, host_path, device_path)
 
@@ -912,6 +1556,8 @@ class DeviceUtils(object):
       CommandTimeoutError on timeout.
       DeviceUnreachableError on missing device.
     """
+    if self._GetCachedStat(device_path) is not None:
+      return True
     try:
       self.RunShellCommand(['test', '-e', device_path], check_return=True)
       return True
@@ -951,6 +1597,10 @@ class DeviceUtils(object):
       if os.path.exists(d):
         shutil.rmtree(d)
 
+  def _ReadFileWithExecOut(self, device_path):
+    return self.adb.ExecOut(
+        'cat %s' % cmd_helper.SingleQuote(device_path), timeout=60*5)
+
   _LS_RE = re.compile(
       r'(?P<perms>\S+) +(?P<owner>\S+) +(?P<group>\S+) +(?:(?P<size>\d+) +)?'
       + r'(?P<date>\S+) +(?P<time>\S+) +(?P<name>.+)$')
@@ -981,15 +1631,21 @@ class DeviceUtils(object):
     # TODO(jbudorick): Implement a generic version of Stat() that handles
     # as_root=True, then switch this implementation to use that.
     size = None
-    ls_out = self.RunShellCommand(['ls', '-l', device_path], as_root=as_root,
-                                  check_return=True)
-    for line in ls_out:
-      m = self._LS_RE.match(line)
-      if m and m.group('name') == posixpath.basename(device_path):
-        size = int(m.group('size'))
-        break
+    # Fall back to parsing the output of ls -l on devices without stat -c.
+    quoted_path = cmd_helper.SingleQuote(device_path)
+    size_out = self.RunShellCommand(
+        'stat -c %%s %s 2>/dev/null || ls -l %s' % (quoted_path, quoted_path),
+        as_root=as_root, check_return=True)
+    if len(size_out) == 1 and size_out[0].isdigit():
+      size = int(size_out[0])
     else:
-      logging.warning('Could not determine size of %s.', device_path)
+      for line in size_out:
+        m = self._LS_RE.match(line)
+        if m and m.group('name') == posixpath.basename(device_path):
+          size = int(m.group('size'))
+          break
+      else:
+        logging.warning('Could not determine size of %s.', device_path)
 
     if size is None or size <= self._MAX_ADB_OUTPUT_LENGTH:
       return _JoinLines(self.RunShellCommand(
@@ -999,6 +1655,9 @@ class DeviceUtils(object):
         self.RunShellCommand(['cp', device_path, device_temp.name],
                              as_root=True, check_return=True)
         return self._ReadFileWithPull(device_temp.name)
+    elif (self.build_version_sdk >=
+          constants.ANDROID_SDK_VERSION_CODES.LOLLIPOP):
+      return self._ReadFileWithExecOut(device_path)
     else:
       return self._ReadFileWithPull(device_path)
 
@@ -1006,8 +1665,31 @@ class DeviceUtils(object):
     with tempfile.NamedTemporaryFile() as host_temp:
       host_temp.write(contents)
       host_temp.flush()
+      self._InvalidateLsCache(device_path)
       self.adb.Push(host_temp.name, device_path)
 
+  def _WriteFileWithEcho(self, device_path, contents, as_root):
+    self._InvalidateLsCache(device_path)
+    quoted_path = cmd_helper.SingleQuote(device_path)
+    global_cache = self._GetGlobalCache()
+    if global_cache.get('has_base64', True):
+      # base64 encoded contents need no escaping, and may hold binary data.
+      cmd = 'echo %s | base64 -d > %s' % (base64.b64encode(contents),
+                                          quoted_path)
+      if len(cmd) < self._MAX_ADB_COMMAND_LENGTH:
+        try:
+          self.RunShellCommand(cmd, as_root=as_root, check_return=True)
+          global_cache['has_base64'] = True
+          return
+        except device_errors.AdbCommandFailedError as e:
+          # Older devices do not ship a base64 binary. Other failures, e.g. a
+          # missing directory, say nothing about base64 and are raised.
+          if e.status != 127 and 'not found' not in (e.output or ''):
+            raise
+          global_cache['has_base64'] = False
+    cmd = 'echo -n %s > %s' % (cmd_helper.SingleQuote(contents), quoted_path)
+    self.RunShellCommand(cmd, as_root=as_root, check_return=True)
+
   @decorators.WithTimeoutAndRetriesFromInstance()
   def WriteFile(self, device_path, contents, as_root=False, force_push=False,
                 timeout=None, retries=None):
@@ -1033,9 +1715,7 @@ class DeviceUtils(object):
     if not force_push and len(contents) < self._MAX_ADB_COMMAND_LENGTH:
       # If the contents are small, for efficieny we write the contents with
       # a shell command rather than pushing a file.
-      cmd = 'echo -n %s > %s' % (cmd_helper.SingleQuote(contents),
-                                 cmd_helper.SingleQuote(device_path))
-      self.RunShellCommand(cmd, as_root=as_root, check_return=True)
+      self._WriteFileWithEcho(device_path, contents, as_root)
     elif as_root and self.NeedsSU():
       # Adb does not allow to "push with su", so we first push to a temp file
       # on a safe location, and then copy it to the desired location with su.
@@ -1044,6 +1724,7 @@ class DeviceUtils(object):
         # Here we need 'cp' rather than 'mv' because the temp and
         # destination files might be on different file systems (e.g.
         # on internal storage and an external sd card).
+        self._InvalidateLsCache(device_path)
         self.RunShellCommand(['cp', device_temp.name, device_path],
                              as_root=True, check_return=True)
     else:
@@ -1091,12 +1772,53 @@ class DeviceUtils(object):
       DeviceUnreachableError on missing device.
     """
     dirname, target = device_path.rsplit('/', 1)
-    for filename, stat in self.adb.Ls(dirname):
+    for filename, stat in self._LsCached(dirname):
       if filename == target:
         return stat
     raise device_errors.CommandFailedError(
         'Cannot find file or directory: %r' % device_path, str(self))
 
+  def _LsCached(self, dirname):
+    """Lists |dirname| with adb.Ls, reusing listings made within the TTL.
+
+    DeviceUtils methods that change files drop the listings they make stale,
+    and shell commands other than _READ_ONLY_SHELL_COMMANDS drop them all.
+    """
+    now = time.time()
+    entry = self._ls_cache.pop(dirname, None)
+    if entry is None or now - entry[0] > self._LS_CACHE_TTL:
+      entry = (now, self.adb.Ls(dirname))
+    self._ls_cache[dirname] = entry
+    while len(self._ls_cache) > self._LS_CACHE_MAX_SIZE:
+      self._ls_cache.popitem(last=False)
+    return entry[1]
+
+  def _GetCachedStat(self, device_path):
+    """Gets the stat of |device_path| from a recent listing of its directory.
+
+    Never lists the directory itself, so that a cache miss costs nothing.
+
+    Returns:
+      The stat object of |device_path|, or None if its directory has not been
+      listed within the TTL or the path was not found in the listing.
+    """
+    dirname, _, target = device_path.rpartition('/')
+    entry = self._ls_cache.get(dirname)
+    if entry is None or time.time() - entry[0] > self._LS_CACHE_TTL:
+      return None
+    for filename, file_stat in entry[1]:
+      if filename == target:
+        return file_stat
+    return None
+
+  def _InvalidateLsCache(self, device_path):
+    """Drops the listings that a change to |device_path| makes stale."""
+    path = device_path.rstrip('/')
+    self._ls_cache.pop(path.rpartition('/')[0], None)
+    for dirname in [d for d in self._ls_cache
+                    if d == path or d.startswith(path + '/')]:
+      del self._ls_cache[dirname]
+
   @decorators.WithTimeoutAndRetriesFromInstance()
   def SetJavaAsserts(self, enabled, timeout=None, retries=None):
     """Enables or disables Java asserts.
@@ -1125,12 +1847,26 @@ class DeviceUtils(object):
 
     new_value = 'all' if enabled else ''
 
+    # Read both the persisted and the runtime values in a single shell call.
+    # The separator is printed after a line break, so that it is on its own
+    # line even if the file does not end with one.
+    output = self.RunShellCommand(
+        "cat %s 2>/dev/null; printf '\\n%%s\\n' %s; getprop %s" % (
+            cmd_helper.SingleQuote(constants.DEVICE_LOCAL_PROPERTIES_PATH),
+            _JAVA_ASSERTS_SEPARATOR, self.JAVA_ASSERT_PROPERTY))
+    if _JAVA_ASSERTS_SEPARATOR not in output:
+      raise device_errors.CommandFailedError(
+          'Unexpected output while reading %s: %r' % (
+              self.JAVA_ASSERT_PROPERTY, output), str(self))
+    separator_index = output.index(_JAVA_ASSERTS_SEPARATOR)
+    properties = output[:separator_index]
+    if properties and properties[-1] == '':
+      # Drop the empty line left by the line break before the separator.
+      properties.pop()
+    runtime_value = ''.join(output[separator_index+1:]).strip()
+
+    commands = []
     # First ensure the desired property is persisted.
-    try:
-      properties = self.ReadFile(
-          constants.DEVICE_LOCAL_PROPERTIES_PATH).splitlines()
-    except device_errors.CommandFailedError:
-      properties = []
     index, value = find_property(properties, self.JAVA_ASSERT_PROPERTY)
     if new_value != value:
       if new_value:
@@ -1142,18 +1878,22 @@ class DeviceUtils(object):
       else:
         assert index is not None # since new_value == '' and new_value != value
         properties.pop(index)
-      self.WriteFile(constants.DEVICE_LOCAL_PROPERTIES_PATH,
-                     _JoinLines(properties))
+      commands.append('echo -n %s > %s' % (
+          cmd_helper.SingleQuote(_JoinLines(properties)),
+          cmd_helper.SingleQuote(constants.DEVICE_LOCAL_PROPERTIES_PATH)))
 
     # Next, check the current runtime value is what we need, and
     # if not, set it and report that a reboot is required.
-    value = self.GetProp(self.JAVA_ASSERT_PROPERTY)
-    if new_value != value:
-      self.SetProp(self.JAVA_ASSERT_PROPERTY, new_value)
-      return True
-    else:
-      return False
+    restart_required = new_value != runtime_value
+    if restart_required:
+      commands.append('setprop %s %s' % (
+          self.JAVA_ASSERT_PROPERTY, cmd_helper.SingleQuote(new_value)))
+      self._cache.pop('_prop:' + self.JAVA_ASSERT_PROPERTY, None)
+      self._cache.pop('_props_loaded', None)
 
+    if commands:
+      self.RunShellCommand(' && '.join(commands), check_return=True)
+    return restart_required
 
   @property
   def build_description(self):
@@ -1249,14 +1989,36 @@ class DeviceUtils(object):
     else:
       # timeout and retries are handled down at run shell, because we don't
       # want to apply them in the other branch when reading from the cache
+      timeout = self._default_timeout if timeout is DEFAULT else timeout
+      retries = self._default_retries if retries is DEFAULT else retries
+      if cache and not self._cache.get('_props_loaded'):
+        self._LoadAllProps(timeout=timeout, retries=retries)
+        if cache_key in self._cache:
+          return self._cache[cache_key]
       value = self.RunShellCommand(
           ['getprop', property_name], single_line=True, check_return=True,
-          timeout=self._default_timeout if timeout is DEFAULT else timeout,
-          retries=self._default_retries if retries is DEFAULT else retries)
+          timeout=timeout, retries=retries)
       if cache or cache_key in self._cache:
         self._cache[cache_key] = value
       return value
 
+  def _LoadAllProps(self, timeout=None, retries=None):
+    """Reads all properties with a single getprop call and caches them.
+
+    Properties whose values span several lines are not cached, and are read
+    on their own by GetProp instead.
+
+    Args:
+      timeout: timeout in seconds
+      retries: number of retries
+    """
+    for line in self.RunShellCommand(['getprop'], check_return=True,
+                                     timeout=timeout, retries=retries):
+      m = _GETPROP_RE.match(line)
+      if m:
+        self._cache['_prop:' + m.group('name')] = m.group('value')
+    self._cache['_props_loaded'] = True
+
   @decorators.WithTimeoutAndRetriesFromInstance()
   def SetProp(self, property_name, value, check=False, timeout=None,
               retries=None):
@@ -1282,8 +2044,8 @@ class DeviceUtils(object):
     assert isinstance(value, basestring), "value is not a string: %r" % value
 
     self.RunShellCommand(['setprop', property_name, value], check_return=True)
-    if property_name in self._cache:
-      del self._cache[property_name]
+    self._cache.pop('_prop:' + property_name, None)
+    self._cache.pop('_props_loaded', None)
     # TODO(perezju) remove the option and make the check mandatory, but using a
     # single shell script to both set- and getprop.
     if check and value != self.GetProp(property_name):
@@ -1329,14 +2091,16 @@ class DeviceUtils(object):
     return self._GetPidsImpl(process_name)
 
   def _GetPidsImpl(self, process_name):
+    # Let the device filter the output of ps when grep is available, so only
+    # the matching lines need to be transferred. The lines are still matched
+    # here against the process name, i.e. the last column.
+    ps_cmd = ('if type grep >/dev/null 2>&1; then ps | grep -F -e %s || true; '
+              'else ps; fi' % cmd_helper.SingleQuote(process_name))
     procs_pids = {}
-    for line in self.RunShellCommand('ps', check_return=True):
-      try:
-        ps_data = line.split()
-        if process_name in ps_data[-1]:
-          procs_pids[ps_data[-1]] = ps_data[1]
-      except IndexError:
-        pass
+    for line in self.RunShellCommand(ps_cmd, check_return=True):
+      ps_data = line.split()
+      if len(ps_data) >= 2 and process_name in ps_data[-1]:
+        procs_pids[ps_data[-1]] = ps_data[1]
     return procs_pids
 
   @decorators.WithTimeoutAndRetriesFromInstance()
@@ -1385,45 +2149,56 @@ class DeviceUtils(object):
     """
     result = collections.defaultdict(int)
 
+    # showmap and the status file are read in a single shell call; the exit
+    # status is not checked so that either of them can fail independently.
+    output = self.RunShellCommand(
+        'showmap %s; echo %s; cat /proc/%s/status' % (
+            pid, _MEMORY_USAGE_SEPARATOR, pid),
+        as_root=True)
+    if _MEMORY_USAGE_SEPARATOR in output:
+      separator_index = output.index(_MEMORY_USAGE_SEPARATOR)
+      showmap_out = output[:separator_index]
+      status_out = output[separator_index+1:]
+    else:
+      showmap_out = status_out = []
+
     try:
-      result.update(self._GetMemoryUsageForPidFromSmaps(pid))
+      result.update(self._ParseMemoryUsageFromShowmap(showmap_out))
     except device_errors.CommandFailedError:
       logging.exception('Error getting memory usage from smaps')
 
     try:
-      result.update(self._GetMemoryUsageForPidFromStatus(pid))
+      result.update(self._ParseMemoryUsageFromStatus(pid, status_out))
     except device_errors.CommandFailedError:
       logging.exception('Error getting memory usage from status')
 
     return result
 
-  def _GetMemoryUsageForPidFromSmaps(self, pid):
+  @staticmethod
+  def _ParseMemoryUsageFromShowmap(showmap_out):
     SMAPS_COLUMNS = (
         'Size', 'Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean',
         'Private_Dirty')
 
-    showmap_out = self.RunShellCommand(
-        ['showmap', str(pid)], as_root=True, check_return=True)
     if not showmap_out:
       raise device_errors.CommandFailedError('No output from showmap')
 
-    split_totals = showmap_out[-1].split()
-    if (not split_totals
-        or len(split_totals) != 9
-        or split_totals[-1] != 'TOTAL'):
+    m = _SHOWMAP_TOTAL_RE.match(showmap_out[-1])
+    if not m:
       raise device_errors.CommandFailedError(
           'Invalid output from showmap: %s' % '\n'.join(showmap_out))
 
-    return dict(itertools.izip(SMAPS_COLUMNS, (int(n) for n in split_totals)))
+    return dict(itertools.izip(SMAPS_COLUMNS,
+                               (int(n) for n in m.group(1).split())))
 
-  def _GetMemoryUsageForPidFromStatus(self, pid):
-    for line in self.ReadFile(
-        '/proc/%s/status' % str(pid), as_root=True).splitlines():
+  @staticmethod
+  def _ParseMemoryUsageFromStatus(pid, status_out):
+    for line in status_out:
       if line.startswith('VmHWM:'):
         return {'VmHWM': int(line.split()[1])}
     else:
       raise device_errors.CommandFailedError(
-          'Could not find memory peak value for pid %s', str(pid))
+          'Could not find memory peak value for pid %s' % str(pid))
 
   @decorators.WithTimeoutAndRetriesFromInstance()
   def GetLogcatMonitor(self, timeout=None, retries=None, *args, **kwargs):
@@ -1449,13 +2224,9 @@ class DeviceUtils(object):
       A dict containing various battery information as reported by dumpsys
       battery.
     """
-    result = {}
     # Skip the first line, which is just a header.
-    for line in self.RunShellCommand(
-        ['dumpsys', 'battery'], check_return=True)[1:]:
-      k, v = line.split(': ', 1)
-      result[k.strip()] = v.strip()
-    return result
+    output = self.RunShellCommand(['dumpsys', 'battery'], check_return=True)
+    return dict(_BATTERY_INFO_RE.findall('\n'.join(output[1:])))
 
   @decorators.WithTimeoutAndRetriesFromInstance()
   def GetCharging(self, timeout=None, retries=None):
@@ -1565,3 +2336,38 @@ class DeviceUtils(object):
       return parallelizer.Parallelizer(devices)
     else:
       return parallelizer.SyncParallelizer(devices)
+
+  @classmethod
+  def InstallMany(cls, devices, apk_path, reinstall=False, timeout=None):
+    """Installs an APK on several devices concurrently.
+
+    Each device runs Install, with its own timeouts and retries, on a separate
+    thread. Since every install mostly waits on its own adb connection, this
+    takes about as long as the slowest device rather than the sum of all of
+    them.
+
+    Args:
+      devices: A list of either DeviceUtils instances or objects from
+               from which DeviceUtils instances can be constructed. If None,
+               all attached devices will be used.
+      apk_path: A string containing the path to the APK to install.
+      reinstall: A boolean indicating if we should keep any existing app data.
+      timeout: The maximum number of seconds to wait for all devices to
+               finish, or None to wait until their own timeouts expire.
+
+    Raises:
+      CommandTimeoutError if the devices did not all finish within |timeout|.
+      Any exception raised by Install on any of the devices.
+    """
+    # The threads are joined here rather than with Parallelizer.pFinish, which
+    # does not enforce its timeout.
+    install_threads = reraiser_thread.ReraiserThreadGroup([
+        reraiser_thread.ReraiserThread(
+            d.Install, args=[apk_path], kwargs={'reinstall': reinstall},
+            name='install-%s' % str(d))
+        for d in cls.parallel(devices).pGet(None)])
+    install_threads.StartAll()
+    try:
+      install_threads.JoinAll(watchdog_timer.WatchdogTimer(timeout))
+    except reraiser_thread.TimeoutError as e:
+      raise device_errors.CommandTimeoutError(str(e)), None, sys.exc_info()[2]
@@ -16,9 +16,13 @@ import datetime
 import logging
 import os
 import re
+import shutil
 import signal
 import sys
+import tempfile
+import threading
 import unittest
+import zlib
 
 from pylib import android_commands
 from pylib import cmd_helper
@@ -27,7 +31,10 @@ from pylib.device import adb_wrapper
 from pylib.device import device_errors
 from pylib.device import device_utils
 from pylib.device import intent
+from pylib.utils import md5sum
 from pylib.utils import mock_calls
+from pylib.utils import reraiser_thread
+from pylib.utils import timeout_retry
 
 # RunCommand from third_party/android_testrunner/run_command.py is mocked
 # below, so its path needs to be in sys.path.
@@ -39,6 +46,46 @@ sys.path.append(os.path.join(
 import mock # pylint: disable=F0401
 
 
+class JoinLinesTest(unittest.TestCase):
+
+  def testJoinLines_empty(self):
+    self.assertEqual('', device_utils._JoinLines([]))
+
+  def testJoinLines_single(self):
+    self.assertEqual('line\n', device_utils._JoinLines(['line']))
+
+  def testJoinLines_multiple(self):
+    self.assertEqual('a\nb\n\nc\n',
+                     device_utils._JoinLines(['a', 'b', '', 'c']))
+
+  def testJoinLines_generator(self):
+    self.assertEqual('a\nb\n', device_utils._JoinLines(l for l in 'ab'))
+
+
+class QuoteArgvTest(unittest.TestCase):
+
+  def setUp(self):
+    device_utils._QUOTED_ARGV_CACHE.clear()
+
+  def testQuoteArgv_quoted(self):
+    self.assertEqual("echo 'hello world' '$10'",
+                     device_utils._QuoteArgv(['echo', 'hello world', '$10']))
+
+  def testQuoteArgv_cached(self):
+    with mock.patch('pylib.cmd_helper.SingleQuote',
+                    side_effect=lambda s: s) as mock_quote:
+      device_utils._QuoteArgv(['input', 'keyevent', '66'])
+      device_utils._QuoteArgv(['input', 'keyevent', '66'])
+      self.assertEqual(3, mock_quote.call_count)
+
+  def testQuoteArgv_bounded(self):
+    with mock.patch('pylib.device.device_utils._QUOTED_ARGV_CACHE_MAX_SIZE',
+                    2):
+      for i in xrange(3):
+        device_utils._QuoteArgv(['echo', str(i)])
+      self.assertEqual(1, len(device_utils._QUOTED_ARGV_CACHE))
+
+
 class DeviceUtilsInitTest(unittest.TestCase):
 
   def testInitWithStr(self):
@@ -131,6 +178,7 @@ def _AdbWrapperMock(test_serial):
 class DeviceUtilsTest(mock_calls.TestCase):
 
   def setUp(self):
+    device_utils.DeviceUtils.InvalidateGlobalCache()
     self.adb = _AdbWrapperMock('0123456789abcdef')
     self.device = device_utils.DeviceUtils(
         self.adb, default_timeout=10, default_retries=0)
@@ -156,6 +204,16 @@ class DeviceUtilsTest(mock_calls.TestCase):
     return mock.Mock(side_effect=device_errors.CommandFailedError(
         msg, str(self.device)))
 
+  def AllPropsCall(self, values):
+    """Returns the expected call and output reading all properties.
+
+    Args:
+      values: A dict with the names and values of the properties to report.
+    """
+    return (self.call.adb.Shell('getprop'),
+            ''.join('[%s]: [%s]\n' % (k, v)
+                    for k, v in sorted(values.iteritems())))
+
 
 class DeviceUtilsIsOnlineTest(DeviceUtilsTest):
 
@@ -227,6 +285,15 @@ class DeviceUtilsGetExternalStoragePathTest(DeviceUtilsTest):
       self.assertEquals('/fake/storage/path',
                         self.device.GetExternalStoragePath())
 
+  def testGetExternalStoragePath_sharedAcrossInstances(self):
+    with self.assertCall(
+        self.call.adb.Shell('echo $EXTERNAL_STORAGE'), '/fake/storage/path\n'):
+      self.assertEquals('/fake/storage/path',
+                        self.device.GetExternalStoragePath())
+      other_device = device_utils.DeviceUtils(self.adb)
+      self.assertEquals('/fake/storage/path',
+                        other_device.GetExternalStoragePath())
+
   def testGetExternalStoragePath_fails(self):
     with self.assertCall(self.call.adb.Shell('echo $EXTERNAL_STORAGE'), '\n'):
       with self.assertRaises(device_errors.CommandFailedError):
@@ -237,7 +304,7 @@ class DeviceUtilsGetApplicationPathTest(DeviceUtilsTest):
 
   def testGetApplicationPath_exists(self):
     with self.assertCalls(
-        (self.call.adb.Shell('getprop ro.build.version.sdk'), '19\n'),
+        self.AllPropsCall({'ro.build.version.sdk': '19'}),
         (self.call.adb.Shell('pm path android'),
          'package:/path/to/android.apk\n')):
       self.assertEquals('/path/to/android.apk',
@@ -245,31 +312,58 @@ class DeviceUtilsGetApplicationPathTest(DeviceUtilsTest):
 
   def testGetApplicationPath_notExists(self):
     with self.assertCalls(
-        (self.call.adb.Shell('getprop ro.build.version.sdk'), '19\n'),
+        self.AllPropsCall({'ro.build.version.sdk': '19'}),
         (self.call.adb.Shell('pm path not.installed.app'), '')):
       self.assertEquals(None,
                         self.device.GetApplicationPath('not.installed.app'))
 
+  def testGetApplicationPath_cached(self):
+    with self.assertCalls(
+        self.AllPropsCall({'ro.build.version.sdk': '19'}),
+        (self.call.adb.Shell('pm path android'),
+         'package:/path/to/android.apk\n')):
+      self.assertEquals('/path/to/android.apk',
+                        self.device.GetApplicationPath('android'))
+      self.assertEquals('/path/to/android.apk',
+                        self.device.GetApplicationPath('android'))
+
+  def testGetApplicationPath_noCache(self):
+    with self.assertCalls(
+        self.AllPropsCall({'ro.build.version.sdk': '19'}),
+        (self.call.adb.Shell('pm path android'), ''),
+        (self.call.adb.Shell('pm path android'),
+         'package:/path/to/android.apk\n')):
+      self.assertEquals(None, self.device.GetApplicationPath('android'))
+      self.assertEquals(
+          '/path/to/android.apk',
+          self.device.GetApplicationPath('android', use_cache=False))
+
   def testGetApplicationPath_fails(self):
     with self.assertCalls(
-        (self.call.adb.Shell('getprop ro.build.version.sdk'), '19\n'),
+        self.AllPropsCall({'ro.build.version.sdk': '19'}),
         (self.call.adb.Shell('pm path android'),
          self.CommandError('ERROR. Is package manager running?\n'))):
       with self.assertRaises(device_errors.CommandFailedError):
         self.device.GetApplicationPath('android')
 
 
+def _WaitForAllSequentially(conditions, wait_period=5):
+  # Keeps the order of the calls made by each condition deterministic.
+  return [timeout_retry.WaitFor(c, wait_period=wait_period)
+          for c in conditions]
+
+
 @mock.patch('time.sleep', mock.Mock())
+@mock.patch('pylib.utils.timeout_retry.WaitForAll', _WaitForAllSequentially)
 class DeviceUtilsWaitUntilFullyBootedTest(DeviceUtilsTest):
 
   def testWaitUntilFullyBooted_succeedsNoWifi(self):
     with self.assertCalls(
         self.call.adb.WaitForDevice(),
         # sd_card_ready
-        (self.call.device.GetExternalStoragePath(), '/fake/storage/path'),
-        (self.call.adb.Shell('test -d /fake/storage/path'), ''),
+        (self.call.adb.Shell('test -d "$EXTERNAL_STORAGE"'), ''),
         # pm_ready
-        (self.call.device.GetApplicationPath('android'),
+        (self.call.device.GetApplicationPath('android', use_cache=False),
          'package:/some/fake/path'),
         # boot_completed
         (self.call.device.GetProp('sys.boot_completed'), '1')):
@@ -279,10 +373,9 @@ class DeviceUtilsWaitUntilFullyBootedTest(DeviceUtilsTest):
     with self.assertCalls(
         self.call.adb.WaitForDevice(),
         # sd_card_ready
-        (self.call.device.GetExternalStoragePath(), '/fake/storage/path'),
-        (self.call.adb.Shell('test -d /fake/storage/path'), ''),
+        (self.call.adb.Shell('test -d "$EXTERNAL_STORAGE"'), ''),
         # pm_ready
-        (self.call.device.GetApplicationPath('android'),
+        (self.call.device.GetApplicationPath('android', use_cache=False),
          'package:/some/fake/path'),
         # boot_completed
         (self.call.device.GetProp('sys.boot_completed'), '1'),
@@ -291,26 +384,15 @@ class DeviceUtilsWaitUntilFullyBootedTest(DeviceUtilsTest):
          'stuff\nWi-Fi is enabled\nmore stuff\n')):
       self.device.WaitUntilFullyBooted(wifi=True)
 
-  def testWaitUntilFullyBooted_sdCardReadyFails_noPath(self):
-    with self.assertCalls(
-        self.call.adb.WaitForDevice(),
-        # sd_card_ready
-        (self.call.device.GetExternalStoragePath(), self.CommandError())):
-      with self.assertRaises(device_errors.CommandFailedError):
-        self.device.WaitUntilFullyBooted(wifi=False)
-
   def testWaitUntilFullyBooted_sdCardReadyFails_notExists(self):
     with self.assertCalls(
         self.call.adb.WaitForDevice(),
         # sd_card_ready
-        (self.call.device.GetExternalStoragePath(), '/fake/storage/path'),
-        (self.call.adb.Shell('test -d /fake/storage/path'), self.ShellError()),
+        (self.call.adb.Shell('test -d "$EXTERNAL_STORAGE"'), self.ShellError()),
         # sd_card_ready
-        (self.call.device.GetExternalStoragePath(), '/fake/storage/path'),
-        (self.call.adb.Shell('test -d /fake/storage/path'), self.ShellError()),
+        (self.call.adb.Shell('test -d "$EXTERNAL_STORAGE"'), self.ShellError()),
         # sd_card_ready
-        (self.call.device.GetExternalStoragePath(), '/fake/storage/path'),
-        (self.call.adb.Shell('test -d /fake/storage/path'),
+        (self.call.adb.Shell('test -d "$EXTERNAL_STORAGE"'),
          self.TimeoutError())):
       with self.assertRaises(device_errors.CommandTimeoutError):
         self.device.WaitUntilFullyBooted(wifi=False)
@@ -319,14 +401,16 @@ class DeviceUtilsWaitUntilFullyBootedTest(DeviceUtilsTest):
     with self.assertCalls(
         self.call.adb.WaitForDevice(),
         # sd_card_ready
-        (self.call.device.GetExternalStoragePath(), '/fake/storage/path'),
-        (self.call.adb.Shell('test -d /fake/storage/path'), ''),
+        (self.call.adb.Shell('test -d "$EXTERNAL_STORAGE"'), ''),
         # pm_ready
-        (self.call.device.GetApplicationPath('android'), self.CommandError()),
+        (self.call.device.GetApplicationPath('android', use_cache=False),
+         self.CommandError()),
         # pm_ready
-        (self.call.device.GetApplicationPath('android'), self.CommandError()),
+        (self.call.device.GetApplicationPath('android', use_cache=False),
+         self.CommandError()),
         # pm_ready
-        (self.call.device.GetApplicationPath('android'), self.TimeoutError())):
+        (self.call.device.GetApplicationPath('android', use_cache=False),
+         self.TimeoutError())):
       with self.assertRaises(device_errors.CommandTimeoutError):
         self.device.WaitUntilFullyBooted(wifi=False)
 
@@ -334,10 +418,9 @@ class DeviceUtilsWaitUntilFullyBootedTest(DeviceUtilsTest):
     with self.assertCalls(
         self.call.adb.WaitForDevice(),
         # sd_card_ready
-        (self.call.device.GetExternalStoragePath(), '/fake/storage/path'),
-        (self.call.adb.Shell('test -d /fake/storage/path'), ''),
+        (self.call.adb.Shell('test -d "$EXTERNAL_STORAGE"'), ''),
         # pm_ready
-        (self.call.device.GetApplicationPath('android'),
+        (self.call.device.GetApplicationPath('android', use_cache=False),
          'package:/some/fake/path'),
         # boot_completed
         (self.call.device.GetProp('sys.boot_completed'), '0'),
@@ -352,10 +435,9 @@ class DeviceUtilsWaitUntilFullyBootedTest(DeviceUtilsTest):
     with self.assertCalls(
         self.call.adb.WaitForDevice(),
         # sd_card_ready
-        (self.call.device.GetExternalStoragePath(), '/fake/storage/path'),
-        (self.call.adb.Shell('test -d /fake/storage/path'), ''),
+        (self.call.adb.Shell('test -d "$EXTERNAL_STORAGE"'), ''),
         # pm_ready
-        (self.call.device.GetApplicationPath('android'),
+        (self.call.device.GetApplicationPath('android', use_cache=False),
          'package:/some/fake/path'),
         # boot_completed
         (self.call.device.GetProp('sys.boot_completed'), '1'),
@@ -398,11 +480,21 @@ class DeviceUtilsRebootTest(DeviceUtilsTest):
 
 class DeviceUtilsInstallTest(DeviceUtilsTest):
 
+  def setUp(self):
+    super(DeviceUtilsInstallTest, self).setUp()
+    patcher = mock.patch('pylib.utils.md5sum.CalculateHostMd5Sums',
+                         return_value=[md5sum.HashAndPath(
+                             '0123456789abcdeffedcba9876543210',
+                             '/fake/test/app.apk')])
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
   def testInstall_noPriorInstall(self):
     with self.assertCalls(
         (mock.call.pylib.utils.apk_helper.GetPackageName('/fake/test/app.apk'),
          'this.is.a.test.package'),
-        (self.call.device.GetApplicationPath('this.is.a.test.package'), None),
+        (self.call.device._InstallProbe('this.is.a.test.package'),
+         (None, None)),
         self.call.adb.Install('/fake/test/app.apk', reinstall=False)):
       self.device.Install('/fake/test/app.apk', retries=0)
 
@@ -410,11 +502,9 @@ class DeviceUtilsInstallTest(DeviceUtilsTest):
     with self.assertCalls(
         (mock.call.pylib.utils.apk_helper.GetPackageName('/fake/test/app.apk'),
          'this.is.a.test.package'),
-        (self.call.device.GetApplicationPath('this.is.a.test.package'),
-         '/fake/data/app/this.is.a.test.package.apk'),
-        (self.call.device._GetChangedFilesImpl(
-            '/fake/test/app.apk', '/fake/data/app/this.is.a.test.package.apk'),
-         [('/fake/test/app.apk', '/fake/data/app/this.is.a.test.package.apk')]),
+        (self.call.device._InstallProbe('this.is.a.test.package'),
+         ('/fake/data/app/this.is.a.test.package.apk',
+          'ffffffffffffffffffffffffffffffff')),
         self.call.adb.Uninstall('this.is.a.test.package'),
         self.call.adb.Install('/fake/test/app.apk', reinstall=False)):
       self.device.Install('/fake/test/app.apk', retries=0)
@@ -423,11 +513,9 @@ class DeviceUtilsInstallTest(DeviceUtilsTest):
     with self.assertCalls(
         (mock.call.pylib.utils.apk_helper.GetPackageName('/fake/test/app.apk'),
          'this.is.a.test.package'),
-        (self.call.device.GetApplicationPath('this.is.a.test.package'),
-         '/fake/data/app/this.is.a.test.package.apk'),
-        (self.call.device._GetChangedFilesImpl(
-            '/fake/test/app.apk', '/fake/data/app/this.is.a.test.package.apk'),
-         [('/fake/test/app.apk', '/fake/data/app/this.is.a.test.package.apk')]),
+        (self.call.device._InstallProbe('this.is.a.test.package'),
+         ('/fake/data/app/this.is.a.test.package.apk',
+          'ffffffffffffffffffffffffffffffff')),
         self.call.adb.Install('/fake/test/app.apk', reinstall=True)):
       self.device.Install('/fake/test/app.apk', reinstall=True, retries=0)
 
@@ -435,8 +523,32 @@ class DeviceUtilsInstallTest(DeviceUtilsTest):
     with self.assertCalls(
         (mock.call.pylib.utils.apk_helper.GetPackageName('/fake/test/app.apk'),
          'this.is.a.test.package'),
-        (self.call.device.GetApplicationPath('this.is.a.test.package'),
-         '/fake/data/app/this.is.a.test.package.apk'),
+        (self.call.device._InstallProbe('this.is.a.test.package'),
+         ('/fake/data/app/this.is.a.test.package.apk',
+          '0123456789abcdeffedcba9876543210'))):
+      self.device.Install('/fake/test/app.apk', retries=0)
+
+  def testInstall_noPriorInstall_joinsHostMd5Thread(self):
+    with mock.patch.object(
+        reraiser_thread.ReraiserThread, 'join', autospec=True,
+        side_effect=reraiser_thread.ReraiserThread.join) as join:
+      with self.assertCalls(
+          (mock.call.pylib.utils.apk_helper.GetPackageName(
+              '/fake/test/app.apk'),
+           'this.is.a.test.package'),
+          (self.call.device._InstallProbe('this.is.a.test.package'),
+           (None, None)),
+          self.call.adb.Install('/fake/test/app.apk', reinstall=False)):
+        self.device.Install('/fake/test/app.apk', retries=0)
+      self.assertIn('host-md5-this.is.a.test.package',
+                    [c[0][0].name for c in join.call_args_list])
+
+  def testInstall_noDeviceMd5(self):
+    with self.assertCalls(
+        (mock.call.pylib.utils.apk_helper.GetPackageName('/fake/test/app.apk'),
+         'this.is.a.test.package'),
+        (self.call.device._InstallProbe('this.is.a.test.package'),
+         ('/fake/data/app/this.is.a.test.package.apk', None)),
         (self.call.device._GetChangedFilesImpl(
             '/fake/test/app.apk', '/fake/data/app/this.is.a.test.package.apk'),
          [])):
@@ -446,13 +558,64 @@ class DeviceUtilsInstallTest(DeviceUtilsTest):
     with self.assertCalls(
         (mock.call.pylib.utils.apk_helper.GetPackageName('/fake/test/app.apk'),
          'this.is.a.test.package'),
-        (self.call.device.GetApplicationPath('this.is.a.test.package'), None),
+        (self.call.device._InstallProbe('this.is.a.test.package'),
+         (None, None)),
         (self.call.adb.Install('/fake/test/app.apk', reinstall=False),
          self.CommandError('Failure\r\n'))):
       with self.assertRaises(device_errors.CommandFailedError):
         self.device.Install('/fake/test/app.apk', retries=0)
 
 
+class DeviceUtilsInstallProbeTest(DeviceUtilsTest):
+
+  _SCRIPT = (
+      'p=$(pm path this.is.a.test.package); echo "$p"; '
+      'echo INSTALL_PROBE_SEPARATOR; p=${p#package:}; '
+      'test -f /data/local/tmp/md5sum/md5sum_bin && '
+      'test -f "$p" -o -d "$p" && '
+      'LD_LIBRARY_PATH=/data/local/tmp/md5sum/  '
+      '/data/local/tmp/md5sum/md5sum_bin "$p"')
+
+  def testInstallProbe_notInstalled(self):
+    with self.assertCalls(
+        (self.call.device.GetDevicePieWrapper(), ''),
+        (self.call.adb.Shell(self._SCRIPT), '\nINSTALL_PROBE_SEPARATOR\n')):
+      self.assertEquals((None, None),
+                        self.device._InstallProbe('this.is.a.test.package'))
+
+  def testInstallProbe_installed(self):
+    with self.assertCalls(
+        (self.call.device.GetDevicePieWrapper(), ''),
+        (self.call.adb.Shell(self._SCRIPT),
+         'package:/data/app/this.is.a.test.package.apk\n'
+         'INSTALL_PROBE_SEPARATOR\n'
+         '0123456789abcdeffedcba9876543210 '
+         '/data/app/this.is.a.test.package.apk\n')):
+      self.assertEquals(
+          ('/data/app/this.is.a.test.package.apk',
+           '0123456789abcdeffedcba9876543210'),
+          self.device._InstallProbe('this.is.a.test.package'))
+
+  def testInstallProbe_noMd5sumBin(self):
+    with self.assertCalls(
+        (self.call.device.GetDevicePieWrapper(), ''),
+        (self.call.adb.Shell(self._SCRIPT),
+         'package:/data/app/this.is.a.test.package.apk\n'
+         'INSTALL_PROBE_SEPARATOR\n')):
+      self.assertEquals(
+          ('/data/app/this.is.a.test.package.apk', None),
+          self.device._InstallProbe('this.is.a.test.package'))
+
+  def testInstallProbe_fails(self):
+    with self.assertCalls(
+        (self.call.device.GetDevicePieWrapper(), ''),
+        (self.call.adb.Shell(self._SCRIPT),
+         'Error: could not access the Package Manager\n'
+         'INSTALL_PROBE_SEPARATOR\n')):
+      with self.assertRaises(device_errors.CommandFailedError):
+        self.device._InstallProbe('this.is.a.test.package')
+
+
 class DeviceUtilsRunShellCommandTest(DeviceUtilsTest):
 
   def setUp(self):
@@ -485,6 +648,20 @@ class DeviceUtilsRunShellCommandTest(DeviceUtilsTest):
     with self.assertRaises(KeyError):
       self.device.RunShellCommand('some_cmd', env={'INVALID NAME': 'value'})
 
+  def testNewRunShellImpl_withCwdAndEnv(self):
+    with self.assertCall(
+        self.call.adb.Shell('cd /some/test/path && VAR=some_string ls'), ''):
+      self.device.RunShellCommand('ls', cwd='/some/test/path',
+                                  env={'VAR': 'some_string'})
+
+  def testNewRunShellImpl_withEnv_leadingDigit(self):
+    with self.assertRaises(KeyError):
+      self.device.RunShellCommand('some_cmd', env={'1VAR': 'value'})
+
+  def testNewRunShellImpl_withEnv_empty(self):
+    with self.assertRaises(KeyError):
+      self.device.RunShellCommand('some_cmd', env={'': 'value'})
+
   def testNewRunShellImpl_withCwd(self):
     with self.assertCall(self.call.adb.Shell('cd /some/test/path && ls'), ''):
       self.device.RunShellCommand('ls', cwd='/some/test/path')
@@ -507,13 +684,14 @@ class DeviceUtilsRunShellCommandTest(DeviceUtilsTest):
 
   def testRunShellCommand_withHugeCmdAmdSU(self):
     payload = 'hi! ' * 1024
-    expected_cmd = """su -c sh -c 'echo '"'"'%s'"'"''""" % payload
+    expected_cmd = "echo '%s'" % payload
     with self.assertCalls(
-      (self.call.device.NeedsSU(), True),
       (mock.call.pylib.utils.device_temp_file.DeviceTempFile(
           self.adb, suffix='.sh'), MockTempFile('/sdcard/temp-123.sh')),
       self.call.device._WriteFileWithPush('/sdcard/temp-123.sh', expected_cmd),
-      (self.call.adb.Shell('sh /sdcard/temp-123.sh'), payload + '\n')):
+      (self.call.device.NeedsSU(), True),
+      (self.call.adb.Shell("su -c sh -c 'sh /sdcard/temp-123.sh'"),
+       payload + '\n')):
       self.assertEquals(
           [payload],
           self.device.RunShellCommand(['echo', payload], as_root=True))
@@ -554,6 +732,18 @@ class DeviceUtilsRunShellCommandTest(DeviceUtilsTest):
       self.assertEquals('',
                         self.device.RunShellCommand(cmd, single_line=True))
 
+  def testRunShellCommand_singleLine_successCarriageReturn(self):
+    cmd = 'echo $VALUE'
+    with self.assertCall(self.call.adb.Shell(cmd), 'some value\r\n'):
+      self.assertEquals('some value',
+                        self.device.RunShellCommand(cmd, single_line=True))
+
+  def testRunShellCommand_singleLine_failTrailingEmptyLine(self):
+    cmd = 'echo $VALUE'
+    with self.assertCall(self.call.adb.Shell(cmd), 'some value\n\n'):
+      with self.assertRaises(device_errors.CommandFailedError):
+        self.device.RunShellCommand(cmd, single_line=True)
+
   def testRunShellCommand_singleLine_failTooManyLines(self):
     cmd = 'echo $VALUE'
     with self.assertCall(self.call.adb.Shell(cmd),
@@ -583,6 +773,128 @@ class DeviceUtilsRunShellCommandTest(DeviceUtilsTest):
                         self.device.RunShellCommand(cmd, check_return=False))
 
 
+class DeviceUtilsPersistentShellTest(DeviceUtilsTest):
+
+  def setUp(self):
+    super(DeviceUtilsPersistentShellTest, self).setUp()
+    self.device.NeedsSU = mock.Mock(return_value=False)
+    self.device._persistent_shell = mock.Mock(
+        spec=device_utils._PersistentShell)
+
+  def testRunShellCommand_persistentShell(self):
+    with self.assertCall(
+        self.call.device._persistent_shell.Run('echo $VALUE', mock.ANY),
+        (0, 'some value\n')):
+      self.assertEquals(['some value'],
+                        self.device.RunShellCommand('echo $VALUE'))
+
+  def testRunShellCommand_persistentShellFailure(self):
+    with self.assertCall(
+        self.call.device._persistent_shell.Run('ls /root', mock.ANY),
+        (1, 'opendir failed, Permission denied\n')):
+      with self.assertRaises(device_errors.AdbCommandFailedError):
+        self.device.RunShellCommand('ls /root', check_return=True)
+
+  def testRunShellCommand_persistentShellUnavailable(self):
+    with self.assertCalls(
+        (self.call.device._persistent_shell.Run('echo $VALUE', mock.ANY),
+         None),
+        (self.call.adb.Shell('echo $VALUE'), 'some value\n')):
+      self.assertEquals(['some value'],
+                        self.device.RunShellCommand('echo $VALUE'))
+
+  def testRunShellCommand_persistentShellHugeCmd(self):
+    payload = 'hi! ' * 1024
+    expected_cmd = "echo '%s'" % payload
+    with self.assertCalls(
+        (mock.call.pylib.utils.device_temp_file.DeviceTempFile(
+            self.adb, suffix='.sh'), MockTempFile('/sdcard/temp-123.sh')),
+        self.call.device._WriteFileWithPush(
+            '/sdcard/temp-123.sh', expected_cmd),
+        (self.call.device._persistent_shell.Run(
+            'sh /sdcard/temp-123.sh', mock.ANY), (0, payload + '\n'))):
+      self.assertEquals([payload],
+                        self.device.RunShellCommand(['echo', payload]))
+
+  def testRunShellCommand_persistentShellTimeout(self):
+    with self.assertCall(
+        self.call.device._persistent_shell.Run('rm /data/file', mock.ANY),
+        self.TimeoutError()):
+      with self.assertRaises(device_errors.CommandTimeoutError):
+        self.device.RunShellCommand(['rm', '/data/file'])
+
+  def testClose(self):
+    self.device.Close()
+    self.device._persistent_shell.Close.assert_called_once_with()
+
+
+class PersistentShellTest(unittest.TestCase):
+
+  def setUp(self):
+    self.shell = device_utils._PersistentShell(['sh'])
+
+  def tearDown(self):
+    self.shell.Close()
+
+  def testRun_output(self):
+    self.assertEquals((0, 'hello\nworld\n'),
+                      self.shell.Run('echo hello; echo world'))
+
+  def testRun_outputWithoutEndLine(self):
+    self.assertEquals((0, 'hello\n'), self.shell.Run('printf hello'))
+
+  def testRun_status(self):
+    self.assertEquals((3, ''), self.shell.Run('exit 3'))
+
+  def testRun_reusesProcess(self):
+    self.shell.Run('true')
+    self.assertTrue(self.shell.IsAlive())
+    self.assertEquals((0, 'again\n'), self.shell.Run('echo again'))
+
+  def testRun_timeout(self):
+    with self.assertRaises(device_errors.CommandTimeoutError):
+      self.shell.Run('sleep 10', timeout=0.1)
+    self.assertFalse(self.shell.IsAlive())
+
+  def testRun_shellExits(self):
+    # $$ is the pid of the persistent shell, even within the subshell.
+    with self.assertRaises(device_errors.CommandFailedError):
+      self.shell.Run('kill -9 $$', timeout=5)
+    self.assertFalse(self.shell.IsAlive())
+    self.assertEquals((0, 'restarted\n'),
+                      self.shell.Run('echo restarted', timeout=5))
+
+  def testRun_busy(self):
+    self.shell._lock.acquire()
+    try:
+      self.assertEquals(None, self.shell.Run('echo busy'))
+    finally:
+      self.shell._lock.release()
+
+  def testRun_stderr(self):
+    self.shell.Close()
+    # The stderr of the shell itself is discarded, as if it were delivered on
+    # a separate stream.
+    self.shell = device_utils._PersistentShell(
+        ['sh', '-c', 'exec sh 2>/dev/null'])
+    self.assertEquals((1, 'out\nerr\n'),
+                      self.shell.Run('echo out; echo err >&2; false',
+                                     timeout=5))
+    self.assertEquals((0, 'next\n'), self.shell.Run('echo next', timeout=5))
+
+  def testRun_commandReadingStdin(self):
+    self.assertEquals((0, ''), self.shell.Run('cat', timeout=5))
+    self.assertEquals((0, 'next\n'), self.shell.Run('echo next', timeout=5))
+
+  def testRun_echoedInput(self):
+    self.shell.Close()
+    # tee copies the input to the output, as a terminal echoing it would.
+    self.shell = device_utils._PersistentShell(
+        ['sh', '-c', 'tee /dev/stderr | sh'])
+    self.assertEquals((0, 'hello\n'), self.shell.Run('echo hello', timeout=5))
+    self.assertEquals((0, 'world\n'), self.shell.Run('echo world', timeout=5))
+
+
 class DeviceUtilsGetDevicePieWrapper(DeviceUtilsTest):
 
   def testGetDevicePieWrapper_jb(self):
@@ -604,54 +916,80 @@ class DeviceUtilsGetDevicePieWrapper(DeviceUtilsTest):
 @mock.patch('time.sleep', mock.Mock())
 class DeviceUtilsKillAllTest(DeviceUtilsTest):
 
+  @staticmethod
+  def _KillScript(process_name, signum=9, blocking=False):
+    find_pids = ('ps | { read -r _; while read -r _ pid rest; do '
+                 'test "$pid" = $$ || '
+                 'case "${rest##* }" in *%s*) echo $pid;; esac; done; }'
+                 % process_name)
+    script = 'pids=$(%s); echo $pids; test -z "$pids" || kill -%d $pids' % (
+        find_pids, signum)
+    if blocking:
+      script += (' && while test -n "$(%s)"; do '
+                 'sleep 0.1 2>/dev/null || sleep 1; done' % find_pids)
+    return script
+
   def testKillAll_noMatchingProcesses(self):
-    with self.assertCall(self.call.adb.Shell('ps'),
-        'USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME\n'):
+    with self.assertCall(
+        self.call.adb.Shell(self._KillScript('test_process')), '\n'):
       with self.assertRaises(device_errors.CommandFailedError):
         self.device.KillAll('test_process')
 
   def testKillAll_nonblocking(self):
-    with self.assertCalls(
-        (self.call.adb.Shell('ps'),
-         'USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME\n'
-         'u0_a1  1234  174   123456 54321 ffffffff 456789ab some.process\n'),
-        (self.call.adb.Shell('kill -9 1234'), '')):
+    with self.assertCall(
+        self.call.adb.Shell(self._KillScript('some.process')), '1234\n'):
       self.assertEquals(1,
           self.device.KillAll('some.process', blocking=False))
 
   def testKillAll_blocking(self):
-    with self.assertCalls(
-        (self.call.adb.Shell('ps'),
-         'USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME\n'
-         'u0_a1  1234  174   123456 54321 ffffffff 456789ab some.process\n'),
-        (self.call.adb.Shell('kill -9 1234'), ''),
-        (self.call.adb.Shell('ps'),
-         'USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME\n'
-         'u0_a1  1234  174   123456 54321 ffffffff 456789ab some.process\n'),
-        (self.call.adb.Shell('ps'),
-         'USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME\n')):
+    with self.assertCall(
+        self.call.adb.Shell(self._KillScript('some.process', blocking=True)),
+        '1234\n'):
       self.assertEquals(1,
           self.device.KillAll('some.process', blocking=True))
 
+  def testKillAll_multipleProcesses(self):
+    with self.assertCall(
+        self.call.adb.Shell(self._KillScript('some.process')), '1234 5678\n'):
+      self.assertEquals(2, self.device.KillAll('some.process'))
+
   def testKillAll_root(self):
     with self.assertCalls(
-        (self.call.adb.Shell('ps'),
-         'USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME\n'
-         'u0_a1  1234  174   123456 54321 ffffffff 456789ab some.process\n'),
         (self.call.device.NeedsSU(), True),
-        (self.call.adb.Shell("su -c sh -c 'kill -9 1234'"), '')):
+        (self.call.adb.Shell(
+            'su -c sh -c %s' % cmd_helper.SingleQuote(
+                self._KillScript('some.process'))),
+         '1234\n')):
       self.assertEquals(1,
           self.device.KillAll('some.process', as_root=True))
 
   def testKillAll_sigterm(self):
-    with self.assertCalls(
-        (self.call.adb.Shell('ps'),
-         'USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME\n'
-         'u0_a1  1234  174   123456 54321 ffffffff 456789ab some.process\n'),
-        (self.call.adb.Shell('kill -15 1234'), '')):
+    with self.assertCall(
+        self.call.adb.Shell(
+            self._KillScript('some.process', signum=signal.SIGTERM)),
+        '1234\n'):
       self.assertEquals(1,
           self.device.KillAll('some.process', signum=signal.SIGTERM))
 
+  def testKillAll_killFails(self):
+    with self.assertCall(
+        self.call.adb.Shell(self._KillScript('some.process')),
+        self.ShellError('1234\nkill: Operation not permitted\n')):
+      with self.assertRaises(device_errors.AdbCommandFailedError):
+        self.device.KillAll('some.process')
+
+  def testKillAll_findPidsSkipsHeaderAndOwnShell(self):
+    # Runs the script on the host, against the output of a fake ps.
+    fake_ps = (
+        'ps() { echo "USER PID PPID VSIZE RSS WCHAN PC NAME"; '
+        'echo "root $$ 1 0 0 0 0 S sh"; '
+        'echo "u0_a1 1234 1 0 0 0 0 S some.shell.NAME"; }; ')
+    for process_name in ('sh', 'NAME'):
+      status, output = cmd_helper.GetCmdStatusAndOutput(
+          ['sh', '-c', fake_ps + device_utils._FIND_PIDS_SCRIPT % process_name])
+      self.assertEquals(0, status)
+      self.assertEquals(['1234'], output.split())
+
 
 class DeviceUtilsStartActivityTest(DeviceUtilsTest):
 
@@ -908,35 +1246,50 @@ class DeviceUtilsForceStopTest(DeviceUtilsTest):
 
 class DeviceUtilsClearApplicationStateTest(DeviceUtilsTest):
 
-  def testClearApplicationState_packageDoesntExist(self):
+  def testClearApplicationState_belowAndroidJBMR2(self):
     with self.assertCalls(
-        (self.call.adb.Shell('getprop ro.build.version.sdk'), '17\n'),
-        (self.call.device.GetApplicationPath('this.package.does.not.exist'),
-         None)):
-      self.device.ClearApplicationState('this.package.does.not.exist')
+        self.AllPropsCall({'ro.build.version.sdk': '17'}),
+        (self.call.adb.Shell(
+            'case "$(pm path this.package.exists)" in '
+            'package:*) pm clear this.package.exists;; esac'),
+         'Success\r\n')):
+      self.device.ClearApplicationState('this.package.exists')
 
   def testClearApplicationState_packageDoesntExistOnAndroidJBMR2OrAbove(self):
     with self.assertCalls(
-        (self.call.adb.Shell('getprop ro.build.version.sdk'), '18\n'),
+        self.AllPropsCall({'ro.build.version.sdk': '18'}),
         (self.call.adb.Shell('pm clear this.package.does.not.exist'),
          'Failed\r\n')):
       self.device.ClearApplicationState('this.package.does.not.exist')
 
-  def testClearApplicationState_packageExists(self):
+  def testClearApplicationState_packageExistsOnAndroidJBMR2OrAbove(self):
     with self.assertCalls(
-        (self.call.adb.Shell('getprop ro.build.version.sdk'), '17\n'),
-        (self.call.device.GetApplicationPath('this.package.exists'),
-         '/data/app/this.package.exists.apk'),
+        self.AllPropsCall({'ro.build.version.sdk': '18'}),
         (self.call.adb.Shell('pm clear this.package.exists'),
          'Success\r\n')):
       self.device.ClearApplicationState('this.package.exists')
 
-  def testClearApplicationState_packageExistsOnAndroidJBMR2OrAbove(self):
+
+class DeviceUtilsResetAppStateTest(DeviceUtilsTest):
+
+  def testResetAppState_belowAndroidJBMR2(self):
     with self.assertCalls(
-        (self.call.adb.Shell('getprop ro.build.version.sdk'), '18\n'),
-        (self.call.adb.Shell('pm clear this.package.exists'),
+        self.AllPropsCall({'ro.build.version.sdk': '17'}),
+        (self.call.adb.Shell(
+            'am force-stop this.package.exists && '
+            'case "$(pm path this.package.exists)" in '
+            'package:*) pm clear this.package.exists;; esac'),
          'Success\r\n')):
-      self.device.ClearApplicationState('this.package.exists')
+      self.device.ResetAppState('this.package.exists')
+
+  def testResetAppState_androidJBMR2OrAbove(self):
+    with self.assertCalls(
+        self.AllPropsCall({'ro.build.version.sdk': '18'}),
+        (self.call.adb.Shell(
+            'am force-stop this.package.exists && '
+            'pm clear this.package.exists'),
+         'Success\r\n')):
+      self.device.ResetAppState('this.package.exists')
 
 
 class DeviceUtilsSendKeyEventTest(DeviceUtilsTest):
@@ -946,6 +1299,163 @@ class DeviceUtilsSendKeyEventTest(DeviceUtilsTest):
       self.device.SendKeyEvent(66)
 
 
+class DeviceUtilsGetChangedFilesTest(DeviceUtilsTest):
+
+  def testGetChangedFiles_missingOnDevice(self):
+    with self.assertCall(
+        self.call.device.RunShellCommand(
+            'echo "$(realpath /test/device/file 2>/dev/null)"',
+            check_return=True),
+        ['']):
+      self.assertEquals(
+          [('/test/host/file', '/test/device/file')],
+          self.device._GetChangedFiles(
+              [('/test/host/file', '/test/device/file')]))
+
+  @mock.patch('os.path.realpath', mock.Mock(side_effect=lambda p: p))
+  @mock.patch('os.path.isfile',
+              mock.Mock(side_effect=lambda p: p == '/test/host/file'))
+  def testGetChangedFiles_batched(self):
+    with self.assertCalls(
+        (self.call.device.RunShellCommand(
+            'echo "$(realpath /test/device/file 2>/dev/null)"; '
+            'echo "$(realpath /test/device/dir 2>/dev/null)"',
+            check_return=True),
+         ['/test/device/file', '/real/device/dir']),
+        (mock.call.pylib.utils.md5sum.CalculateHostMd5Sums(
+            ['/test/host/file', '/test/host/dir']),
+         [md5sum.HashAndPath('0123', '/test/host/file'),
+          md5sum.HashAndPath('4567', '/test/host/dir/same'),
+          md5sum.HashAndPath('89ab', '/test/host/dir/changed')]),
+        (mock.call.pylib.utils.md5sum.CalculateDeviceMd5Sums(
+            ['/test/device/file', '/real/device/dir/same',
+             '/real/device/dir/changed'], self.device),
+         [md5sum.HashAndPath('0123', '/test/device/file'),
+          md5sum.HashAndPath('4567', '/real/device/dir/same'),
+          md5sum.HashAndPath('cdef', '/real/device/dir/changed')])):
+      self.assertEquals(
+          [('/test/host/dir/changed', '/real/device/dir/changed')],
+          self.device._GetChangedFiles(
+              [('/test/host/file', '/test/device/file'),
+               ('/test/host/dir', '/test/device/dir')], strict=True))
+
+  @mock.patch('os.path.realpath', mock.Mock(side_effect=lambda p: p))
+  @mock.patch('os.path.isfile',
+              mock.Mock(side_effect=lambda p: p != '/test/host/dir'))
+  @mock.patch('os.walk', mock.Mock(return_value=[
+      ('/test/host/dir', [], ['same', 'resized', 'touched', 'new'])]))
+  @mock.patch('os.stat', mock.Mock(side_effect=lambda p: mock.Mock(
+      st_size=10, st_mtime=1000.5)))
+  def testGetChangedFiles_stat(self):
+    with self.assertCalls(
+        (self.call.device.RunShellCommand(
+            'echo "$(realpath /test/device/file 2>/dev/null)"; '
+            'echo "$(realpath /test/device/dir 2>/dev/null)"',
+            check_return=True),
+         ['/test/device/file', '/real/device/dir']),
+        (self.call.device._StatDeviceFiles(
+            ['/test/device/file', '/real/device/dir']),
+         {'/test/device/file': (10, 1000),
+          '/real/device/dir/same': (10, 1000),
+          '/real/device/dir/resized': (12, 1000),
+          '/real/device/dir/touched': (10, 2000)}),
+        (mock.call.pylib.utils.md5sum.CalculateHostMd5Sums(
+            ['/test/host/dir/touched']),
+         [md5sum.HashAndPath('0123', '/test/host/dir/touched')]),
+        (mock.call.pylib.utils.md5sum.CalculateDeviceMd5Sums(
+            ['/real/device/dir/touched'], self.device),
+         [md5sum.HashAndPath('0123', '/real/device/dir/touched')])):
+      self.assertEquals(
+          [('/test/host/dir/resized', '/real/device/dir/resized'),
+           ('/test/host/dir/new', '/real/device/dir/new')],
+          self.device._GetChangedFiles(
+              [('/test/host/file', '/test/device/file'),
+               ('/test/host/dir', '/test/device/dir')]))
+
+  @mock.patch('os.path.realpath', mock.Mock(side_effect=lambda p: p))
+  @mock.patch('os.path.isfile', mock.Mock(return_value=True))
+  def testGetChangedFiles_statNotAvailable(self):
+    with self.assertCalls(
+        (self.call.device.RunShellCommand(
+            'echo "$(realpath /test/device/file 2>/dev/null)"',
+            check_return=True),
+         ['/test/device/file']),
+        (self.call.device._StatDeviceFiles(['/test/device/file']), {}),
+        (mock.call.pylib.utils.md5sum.CalculateHostMd5Sums(
+            ['/test/host/file']),
+         [md5sum.HashAndPath('0123', '/test/host/file')]),
+        (mock.call.pylib.utils.md5sum.CalculateDeviceMd5Sums(
+            ['/test/device/file'], self.device),
+         [md5sum.HashAndPath('4567', '/test/device/file')])):
+      self.assertEquals(
+          [('/test/host/file', '/test/device/file')],
+          self.device._GetChangedFiles(
+              [('/test/host/file', '/test/device/file')]))
+
+
+class DeviceUtilsStatDeviceFilesTest(DeviceUtilsTest):
+
+  def testStatDeviceFiles(self):
+    with self.assertCall(
+        self.call.adb.Shell(
+            "find /test/device/dir -type f "
+            "-exec stat -c '%s %Y %n' {} + 2>/dev/null"),
+        '10 1000 /test/device/dir/file\n'
+        '12 2000 /test/device/dir/with space\n'):
+      self.assertEquals(
+          {'/test/device/dir/file': (10, 1000),
+           '/test/device/dir/with space': (12, 2000)},
+          self.device._StatDeviceFiles(['/test/device/dir']))
+
+  def testStatDeviceFiles_notAvailable(self):
+    with self.assertCall(
+        self.call.adb.Shell(
+            "find /test/device/dir -type f "
+            "-exec stat -c '%s %Y %n' {} + 2>/dev/null"),
+        'find: -exec: unknown option\n'):
+      self.assertEquals({}, self.device._StatDeviceFiles(['/test/device/dir']))
+
+
+class DeviceUtilsEstimateCompressionRatioTest(DeviceUtilsTest):
+
+  def setUp(self):
+    super(DeviceUtilsEstimateCompressionRatioTest, self).setUp()
+    self.host_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.host_dir)
+
+  def _MakeHostFile(self, name, contents):
+    path = os.path.join(self.host_dir, name)
+    with open(path, 'wb') as f:
+      f.write(contents)
+    return (path, '/test/device/' + name)
+
+  def testEstimateCompressionRatio_compressible(self):
+    files = [self._MakeHostFile('text', 'compressible contents\n' * 1000)]
+    self.assertGreater(
+        self.device._EstimateCompressionRatio(files),
+        device_utils._PUSH_MIN_COMPRESSION_RATIO)
+
+  def testEstimateCompressionRatio_alreadyCompressed(self):
+    files = [self._MakeHostFile('data', zlib.compress(os.urandom(100000)))]
+    self.assertLess(
+        self.device._EstimateCompressionRatio(files),
+        device_utils._PUSH_MIN_COMPRESSION_RATIO)
+
+  def testEstimateCompressionRatio_directory(self):
+    self._MakeHostFile('text', 'compressible contents\n' * 1000)
+    self.assertGreater(
+        self.device._EstimateCompressionRatio(
+            [(self.host_dir, '/test/device')]),
+        device_utils._PUSH_MIN_COMPRESSION_RATIO)
+
+  def testEstimateCompressionRatio_empty(self):
+    self.assertEqual(
+        device_utils._PUSH_COMPRESSION_RATIO,
+        self.device._EstimateCompressionRatio([]))
+
+
 class DeviceUtilsPushChangedFilesIndividuallyTest(DeviceUtilsTest):
 
   def testPushChangedFilesIndividually_empty(self):
@@ -962,10 +1472,37 @@ class DeviceUtilsPushChangedFilesIndividuallyTest(DeviceUtilsTest):
     test_files = [
         ('/test/host/path/file1', '/test/device/path/file1'),
         ('/test/host/path/file2', '/test/device/path/file2')]
-    with self.assertCalls(
-        self.call.adb.Push(*test_files[0]),
-        self.call.adb.Push(*test_files[1])):
+    with mock.patch.object(self.device, '_MAX_PARALLEL_PUSHES', 1):
+      with self.assertCalls(
+          self.call.adb.Push(*test_files[0]),
+          self.call.adb.Push(*test_files[1])):
+        self.device._PushChangedFilesIndividually(test_files)
+
+  def testPushChangedFilesIndividually_parallel(self):
+    test_files = [
+        ('/test/host/path/file%d' % i, '/test/device/path/file%d' % i)
+        for i in xrange(10)]
+    pushed = []
+    def push(host_path, device_path):
+      pushed.append((host_path, device_path))
+    with mock.patch.object(self.adb, 'Push', side_effect=push):
+      self.device._PushChangedFilesIndividually(test_files)
+    self.assertEquals(sorted(test_files), sorted(pushed))
+
+  def testPushChangedFilesIndividually_parallelFailure(self):
+    test_files = [
+        ('/test/host/path/file1', '/test/device/path/file1'),
+        ('/test/host/path/file2', '/test/device/path/file2')]
+    pushed = []
+    def push(host_path, device_path):
+      if not pushed:
+        pushed.append(None)
+        raise device_errors.AdbCommandFailedError(
+            ['push', host_path, device_path], 'failed')
+      pushed.append((host_path, device_path))
+    with mock.patch.object(self.adb, 'Push', side_effect=push):
       self.device._PushChangedFilesIndividually(test_files)
+    self.assertEquals(test_files, pushed[-2:])
 
 
 class DeviceUtilsPushChangedFilesZippedTest(DeviceUtilsTest):
@@ -980,9 +1517,8 @@ class DeviceUtilsPushChangedFilesZippedTest(DeviceUtilsTest):
     mock_zip_temp.return_value.name = '/test/temp/file/tmp.zip'
     with self.assertCalls(
         (mock.call.tempfile.NamedTemporaryFile(suffix='.zip'), mock_zip_temp),
-        (mock.call.multiprocessing.Process(
-            target=device_utils.DeviceUtils._CreateDeviceZip,
-            args=('/test/temp/file/tmp.zip', test_files)), mock.Mock()),
+        self.call.device._CreateDeviceZip(
+            '/test/temp/file/tmp.zip', test_files),
         (self.call.device.GetExternalStoragePath(),
          '/test/device/external_dir'),
         self.call.adb.Push(
@@ -1006,6 +1542,82 @@ class DeviceUtilsPushChangedFilesZippedTest(DeviceUtilsTest):
         [('/test/host/path/file1', '/test/device/path/file1'),
          ('/test/host/path/file2', '/test/device/path/file2')])
 
+  @mock.patch('multiprocessing.cpu_count', mock.Mock(return_value=2))
+  @mock.patch(
+      'pylib.device.device_utils.DeviceUtils._MIN_FILES_PER_ZIP_SHARD', 1)
+  def testPushChangedFilesZipped_sharded(self):
+    test_files = [
+        ('/test/host/path/file1', '/test/device/path/file1'),
+        ('/test/host/path/file2', '/test/device/path/file2'),
+        ('/test/host/path/file3', '/test/device/path/file3')]
+    mock_zip_temps = [mock.mock_open(), mock.mock_open()]
+    mock_zip_temps[0].return_value.name = '/test/temp/file/tmp0.zip'
+    mock_zip_temps[1].return_value.name = '/test/temp/file/tmp1.zip'
+    with self.assertCalls(
+        (mock.call.tempfile.NamedTemporaryFile(suffix='.zip'),
+         mock_zip_temps[0]),
+        (mock.call.multiprocessing.Process(
+            target=device_utils.DeviceUtils._CreateDeviceZip,
+            args=('/test/temp/file/tmp0.zip',
+                  [test_files[0], test_files[2]])),
+         mock.NonCallableMock(exitcode=0)),
+        (mock.call.tempfile.NamedTemporaryFile(suffix='.zip'),
+         mock_zip_temps[1]),
+        (mock.call.multiprocessing.Process(
+            target=device_utils.DeviceUtils._CreateDeviceZip,
+            args=('/test/temp/file/tmp1.zip', [test_files[1]])),
+         mock.NonCallableMock(exitcode=0)),
+        (self.call.device.GetExternalStoragePath(),
+         '/test/device/external_dir'),
+        self.call.adb.Push(
+            '/test/temp/file/tmp0.zip', '/test/device/external_dir/tmp0.zip'),
+        self.call.adb.Push(
+            '/test/temp/file/tmp1.zip', '/test/device/external_dir/tmp1.zip'),
+        self.call.device.RunShellCommand(
+            '/data/local/tmp/bin/unzip /test/device/external_dir/tmp0.zip && '
+            '/data/local/tmp/bin/unzip /test/device/external_dir/tmp1.zip',
+            as_root=True,
+            check_return=True),
+        (self.call.device.IsOnline(), True),
+        self.call.device.RunShellCommand(
+            ['rm', '/test/device/external_dir/tmp0.zip',
+             '/test/device/external_dir/tmp1.zip'], check_return=True)):
+      self.device._PushChangedFilesZipped(test_files)
+
+
+  @mock.patch('multiprocessing.cpu_count', mock.Mock(return_value=2))
+  @mock.patch(
+      'pylib.device.device_utils.DeviceUtils._MIN_FILES_PER_ZIP_SHARD', 1)
+  def testPushChangedFilesZipped_zipFailure(self):
+    test_files = [
+        ('/test/host/path/file1', '/test/device/path/file1'),
+        ('/test/host/path/file2', '/test/device/path/file2')]
+    mock_zip_temps = [mock.mock_open(), mock.mock_open()]
+    mock_zip_temps[0].return_value.name = '/test/temp/file/tmp0.zip'
+    mock_zip_temps[1].return_value.name = '/test/temp/file/tmp1.zip'
+    with self.assertCalls(
+        (mock.call.tempfile.NamedTemporaryFile(suffix='.zip'),
+         mock_zip_temps[0]),
+        (mock.call.multiprocessing.Process(
+            target=device_utils.DeviceUtils._CreateDeviceZip,
+            args=('/test/temp/file/tmp0.zip', [test_files[0]])),
+         mock.NonCallableMock(exitcode=0)),
+        (mock.call.tempfile.NamedTemporaryFile(suffix='.zip'),
+         mock_zip_temps[1]),
+        (mock.call.multiprocessing.Process(
+            target=device_utils.DeviceUtils._CreateDeviceZip,
+            args=('/test/temp/file/tmp1.zip', [test_files[1]])),
+         mock.NonCallableMock(exitcode=1)),
+        (self.call.device.GetExternalStoragePath(),
+         '/test/device/external_dir'),
+        self.call.adb.Push(
+            '/test/temp/file/tmp0.zip', '/test/device/external_dir/tmp0.zip'),
+        (self.call.device.IsOnline(), True),
+        self.call.device.RunShellCommand(
+            ['rm', '/test/device/external_dir/tmp0.zip'], check_return=True)):
+      with self.assertRaises(device_errors.CommandFailedError):
+        self.device._PushChangedFilesZipped(test_files)
+
 
 class DeviceUtilsFileExistsTest(DeviceUtilsTest):
 
@@ -1074,7 +1686,21 @@ class DeviceUtilsReadFileTest(DeviceUtilsTest):
   def testReadFile_exists(self):
     with self.assertCalls(
         (self.call.device.RunShellCommand(
-            ['ls', '-l', '/read/this/test/file'],
+            'stat -c %s /read/this/test/file 2>/dev/null || '
+            'ls -l /read/this/test/file',
+            as_root=False, check_return=True),
+         ['-rw-rw---- root foo 256 1970-01-01 00:00 file']),
+        (self.call.device.RunShellCommand(
+            ['cat', '/read/this/test/file'], as_root=False, check_return=True),
+         ['this is a test file'])):
+      self.assertEqual('this is a test file\n',
+                       self.device.ReadFile('/read/this/test/file'))
+
+  def testReadFile_withoutStat(self):
+    with self.assertCalls(
+        (self.call.device.RunShellCommand(
+            'stat -c %s /read/this/test/file 2>/dev/null || '
+            'ls -l /read/this/test/file',
             as_root=False, check_return=True),
          ['-rw-rw---- root foo 256 1970-01-01 00:00 file']),
         (self.call.device.RunShellCommand(
@@ -1086,7 +1712,8 @@ class DeviceUtilsReadFileTest(DeviceUtilsTest):
   def testReadFile_doesNotExist(self):
     with self.assertCall(
         self.call.device.RunShellCommand(
-            ['ls', '-l', '/this/file/does.not.exist'],
+            'stat -c %s /this/file/does.not.exist 2>/dev/null || '
+            'ls -l /this/file/does.not.exist',
             as_root=False, check_return=True),
         self.CommandError('File does not exist')):
       with self.assertRaises(device_errors.CommandFailedError):
@@ -1095,9 +1722,10 @@ class DeviceUtilsReadFileTest(DeviceUtilsTest):
   def testReadFile_withSU(self):
     with self.assertCalls(
         (self.call.device.RunShellCommand(
-            ['ls', '-l', '/this/file/can.be.read.with.su'],
+            'stat -c %s /this/file/can.be.read.with.su 2>/dev/null || '
+            'ls -l /this/file/can.be.read.with.su',
             as_root=True, check_return=True),
-         ['-rw------- root root 256 1970-01-01 00:00 can.be.read.with.su']),
+         ['256']),
         (self.call.device.RunShellCommand(
             ['cat', '/this/file/can.be.read.with.su'],
             as_root=True, check_return=True),
@@ -1111,21 +1739,41 @@ class DeviceUtilsReadFileTest(DeviceUtilsTest):
     contents = 'a' * 123456
     with self.assertCalls(
         (self.call.device.RunShellCommand(
-            ['ls', '-l', '/read/this/big/test/file'],
+            'stat -c %s /read/this/big/test/file 2>/dev/null || '
+            'ls -l /read/this/big/test/file',
             as_root=False, check_return=True),
-         ['-rw-rw---- root foo 123456 1970-01-01 00:00 file']),
+         ['123456']),
+        (self.call.device.build_version_sdk(),
+         constants.ANDROID_SDK_VERSION_CODES.KITKAT),
         (self.call.device._ReadFileWithPull('/read/this/big/test/file'),
          contents)):
       self.assertEqual(
           contents, self.device.ReadFile('/read/this/big/test/file'))
 
+  def testReadFile_withExecOut(self):
+    contents = 'a' * 123456
+    with self.assertCalls(
+        (self.call.device.RunShellCommand(
+            'stat -c %s /read/this/big/test/file 2>/dev/null || '
+            'ls -l /read/this/big/test/file',
+            as_root=False, check_return=True),
+         ['123456']),
+        (self.call.device.build_version_sdk(),
+         constants.ANDROID_SDK_VERSION_CODES.LOLLIPOP),
+        (self.call.adb.ExecOut('cat /read/this/big/test/file',
+                               timeout=mock.ANY),
+         contents)):
+      self.assertEqual(
+          contents, self.device.ReadFile('/read/this/big/test/file'))
+
   def testReadFile_withPullAndSU(self):
     contents = 'b' * 123456
     with self.assertCalls(
         (self.call.device.RunShellCommand(
-            ['ls', '-l', '/this/big/file/can.be.read.with.su'],
+            'stat -c %s /this/big/file/can.be.read.with.su 2>/dev/null || '
+            'ls -l /this/big/file/can.be.read.with.su',
             as_root=True, check_return=True),
-         ['-rw------- root root 123456 1970-01-01 00:00 can.be.read.with.su']),
+         ['123456']),
         (self.call.device.NeedsSU(), True),
         (mock.call.pylib.utils.device_temp_file.DeviceTempFile(self.adb),
          MockTempFile('/sdcard/tmp/on.device')),
@@ -1188,21 +1836,58 @@ class DeviceUtilsWriteFileTest(DeviceUtilsTest):
 
   def testWriteFile_withEcho(self):
     with self.assertCall(self.call.adb.Shell(
-        "echo -n the.contents > /test/file/to.write"), ''):
+        "echo dGhlLmNvbnRlbnRz | base64 -d > /test/file/to.write"), ''):
       self.device.WriteFile('/test/file/to.write', 'the.contents')
 
   def testWriteFile_withEchoAndQuotes(self):
     with self.assertCall(self.call.adb.Shell(
-        "echo -n 'the contents' > '/test/file/to write'"), ''):
+        "echo dGhlIGNvbnRlbnRz | base64 -d > '/test/file/to write'"), ''):
       self.device.WriteFile('/test/file/to write', 'the contents')
 
   def testWriteFile_withEchoAndSU(self):
     with self.assertCalls(
         (self.call.device.NeedsSU(), True),
-        (self.call.adb.Shell("su -c sh -c 'echo -n contents > /test/file'"),
+        (self.call.adb.Shell(
+            "su -c sh -c 'echo Y29udGVudHM= | base64 -d > /test/file'"),
          '')):
       self.device.WriteFile('/test/file', 'contents', as_root=True)
 
+  def testWriteFile_withEchoAndBinaryContents(self):
+    with self.assertCall(self.call.adb.Shell(
+        "echo AAEC/w== | base64 -d > /test/file"), ''):
+      self.device.WriteFile('/test/file', '\x00\x01\x02\xff')
+
+  def testWriteFile_withEchoWithoutBase64(self):
+    with self.assertCalls(
+        (self.call.adb.Shell(
+            "echo dGhlLmNvbnRlbnRz | base64 -d > /test/file/to.write"),
+         self.ShellError('/system/bin/sh: base64: not found\n', 127)),
+        (self.call.adb.Shell(
+            "echo -n the.contents > /test/file/to.write"), '')):
+      self.device.WriteFile('/test/file/to.write', 'the.contents')
+    with self.assertCall(self.call.adb.Shell(
+        "echo -n 'the contents' > /test/file/to.write"), ''):
+      self.device.WriteFile('/test/file/to.write', 'the contents')
+
+  def testWriteFile_withEchoFailingForAnotherReason(self):
+    with self.assertCall(
+        self.call.adb.Shell(
+            "echo dGhlLmNvbnRlbnRz | base64 -d > /test/missing/to.write"),
+        self.ShellError(
+            "/system/bin/sh: can't create /test/missing/to.write: "
+            "No such file or directory\n")):
+      with self.assertRaises(device_errors.AdbCommandFailedError):
+        self.device.WriteFile('/test/missing/to.write', 'the.contents')
+    with self.assertCall(self.call.adb.Shell(
+        "echo dGhlLmNvbnRlbnRz | base64 -d > /test/file/to.write"), ''):
+      self.device.WriteFile('/test/file/to.write', 'the.contents')
+
+  def testWriteFile_withEchoTooLongForBase64(self):
+    contents = 'x' * 400
+    with self.assertCall(self.call.adb.Shell(
+        "echo -n %s > /test/file" % contents), ''):
+      self.device.WriteFile('/test/file', contents)
+
 
 class DeviceUtilsLsTest(DeviceUtilsTest):
 
@@ -1251,46 +1936,144 @@ class DeviceUtilsStatTest(DeviceUtilsTest):
       with self.assertRaises(device_errors.CommandFailedError):
         self.device.Stat('/data/local/tmp/does.not.exist.txt')
 
+  @mock.patch('time.time', mock.Mock(return_value=1000.0))
+  def testStat_cached(self):
+    result = [('testfile.txt', adb_wrapper.DeviceStat(33206, 3, 1417436122)),
+              ('otherfile.txt', adb_wrapper.DeviceStat(33206, 5, 1417436122))]
+    with self.assertCalls(
+        (self.call.adb.Ls('/data/local/tmp'), result)):
+      self.assertEquals(adb_wrapper.DeviceStat(33206, 3, 1417436122),
+                        self.device.Stat('/data/local/tmp/testfile.txt'))
+      self.assertEquals(adb_wrapper.DeviceStat(33206, 5, 1417436122),
+                        self.device.Stat('/data/local/tmp/otherfile.txt'))
+      self.assertTrue(self.device.FileExists('/data/local/tmp/testfile.txt'))
+
+  @mock.patch('pylib.device.device_utils.DeviceUtils._LS_CACHE_TTL', -1)
+  def testStat_cacheExpires(self):
+    result = [('testfile.txt', adb_wrapper.DeviceStat(33206, 3, 1417436122))]
+    with self.assertCalls(
+        (self.call.adb.Ls('/data/local/tmp'), result),
+        (self.call.adb.Ls('/data/local/tmp'), result)):
+      self.device.Stat('/data/local/tmp/testfile.txt')
+      self.device.Stat('/data/local/tmp/testfile.txt')
+
+  @mock.patch('time.time', mock.Mock(return_value=1000.0))
+  def testStat_cacheClearedByShellCommand(self):
+    result = [('testfile.txt', adb_wrapper.DeviceStat(33206, 3, 1417436122))]
+    with self.assertCalls(
+        (self.call.adb.Ls('/data/local/tmp'), result),
+        (self.call.adb.Shell('rm /data/local/tmp/testfile.txt'), ''),
+        (self.call.adb.Ls('/data/local/tmp'), [])):
+      self.device.Stat('/data/local/tmp/testfile.txt')
+      self.device.RunShellCommand(['rm', '/data/local/tmp/testfile.txt'])
+      with self.assertRaises(device_errors.CommandFailedError):
+        self.device.Stat('/data/local/tmp/testfile.txt')
+
+  @mock.patch('time.time', mock.Mock(return_value=1000.0))
+  def testStat_cacheKeptByReadOnlyCommand(self):
+    result = [('testfile.txt', adb_wrapper.DeviceStat(33206, 3, 1417436122))]
+    with self.assertCalls(
+        (self.call.adb.Ls('/data/local/tmp'), result),
+        (self.call.adb.Shell('test -e /data/local/tmp/missing.txt'),
+         self.ShellError('', 1))):
+      self.device.Stat('/data/local/tmp/testfile.txt')
+      self.assertFalse(self.device.FileExists('/data/local/tmp/missing.txt'))
+      self.assertEquals(adb_wrapper.DeviceStat(33206, 3, 1417436122),
+                        self.device.Stat('/data/local/tmp/testfile.txt'))
+
+  @mock.patch('pylib.device.device_utils.DeviceUtils._LS_CACHE_MAX_SIZE', 1)
+  @mock.patch('time.time', mock.Mock(return_value=1000.0))
+  def testStat_cacheBounded(self):
+    with self.assertCalls(
+        (self.call.adb.Ls('/data/local/tmp'),
+         [('a.txt', adb_wrapper.DeviceStat(33206, 3, 1417436122))]),
+        (self.call.adb.Ls('/sdcard'),
+         [('b.txt', adb_wrapper.DeviceStat(33206, 3, 1417436122))]),
+        (self.call.adb.Ls('/data/local/tmp'),
+         [('a.txt', adb_wrapper.DeviceStat(33206, 3, 1417436122))])):
+      self.device.Stat('/data/local/tmp/a.txt')
+      self.device.Stat('/sdcard/b.txt')
+      self.device.Stat('/data/local/tmp/a.txt')
+
 
 class DeviceUtilsSetJavaAssertsTest(DeviceUtilsTest):
 
+  def ReadJavaAssertsCall(self):
+    return self.call.device.RunShellCommand(
+        "cat %s 2>/dev/null; printf '\\n%%s\\n' JAVA_ASSERTS_SEPARATOR; "
+        "getprop dalvik.vm.enableassertions"
+        % constants.DEVICE_LOCAL_PROPERTIES_PATH)
+
   def testSetJavaAsserts_enable(self):
     with self.assertCalls(
-        (self.call.device.ReadFile(constants.DEVICE_LOCAL_PROPERTIES_PATH),
-         'some.example.prop=with an example value\n'
-         'some.other.prop=value_ok\n'),
-        self.call.device.WriteFile(
-            constants.DEVICE_LOCAL_PROPERTIES_PATH,
-            'some.example.prop=with an example value\n'
-            'some.other.prop=value_ok\n'
-            'dalvik.vm.enableassertions=all\n'),
-        (self.call.device.GetProp('dalvik.vm.enableassertions'), ''),
-        self.call.device.SetProp('dalvik.vm.enableassertions', 'all')):
+        (self.ReadJavaAssertsCall(),
+         ['some.example.prop=with an example value',
+          'some.other.prop=value_ok',
+          '',
+          'JAVA_ASSERTS_SEPARATOR',
+          '']),
+        self.call.device.RunShellCommand(
+            "echo -n 'some.example.prop=with an example value\n"
+            "some.other.prop=value_ok\n"
+            "dalvik.vm.enableassertions=all\n' > %s && "
+            "setprop dalvik.vm.enableassertions all"
+            % constants.DEVICE_LOCAL_PROPERTIES_PATH,
+            check_return=True)):
       self.assertTrue(self.device.SetJavaAsserts(True))
 
   def testSetJavaAsserts_disable(self):
     with self.assertCalls(
-        (self.call.device.ReadFile(constants.DEVICE_LOCAL_PROPERTIES_PATH),
-         'some.example.prop=with an example value\n'
-         'dalvik.vm.enableassertions=all\n'
-         'some.other.prop=value_ok\n'),
-        self.call.device.WriteFile(
-            constants.DEVICE_LOCAL_PROPERTIES_PATH,
-            'some.example.prop=with an example value\n'
-            'some.other.prop=value_ok\n'),
-        (self.call.device.GetProp('dalvik.vm.enableassertions'), 'all'),
-        self.call.device.SetProp('dalvik.vm.enableassertions', '')):
+        (self.ReadJavaAssertsCall(),
+         ['some.example.prop=with an example value',
+          'dalvik.vm.enableassertions=all',
+          'some.other.prop=value_ok',
+          '',
+          'JAVA_ASSERTS_SEPARATOR',
+          'all']),
+        self.call.device.RunShellCommand(
+            "echo -n 'some.example.prop=with an example value\n"
+            "some.other.prop=value_ok\n' > %s && "
+            "setprop dalvik.vm.enableassertions ''"
+            % constants.DEVICE_LOCAL_PROPERTIES_PATH,
+            check_return=True)):
       self.assertTrue(self.device.SetJavaAsserts(False))
 
   def testSetJavaAsserts_alreadyEnabled(self):
-    with self.assertCalls(
-        (self.call.device.ReadFile(constants.DEVICE_LOCAL_PROPERTIES_PATH),
-         'some.example.prop=with an example value\n'
-         'dalvik.vm.enableassertions=all\n'
-         'some.other.prop=value_ok\n'),
-        (self.call.device.GetProp('dalvik.vm.enableassertions'), 'all')):
+    with self.assertCall(
+        self.ReadJavaAssertsCall(),
+        ['some.example.prop=with an example value',
+         'dalvik.vm.enableassertions=all',
+         'some.other.prop=value_ok',
+         '',
+         'JAVA_ASSERTS_SEPARATOR',
+         'all']):
       self.assertFalse(self.device.SetJavaAsserts(True))
 
+  def testSetJavaAsserts_onlyRuntimeValueDiffers(self):
+    with self.assertCalls(
+        (self.ReadJavaAssertsCall(),
+         ['dalvik.vm.enableassertions=all',
+          '',
+          'JAVA_ASSERTS_SEPARATOR',
+          '']),
+        self.call.device.RunShellCommand(
+            'setprop dalvik.vm.enableassertions all', check_return=True)):
+      self.assertTrue(self.device.SetJavaAsserts(True))
+
+  def testSetJavaAsserts_noTrailingNewLine(self):
+    with self.assertCalls(
+        (self.ReadJavaAssertsCall(),
+         ['some.example.prop=with an example value',
+          'JAVA_ASSERTS_SEPARATOR',
+          '']),
+        self.call.device.RunShellCommand(
+            "echo -n 'some.example.prop=with an example value\n"
+            "dalvik.vm.enableassertions=all\n' > %s && "
+            "setprop dalvik.vm.enableassertions all"
+            % constants.DEVICE_LOCAL_PROPERTIES_PATH,
+            check_return=True)):
+      self.assertTrue(self.device.SetJavaAsserts(True))
+
 
 class DeviceUtilsGetPropTest(DeviceUtilsTest):
 
@@ -1306,8 +2089,7 @@ class DeviceUtilsGetPropTest(DeviceUtilsTest):
       self.assertEqual('', self.device.GetProp('property.does.not.exist'))
 
   def testGetProp_cachedRoProp(self):
-    with self.assertCall(
-        self.call.adb.Shell('getprop ro.build.type'), 'userdebug\n'):
+    with self.assertCall(*self.AllPropsCall({'ro.build.type': 'userdebug'})):
       self.assertEqual('userdebug',
                        self.device.GetProp('ro.build.type', cache=True))
       self.assertEqual('userdebug',
@@ -1315,9 +2097,9 @@ class DeviceUtilsGetPropTest(DeviceUtilsTest):
 
   def testGetProp_retryAndCache(self):
     with self.assertCalls(
-        (self.call.adb.Shell('getprop ro.build.type'), self.ShellError()),
-        (self.call.adb.Shell('getprop ro.build.type'), self.ShellError()),
-        (self.call.adb.Shell('getprop ro.build.type'), 'userdebug\n')):
+        (self.call.adb.Shell('getprop'), self.ShellError()),
+        (self.call.adb.Shell('getprop'), self.ShellError()),
+        (self.call.adb.Shell('getprop'), '[ro.build.type]: [userdebug]\n')):
       self.assertEqual('userdebug',
                        self.device.GetProp('ro.build.type',
                                            cache=True, retries=3))
@@ -1325,6 +2107,26 @@ class DeviceUtilsGetPropTest(DeviceUtilsTest):
                        self.device.GetProp('ro.build.type',
                                            cache=True, retries=3))
 
+  def testGetProp_cachedAllProps(self):
+    with self.assertCall(*self.AllPropsCall(
+        {'ro.build.type': 'userdebug', 'ro.product.model': 'Nexus 7',
+         'ro.build.id': ''})):
+      self.assertEqual('userdebug',
+                       self.device.GetProp('ro.build.type', cache=True))
+      self.assertEqual('Nexus 7', self.device.product_model)
+      self.assertEqual('', self.device.build_id)
+
+  def testGetProp_notInAllProps(self):
+    with self.assertCalls(
+        (self.call.adb.Shell('getprop'),
+         '[ro.build.type]: [userdebug]\n'
+         '[ro.build.description]: [multi\n'
+         'line]\n'),
+        (self.call.adb.Shell('getprop ro.build.id'), 'KTU84P\n')):
+      self.assertEqual('userdebug', self.device.build_type)
+      self.assertEqual('KTU84P', self.device.build_id)
+      self.assertEqual('KTU84P', self.device.build_id)
+
 
 class DeviceUtilsSetPropTest(DeviceUtilsTest):
 
@@ -1346,42 +2148,63 @@ class DeviceUtilsSetPropTest(DeviceUtilsTest):
       with self.assertRaises(device_errors.CommandFailedError):
         self.device.SetProp('test.property', 'new_value', check=True)
 
+  def testSetProp_invalidatesCache(self):
+    with self.assertCalls(
+        self.AllPropsCall({'test.property': 'old_value'}),
+        (self.call.adb.Shell('setprop test.property new_value'), ''),
+        self.AllPropsCall({'test.property': 'new_value'})):
+      self.assertEqual('old_value',
+                       self.device.GetProp('test.property', cache=True))
+      self.device.SetProp('test.property', 'new_value')
+      self.assertEqual('new_value',
+                       self.device.GetProp('test.property', cache=True))
+
 
 class DeviceUtilsGetPidsTest(DeviceUtilsTest):
 
+  def PsCall(self, process_name):
+    return self.call.device.RunShellCommand(
+        'if type grep >/dev/null 2>&1; then ps | grep -F -e %s || true; '
+        'else ps; fi' % process_name, check_return=True)
+
   def testGetPids_noMatches(self):
-    with self.assertCall(self.call.adb.Shell('ps'),
-        'USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME\n'
-        'user  1000    100   1024 1024   ffffffff 00000000 no.match\n'):
+    with self.assertCall(self.PsCall('does.not.match'), []):
       self.assertEqual({}, self.device.GetPids('does.not.match'))
 
   def testGetPids_oneMatch(self):
-    with self.assertCall(self.call.adb.Shell('ps'),
-        'USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME\n'
-        'user  1000    100   1024 1024   ffffffff 00000000 not.a.match\n'
-        'user  1001    100   1024 1024   ffffffff 00000000 one.match\n'):
+    with self.assertCall(self.PsCall('one.match'),
+        ['user  1001    100   1024 1024   ffffffff 00000000 one.match']):
       self.assertEqual({'one.match': '1001'}, self.device.GetPids('one.match'))
 
   def testGetPids_mutlipleMatches(self):
-    with self.assertCall(self.call.adb.Shell('ps'),
-        'USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME\n'
-        'user  1000    100   1024 1024   ffffffff 00000000 not\n'
-        'user  1001    100   1024 1024   ffffffff 00000000 one.match\n'
-        'user  1002    100   1024 1024   ffffffff 00000000 two.match\n'
-        'user  1003    100   1024 1024   ffffffff 00000000 three.match\n'):
+    with self.assertCall(self.PsCall('match'),
+        ['user  1001    100   1024 1024   ffffffff 00000000 one.match',
+         'user  1002    100   1024 1024   ffffffff 00000000 two.match',
+         'user  1003    100   1024 1024   ffffffff 00000000 three.match']):
       self.assertEqual(
           {'one.match': '1001', 'two.match': '1002', 'three.match': '1003'},
           self.device.GetPids('match'))
 
   def testGetPids_exactMatch(self):
-    with self.assertCall(self.call.adb.Shell('ps'),
-        'USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME\n'
-        'user  1000    100   1024 1024   ffffffff 00000000 not.exact.match\n'
-        'user  1234    100   1024 1024   ffffffff 00000000 exact.match\n'):
+    with self.assertCall(self.PsCall('exact.match'),
+        ['user  1000    100   1024 1024   ffffffff 00000000 not.exact.match',
+         'user  1234    100   1024 1024   ffffffff 00000000 exact.match']):
       self.assertEqual(
           {'not.exact.match': '1000', 'exact.match': '1234'},
           self.device.GetPids('exact.match'))
 
+  def testGetPids_withoutGrep(self):
+    with self.assertCall(self.PsCall('one.match'),
+        ['USER   PID   PPID  VSIZE  RSS   WCHAN    PC       NAME',
+         'user  1000    100   1024 1024   ffffffff 00000000 not.a.match',
+         'user  1001    100   1024 1024   ffffffff 00000000 one.match']):
+      self.assertEqual({'one.match': '1001'}, self.device.GetPids('one.match'))
+
+  def testGetPids_matchOnlyInOtherColumns(self):
+    with self.assertCall(self.PsCall('u0_a1'),
+        ['u0_a1  1001    100   1024 1024   ffffffff 00000000 some.app']):
+      self.assertEqual({}, self.device.GetPids('u0_a1'))
+
 
 class DeviceUtilsTakeScreenshotTest(DeviceUtilsTest):
 
@@ -1403,12 +2226,13 @@ class DeviceUtilsGetMemoryUsageForPidTest(DeviceUtilsTest):
     super(DeviceUtilsGetMemoryUsageForPidTest, self).setUp()
 
   def testGetMemoryUsageForPid_validPid(self):
-    with self.assertCalls(
-        (self.call.device.RunShellCommand(
-            ['showmap', '1234'], as_root=True, check_return=True),
-         ['100 101 102 103 104 105 106 107 TOTAL']),
-        (self.call.device.ReadFile('/proc/1234/status', as_root=True),
-         'VmHWM: 1024 kB\n')):
+    with self.assertCall(
+        self.call.device.RunShellCommand(
+            'showmap 1234; echo MEMORY_USAGE_SEPARATOR; '
+            'cat /proc/1234/status', as_root=True),
+        ['100 101 102 103 104 105 106 107 TOTAL',
+         'MEMORY_USAGE_SEPARATOR',
+         'VmHWM: 1024 kB']):
       self.assertEqual(
           {
             'Size': 100,
@@ -1423,21 +2247,23 @@ class DeviceUtilsGetMemoryUsageForPidTest(DeviceUtilsTest):
           self.device.GetMemoryUsageForPid(1234))
 
   def testGetMemoryUsageForPid_noSmaps(self):
-    with self.assertCalls(
-        (self.call.device.RunShellCommand(
-            ['showmap', '4321'], as_root=True, check_return=True),
-         ['cannot open /proc/4321/smaps: No such file or directory']),
-        (self.call.device.ReadFile('/proc/4321/status', as_root=True),
-         'VmHWM: 1024 kb\n')):
+    with self.assertCall(
+        self.call.device.RunShellCommand(
+            'showmap 4321; echo MEMORY_USAGE_SEPARATOR; '
+            'cat /proc/4321/status', as_root=True),
+        ['cannot open /proc/4321/smaps: No such file or directory',
+         'MEMORY_USAGE_SEPARATOR',
+         'VmHWM: 1024 kb']):
       self.assertEquals({'VmHWM': 1024}, self.device.GetMemoryUsageForPid(4321))
 
   def testGetMemoryUsageForPid_noStatus(self):
-    with self.assertCalls(
-        (self.call.device.RunShellCommand(
-            ['showmap', '4321'], as_root=True, check_return=True),
-         ['100 101 102 103 104 105 106 107 TOTAL']),
-        (self.call.device.ReadFile('/proc/4321/status', as_root=True),
-         self.CommandError())):
+    with self.assertCall(
+        self.call.device.RunShellCommand(
+            'showmap 4321; echo MEMORY_USAGE_SEPARATOR; '
+            'cat /proc/4321/status', as_root=True),
+        ['100 101 102 103 104 105 106 107 TOTAL',
+         'MEMORY_USAGE_SEPARATOR',
+         '/proc/4321/status: No such file or directory']):
       self.assertEquals(
           {
             'Size': 100,
@@ -1450,6 +2276,14 @@ class DeviceUtilsGetMemoryUsageForPidTest(DeviceUtilsTest):
           },
           self.device.GetMemoryUsageForPid(4321))
 
+  def testGetMemoryUsageForPid_noSeparator(self):
+    with self.assertCall(
+        self.call.device.RunShellCommand(
+            'showmap 4321; echo MEMORY_USAGE_SEPARATOR; '
+            'cat /proc/4321/status', as_root=True),
+        []):
+      self.assertEquals({}, self.device.GetMemoryUsageForPid(4321))
+
 
 class DeviceUtilsGetBatteryInfoTest(DeviceUtilsTest):
   def testGetBatteryInfo_normal(self):
@@ -1473,6 +2307,23 @@ class DeviceUtilsGetBatteryInfoTest(DeviceUtilsTest):
           self.device.GetBatteryInfo())
 
 
+  def testGetBatteryInfo_unexpectedLines(self):
+    with self.assertCall(
+        self.call.device.RunShellCommand(
+            ['dumpsys', 'battery'], check_return=True),
+        [
+          'Current Battery Service state:',
+          '  (UPDATES STOPPED -- use \'reset\' to restart)',
+          '  AC powered: false',
+          '  technology: Li-ion',
+        ]):
+      self.assertEquals(
+          {
+            'AC powered': 'false',
+            'technology': 'Li-ion',
+          },
+          self.device.GetBatteryInfo())
+
   def testGetBatteryInfo_nothing(self):
     with self.assertCall(
         self.call.device.RunShellCommand(
@@ -1566,6 +2417,41 @@ class DeviceUtilsParallelTest(mock_calls.TestCase):
       with self.assertRaises(device_errors.NoDevicesError):
         device_utils.DeviceUtils.parallel()
 
+  def testInstallMany(self):
+    test_serials = ['0123456789abcdef', 'fedcba9876543210']
+    devices = [device_utils.DeviceUtils(_AdbWrapperMock(serial))
+               for serial in test_serials]
+    installed = []
+    def install(device, apk_path, reinstall=False):
+      installed.append((str(device), apk_path, reinstall))
+    with mock.patch.object(device_utils.DeviceUtils, 'Install', install):
+      device_utils.DeviceUtils.InstallMany(
+          devices, '/fake/test/app.apk', reinstall=True)
+    self.assertEqual(
+        sorted((serial, '/fake/test/app.apk', True) for serial in test_serials),
+        sorted(installed))
+
+  def testInstallMany_fails(self):
+    devices = [device_utils.DeviceUtils(_AdbWrapperMock('0123456789abcdef'))]
+    def install(device, apk_path, reinstall=False):
+      raise device_errors.CommandFailedError('Failure', str(device))
+    with mock.patch.object(device_utils.DeviceUtils, 'Install', install):
+      with self.assertRaises(device_errors.CommandFailedError):
+        device_utils.DeviceUtils.InstallMany(devices, '/fake/test/app.apk')
+
+  def testInstallMany_timeout(self):
+    devices = [device_utils.DeviceUtils(_AdbWrapperMock('0123456789abcdef'))]
+    stuck = threading.Event()
+    def install(_device, _apk_path, reinstall=False):
+      stuck.wait(10)
+    try:
+      with mock.patch.object(device_utils.DeviceUtils, 'Install', install):
+        with self.assertRaises(device_errors.CommandTimeoutError):
+          device_utils.DeviceUtils.InstallMany(
+              devices, '/fake/test/app.apk', timeout=0.1)
+    finally:
+      stuck.set()
+
 
 if __name__ == '__main__':
   logging.getLogger().setLevel(logging.DEBUG)
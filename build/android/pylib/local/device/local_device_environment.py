@@ -52,5 +52,6 @@ class LocalDeviceEnvironment(environment.Environment):
 
   #override
   def TearDown(self):
-    pass
+    for device in self._devices:
+      device.Close()
 
@@ -14,3 +14,19 @@ def GetRecursiveDiskUsage(path):
                            for f in files + dirs])
   return running_size
 
+
+def GetRecursiveFileCountAndDiskUsage(path):
+  """Returns the number of files under |path| and their disk usage in bytes.
+
+  Equivalent to counting the files found by os.walk and calling
+  GetRecursiveDiskUsage, but stats each entry only once in a single traversal.
+  """
+  running_size = os.path.getsize(path)
+  if not os.path.isdir(path):
+    return 1, running_size
+  file_count = 0
+  for root, dirs, files in os.walk(path):
+    file_count += len(files)
+    for f in files + dirs:
+      running_size += os.stat(os.path.join(root, f)).st_size
+  return file_count, running_size
@@ -6,6 +6,8 @@
 # pylint: disable=W0702
 
 import logging
+import Queue
+import sys
 import threading
 import time
 import traceback
@@ -124,6 +126,75 @@ def WaitFor(condition, wait_period=5, max_tries=None):
   return None
 
 
+class _ConditionAborted(Exception):
+  """Raised to stop polling a condition once another one has failed."""
+  pass
+
+
+def WaitForAll(conditions, wait_period=5):
+  """Wait in parallel for a number of conditions to become true.
+
+  Each condition is polled with WaitFor on its own TimeoutRetryThread, so
+  conditions that each require a round-trip to a device can overlap their
+  latencies. If called within a TimeoutRetryThread, all of the polling threads
+  share the time left on it.
+
+  As soon as one of the conditions raises an exception, the remaining ones
+  stop polling and the exception is reraised on the calling thread.
+
+  Args:
+    conditions: list of functions with the conditions to check
+    wait_period: number of seconds to wait before retrying to check each
+      condition
+
+  Returns:
+    A list with the true values returned by each of the conditions.
+
+  Raises:
+    reraiser_thread.TimeoutError if the current thread is a TimeoutRetryThread
+      and the timeout expires.
+  """
+  timeout_thread = CurrentTimeoutThread()
+  timeout = timeout_thread.GetRemainingTime() if timeout_thread else None
+  results = [None] * len(conditions)
+  done = Queue.Queue()
+  failed = threading.Event()
+
+  def PollCondition(index, condition):
+    def Check():
+      if failed.is_set():
+        raise _ConditionAborted()
+      return condition()
+    Check.__name__ = condition.__name__
+    try:
+      results[index] = WaitFor(Check, wait_period=wait_period)
+      done.put(None)
+    except _ConditionAborted:
+      done.put(None)
+    except:
+      failed.set()
+      done.put(sys.exc_info())
+
+  for index, condition in enumerate(conditions):
+    TimeoutRetryThread(
+        lambda i=index, c=condition: PollCondition(i, c), timeout,
+        name='WaitForAll-%s-for-%s' % (condition.__name__,
+                                       threading.current_thread().name)
+    ).start()
+
+  for _ in conditions:
+    try:
+      exc_info = done.get(
+          True, timeout_thread.GetRemainingTime() if timeout_thread else None)
+    except Queue.Empty:
+      failed.set()
+      raise reraiser_thread.TimeoutError(
+          'Timed out waiting for %d conditions' % len(conditions))
+    if exc_info:
+      raise exc_info[0], exc_info[1], exc_info[2]
+  return results
+
+
 def Run(func, timeout, retries, args=None, kwargs=None):
   """Runs the passed function in a separate thread with timeouts and retries.
 
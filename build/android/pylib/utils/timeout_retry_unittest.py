@@ -4,6 +4,7 @@
 
 """Unittests for timeout_and_retry.py."""
 
+import threading
 import unittest
 
 from pylib.utils import reraiser_thread
@@ -48,5 +49,41 @@ class TestRun(unittest.TestCase):
     self.assertTrue(timeout_retry.Run(lambda: True, 30, 3))
 
 
+class TestWaitForAll(unittest.TestCase):
+  """Tests for timeout_retry.WaitForAll."""
+
+  def testWaitForAll(self):
+    def first():
+      return 1
+    def second():
+      return 2
+    self.assertEqual([1, 2], timeout_retry.WaitForAll([first, second]))
+
+  def testWaitForAllOverlaps(self):
+    barrier = threading.Event()
+    def waiter():
+      return barrier.wait(5)
+    def setter():
+      barrier.set()
+      return True
+    self.assertEqual([True, True],
+                     timeout_retry.WaitForAll([waiter, setter], wait_period=0))
+
+  def testWaitForAllReraises(self):
+    def fails():
+      raise TestException
+    def never_met():
+      return False
+    self.assertRaises(TestException, timeout_retry.WaitForAll,
+                      [never_met, fails], wait_period=0.01)
+
+  def testWaitForAllTimeout(self):
+    def never_met():
+      return False
+    self.assertRaises(reraiser_thread.TimeoutError, timeout_retry.Run,
+                      lambda: timeout_retry.WaitForAll([never_met], 0.01),
+                      0.1, 0)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -6,7 +6,8 @@
 
 import os
 import platform
-import urllib
+import shutil
+import urllib2
 
 import util
 
@@ -15,6 +16,11 @@ CHROME_41_REVISION = '310968'
 CHROME_42_REVISION = '317481'
 
 _SITE = 'http://commondatastorage.googleapis.com'
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Maps the URL of a LAST_CHANGE file to an (etag, last_modified, revision)
+# tuple, so that unchanged revisions are not downloaded again.
+_revision_cache = {}
 
 
 class Site(object):
@@ -29,8 +35,29 @@ def GetLatestRevision(site=Site.CONTINUOUS):
   Args:
     site: the archive site to check against, default to the continuous one.
   """
-  url = site + '/%s/LAST_CHANGE'
-  return urllib.urlopen(url % _GetDownloadPlatform()).read()
+  url = site + '/%s/LAST_CHANGE' % _GetDownloadPlatform()
+  request = urllib2.Request(url)
+  cached = _revision_cache.get(url)
+  if cached:
+    etag, last_modified, revision = cached
+    if etag:
+      request.add_header('If-None-Match', etag)
+    if last_modified:
+      request.add_header('If-Modified-Since', last_modified)
+  try:
+    response = urllib2.urlopen(request)
+  except urllib2.HTTPError as e:
+    if cached and e.code == 304:
+      return revision
+    raise
+  try:
+    revision = response.read()
+    _revision_cache[url] = (response.info().getheader('ETag'),
+                            response.info().getheader('Last-Modified'),
+                            revision)
+  finally:
+    response.close()
+  return revision
 
 
 def DownloadChrome(revision, dest_dir, site=Site.CONTINUOUS):
@@ -44,41 +71,86 @@ def DownloadChrome(revision, dest_dir, site=Site.CONTINUOUS):
   Returns:
     The path to the unzipped Chrome binary.
   """
-  def GetZipName():
-    if util.IsWindows():
-      return 'chrome-win32'
-    elif util.IsMac():
-      return 'chrome-mac'
-    elif util.IsLinux():
-      return 'chrome-linux'
-  def GetChromePathFromPackage():
-    if util.IsWindows():
-      return 'chrome.exe'
-    elif util.IsMac():
-      return 'Chromium.app/Contents/MacOS/Chromium'
-    elif util.IsLinux():
-      return 'chrome'
+  if util.IsWindows():
+    zip_name = 'chrome-win32'
+    chrome_path = 'chrome.exe'
+  elif util.IsMac():
+    zip_name = 'chrome-mac'
+    chrome_path = 'Chromium.app/Contents/MacOS/Chromium'
+  elif util.IsLinux():
+    zip_name = 'chrome-linux'
+    chrome_path = 'chrome'
   zip_path = os.path.join(dest_dir, 'chrome-%s.zip' % revision)
   if not os.path.exists(zip_path):
-    url = site + '/%s/%s/%s.zip' % (_GetDownloadPlatform(), revision,
-                                    GetZipName())
+    url = site + '/%s/%s/%s.zip' % (_GetDownloadPlatform(), revision, zip_name)
     print 'Downloading', url, '...'
-    urllib.urlretrieve(url, zip_path)
+    _DownloadFile(url, zip_path)
   util.Unzip(zip_path, dest_dir)
-  return os.path.join(dest_dir, GetZipName(), GetChromePathFromPackage())
+  return os.path.join(dest_dir, zip_name, chrome_path)
+
+
+def _DownloadFile(url, path):
+  """Streams the contents of |url| to |path| in large chunks.
+
+  The contents are written to a temporary file next to |path| which is only
+  renamed once the download completes, so an interrupted download is not
+  mistaken for a complete one on the next run. Instead, the next run resumes
+  it with an HTTP Range request.
+
+  Raises:
+    RuntimeError if the size of the downloaded file does not match the size
+    reported by the server.
+  """
+  part_path = path + '.part'
+  have = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+  request = urllib2.Request(url)
+  if have:
+    request.add_header('Range', 'bytes=%d-' % have)
+  try:
+    response = urllib2.urlopen(request)
+  except urllib2.HTTPError as e:
+    if e.code != 416:
+      raise
+    # The partial file is already complete, or does not match the remote file.
+    os.remove(part_path)
+    return _DownloadFile(url, path)
+  try:
+    if have and response.getcode() == 206:
+      mode = 'ab'
+      # Content-Range is of the form 'bytes <first>-<last>/<total>'.
+      total = response.info().getheader('Content-Range', '').rpartition('/')[2]
+    else:
+      mode = 'wb'
+      total = response.info().getheader('Content-Length', '')
+    with open(part_path, mode) as f:
+      shutil.copyfileobj(response, f, _DOWNLOAD_CHUNK_SIZE)
+  finally:
+    response.close()
+  if total.isdigit() and os.path.getsize(part_path) != int(total):
+    raise RuntimeError('Incomplete download of %s: got %d of %s bytes' % (
+        url, os.path.getsize(part_path), total))
+  os.rename(part_path, path)
+
+
+_download_platform = None
 
 
 def _GetDownloadPlatform():
   """Returns the name for this platform on the archive site."""
-  if util.IsWindows():
-    return 'Win'
-  elif util.IsMac():
-    return 'Mac'
-  elif util.IsLinux():
-    if platform.architecture()[0] == '64bit':
-      return 'Linux_x64'
-    else:
-      return 'Linux'
+  # platform.architecture() runs file(1) on the interpreter, so the result is
+  # computed only once.
+  global _download_platform
+  if _download_platform is None:
+    if util.IsWindows():
+      _download_platform = 'Win'
+    elif util.IsMac():
+      _download_platform = 'Mac'
+    elif util.IsLinux():
+      if platform.architecture()[0] == '64bit':
+        _download_platform = 'Linux_x64'
+      else:
+        _download_platform = 'Linux'
+  return _download_platform
 
 def GetLatestSnapshotVersion():
   """Returns the latest revision of snapshot build."""
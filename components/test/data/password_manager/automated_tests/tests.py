@@ -6,7 +6,12 @@
 """Automated tests for many websites"""
 
 import argparse
+import functools
 import logging
+import os
+import sys
+import threading
+from xml.sax.saxutils import escape
 
 from environment import Environment
 from websitetest import WebsiteTest
@@ -28,101 +33,93 @@ class TypeOfTestedWebsites:
     pass
 
 
-class Alexa(WebsiteTest):
+class _FormLoginTest(WebsiteTest):
+  """A website whose login form is filled and submitted without any other
+  interaction. Subclasses only set the class attributes below."""
+
+  # The login page URL.
+  URL = None
+  # The username and password input CSS selectors.
+  USERNAME_SELECTOR = "[name='username']"
+  PASSWORD_SELECTOR = "[name='password']"
+  # The CSS selector of the input whose form is submitted. Defaults to the
+  # password input.
+  SUBMIT_SELECTOR = None
 
   def Login(self):
-    self.GoTo("https://www.alexa.com/secure/login")
-    self.FillUsernameInto("#email")
-    self.FillPasswordInto("#pwd")
-    self.Submit("#pwd")
+    self.GoTo(self.URL)
+    self.FillAndSubmit(self.USERNAME_SELECTOR, self.PASSWORD_SELECTOR,
+                       self.SUBMIT_SELECTOR or self.PASSWORD_SELECTOR)
 
 
-class Dropbox(WebsiteTest):
+class Alexa(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https://www.dropbox.com/login")
-    self.FillUsernameInto(".text-input-input[name='login_email']")
-    self.FillPasswordInto(".text-input-input[name='login_password']")
-    self.Submit(".text-input-input[name='login_password']")
+  URL = "https://www.alexa.com/secure/login"
+  USERNAME_SELECTOR = "#email"
+  PASSWORD_SELECTOR = "#pwd"
 
 
-class Facebook(WebsiteTest):
+class Dropbox(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https://www.facebook.com")
-    self.FillUsernameInto("[name='email']")
-    self.FillPasswordInto("[name='pass']")
-    self.Submit("[name='pass']")
+  URL = "https://www.dropbox.com/login"
+  USERNAME_SELECTOR = ".text-input-input[name='login_email']"
+  PASSWORD_SELECTOR = ".text-input-input[name='login_password']"
 
 
-class Google(WebsiteTest):
+class Facebook(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https://accounts.google.com/ServiceLogin?sacu=1&continue=")
-    self.FillUsernameInto("#Email")
-    self.FillPasswordInto("#Passwd")
-    self.Submit("#Passwd")
+  URL = "https://www.facebook.com"
+  USERNAME_SELECTOR = "[name='email']"
+  PASSWORD_SELECTOR = "[name='pass']"
 
 
-class Imgur(WebsiteTest):
+class Google(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https://imgur.com/signin")
-    self.FillUsernameInto("[name='username']")
-    self.FillPasswordInto("[name='password']")
-    self.Submit("[name='password']")
+  URL = "https://accounts.google.com/ServiceLogin?sacu=1&continue="
+  USERNAME_SELECTOR = "#Email"
+  PASSWORD_SELECTOR = "#Passwd"
 
 
-class Liveinternet(WebsiteTest):
+class Imgur(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("http://liveinternet.ru/journals.php?s=&action1=login")
-    self.FillUsernameInto("[name='username']")
-    self.FillPasswordInto("[name='password']")
-    self.Submit("[name='password']")
+  URL = "https://imgur.com/signin"
 
 
-class Linkedin(WebsiteTest):
+class Liveinternet(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https://www.linkedin.com")
-    self.FillUsernameInto("#session_key-login")
-    self.FillPasswordInto("#session_password-login")
-    self.Submit("#session_password-login")
+  URL = "http://liveinternet.ru/journals.php?s=&action1=login"
 
 
-class Mailru(WebsiteTest):
+class Linkedin(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https://mail.ru")
-    self.FillUsernameInto("#mailbox__login")
-    self.FillPasswordInto("#mailbox__password")
-    self.Submit("#mailbox__password")
+  URL = "https://www.linkedin.com"
+  USERNAME_SELECTOR = "#session_key-login"
+  PASSWORD_SELECTOR = "#session_password-login"
 
 
-class Nytimes(WebsiteTest):
+class Mailru(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https://myaccount.nytimes.com/auth/login")
-    self.FillUsernameInto("#userid")
-    self.FillPasswordInto("#password")
-    self.Submit("#password")
+  URL = "https://mail.ru"
+  USERNAME_SELECTOR = "#mailbox__login"
+  PASSWORD_SELECTOR = "#mailbox__password"
 
-class Odnoklassniki(WebsiteTest):
 
-  def Login(self):
-    self.GoTo("https://ok.ru")
-    self.FillUsernameInto("#field_email")
-    self.FillPasswordInto("#field_password")
-    self.Submit("#field_password")
+class Nytimes(_FormLoginTest):
 
-class Pinterest(WebsiteTest):
+  URL = "https://myaccount.nytimes.com/auth/login"
+  USERNAME_SELECTOR = "#userid"
+  PASSWORD_SELECTOR = "#password"
 
-  def Login(self):
-    self.GoTo("https://www.pinterest.com/login/")
-    self.FillUsernameInto("[name='username_or_email']")
-    self.FillPasswordInto("[name='password']")
-    self.Submit("[name='password']")
+class Odnoklassniki(_FormLoginTest):
+
+  URL = "https://ok.ru"
+  USERNAME_SELECTOR = "#field_email"
+  PASSWORD_SELECTOR = "#field_password"
+
+class Pinterest(_FormLoginTest):
+
+  URL = "https://www.pinterest.com/login/"
+  USERNAME_SELECTOR = "[name='username_or_email']"
 
 
 class Reddit(WebsiteTest):
@@ -136,22 +133,18 @@ class Reddit(WebsiteTest):
     self.Submit("#passwd_login")
 
 
-class Tumblr(WebsiteTest):
+class Tumblr(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https://www.tumblr.com/login")
-    self.FillUsernameInto("#signup_email")
-    self.FillPasswordInto("#signup_password")
-    self.Submit("#signup_password")
+  URL = "https://www.tumblr.com/login"
+  USERNAME_SELECTOR = "#signup_email"
+  PASSWORD_SELECTOR = "#signup_password"
 
 
-class Twitter(WebsiteTest):
+class Twitter(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https:///twitter.com")
-    self.FillUsernameInto("#signin-email")
-    self.FillPasswordInto("#signin-password")
-    self.Submit("#signin-password")
+  URL = "https:///twitter.com"
+  USERNAME_SELECTOR = "#signin-email"
+  PASSWORD_SELECTOR = "#signin-password"
 
 
 class Wikia(WebsiteTest):
@@ -164,32 +157,26 @@ class Wikia(WebsiteTest):
     self.Submit("input.login-button")
 
 
-class Wikipedia(WebsiteTest):
+class Wikipedia(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https://en.wikipedia.org/w/index.php?title=Special:UserLogin")
-    self.FillUsernameInto("#wpName1")
-    self.FillPasswordInto("#wpPassword1")
-    self.Submit("#wpPassword1")
+  URL = "https://en.wikipedia.org/w/index.php?title=Special:UserLogin"
+  USERNAME_SELECTOR = "#wpName1"
+  PASSWORD_SELECTOR = "#wpPassword1"
 
 
-class Wordpress(WebsiteTest):
+class Wordpress(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https://de.wordpress.com/wp-login.php")
-    self.FillUsernameInto("[name='log']")
-    self.FillPasswordInto("[name='pwd']")
-    self.Submit("[name='pwd']")
+  URL = "https://de.wordpress.com/wp-login.php"
+  USERNAME_SELECTOR = "[name='log']"
+  PASSWORD_SELECTOR = "[name='pwd']"
 
 
 
-class Yahoo(WebsiteTest):
+class Yahoo(_FormLoginTest):
 
-  def Login(self):
-    self.GoTo("https://login.yahoo.com")
-    self.FillUsernameInto("#username")
-    self.FillPasswordInto("#passwd")
-    self.Submit("#passwd")
+  URL = "https://login.yahoo.com"
+  USERNAME_SELECTOR = "#username"
+  PASSWORD_SELECTOR = "#passwd"
 
 
 class Yandex(WebsiteTest):
@@ -208,8 +195,7 @@ class Aliexpress(WebsiteTest):
 
   def Login(self):
     self.GoTo("https://login.aliexpress.com/buyer.htm?return=http%3A%2F%2Fwww.aliexpress.com%2F")
-    self.WaitUntilDisplayed("iframe#alibaba-login-box")
-    frame = self.driver.find_element_by_css_selector("iframe#alibaba-login-box")
+    frame = self.WaitUntilDisplayed("iframe#alibaba-login-box")
     self.driver.switch_to_frame(frame)
     self.FillUsernameInto("#fm-login-id")
     self.FillPasswordInto("#fm-login-password")
@@ -236,7 +222,7 @@ class Ask(WebsiteTest):
     self.GoTo("http://www.ask.com/answers/browse?qsrc=321&q=&o=0&l=dir#")
     while not self.IsDisplayed("[name='username']"):
       self.Click("#a16CnbSignInText")
-      self.Wait(1)
+      self.WaitFor(lambda: self.IsDisplayed("[name='username']"), 1)
     self.FillUsernameInto("[name='username']")
     self.FillPasswordInto("[name='password']")
     self.Click(".signin_show.signin_submit")
@@ -257,10 +243,10 @@ class Cnn(WebsiteTest):
 
   def Login(self):
     self.GoTo("http://www.cnn.com")
-    self.Wait(5)
+    self.WaitUntilDisplayed("#hdr-auth .no-border.no-pad-right a", 5)
     while not self.IsDisplayed(".cnnOvrlyBtn.cnnBtnLogIn"):
       self.ClickIfClickable("#hdr-auth .no-border.no-pad-right a")
-      self.Wait(1)
+      self.WaitFor(lambda: self.IsDisplayed(".cnnOvrlyBtn.cnnBtnLogIn"), 1)
 
     self.Click(".cnnOvrlyBtn.cnnBtnLogIn")
     self.FillUsernameInto("#cnnOverlayEmail1l")
@@ -309,7 +295,7 @@ class Espn(WebsiteTest):
     self.GoTo("http://espn.go.com/")
     while not self.IsDisplayed("#cboxLoadedContent iframe"):
       self.Click("#signin .cbOverlay")
-      self.Wait(1)
+      self.WaitFor(lambda: self.IsDisplayed("#cboxLoadedContent iframe"), 1)
     frame = self.driver.find_element_by_css_selector("#cboxLoadedContent "
                                                      "iframe")
     self.driver.switch_to_frame(frame)
@@ -317,7 +303,7 @@ class Espn(WebsiteTest):
     self.FillPasswordInto("#password")
     while self.IsDisplayed("#password"):
       self.ClickIfClickable("#submitBtn")
-      self.Wait(1)
+      self.WaitFor(lambda: not self.IsDisplayed("#password"), 1)
 
 
 # Fails due to test framework issue.
@@ -337,7 +323,8 @@ class Instagram(WebsiteTest):
 
   def Login(self):
     self.GoTo("https://instagram.com/accounts/login/")
-    self.Wait(5)
+    self.WaitFor(
+        lambda: self.driver.find_elements_by_css_selector(".hiFrame"), 5)
     frame = self.driver.find_element_by_css_selector(".hiFrame")
     self.driver.switch_to_frame(frame)
     self.FillUsernameInto("#lfFieldInputUsername")
@@ -377,7 +364,8 @@ class Vube(WebsiteTest):
     while (self.IsDisplayed("[ng-model='login.pass']")
            and not self.IsDisplayed(".prompt.alert")):
       self.ClickIfClickable("[ng-click='login()']")
-      self.Wait(1)
+      self.WaitFor(lambda: (not self.IsDisplayed("[ng-model='login.pass']")
+                            or self.IsDisplayed(".prompt.alert")), 1)
 
 
 # Password not saved.
@@ -392,62 +380,64 @@ class Ziddu(WebsiteTest):
 
 def Tests(environment, tests_to_run=None):
 
+  # The WebsiteTests are only created for the tests that are run. Each dict
+  # maps the test name to a callable taking that name and returning the test.
   working_tests = {
-    "alexa": Alexa("alexa"),
-    "dropbox": Dropbox("dropbox"),
-    "facebook": Facebook("facebook"),
-    "google": Google("google"),
-    "imgur": Imgur("imgur"),
-    "liveinternet": Liveinternet("liveinternet"),
-    "linkedin": Linkedin("linkedin"),
-    "mailru": Mailru("mailru"),
-    "nytimes": Nytimes("nytimes"),
-    "odnoklassniki": Odnoklassniki("odnoklassniki"),
-    "pinterest": Pinterest("pinterest"),
-    "reddit": Reddit("reddit", username_not_auto=True),
-    "tumblr": Tumblr("tumblr", username_not_auto=True),
-    "twitter": Twitter("twitter"),
-    "wikia": Wikia("wikia"),
-    "wikipedia": Wikipedia("wikipedia", username_not_auto=True),
-    "wordpress": Wordpress("wordpress"),
-    "yahoo": Yahoo("yahoo", username_not_auto=True),
-    "yandex": Yandex("yandex")
+    "alexa": Alexa,
+    "dropbox": Dropbox,
+    "facebook": Facebook,
+    "google": Google,
+    "imgur": Imgur,
+    "liveinternet": Liveinternet,
+    "linkedin": Linkedin,
+    "mailru": Mailru,
+    "nytimes": Nytimes,
+    "odnoklassniki": Odnoklassniki,
+    "pinterest": Pinterest,
+    "reddit": functools.partial(Reddit, username_not_auto=True),
+    "tumblr": functools.partial(Tumblr, username_not_auto=True),
+    "twitter": Twitter,
+    "wikia": Wikia,
+    "wikipedia": functools.partial(Wikipedia, username_not_auto=True),
+    "wordpress": Wordpress,
+    "yahoo": functools.partial(Yahoo, username_not_auto=True),
+    "yandex": Yandex
   }
 
   disabled_tests = {
-    "aliexpress": Aliexpress("aliexpress"), # Fails due to test framework issue.
-    "amazon": Amazon("amazon"), # Bug not reproducible without test.
-    "ask": Ask("ask"), # Password not saved.
-    "baidu": Baidu("baidu"), # Password not saved.
-    "cnn": Cnn("cnn"), # http://crbug.com/368690
-    "craigslist": Craigslist("craigslist"), # Too many failed logins per time.
-    "dailymotion": Dailymotion("dailymotion"), # Crashes.
-    "ebay": Ebay("ebay"), # http://crbug.com/368690
-    "espn": Espn("espn"), # Iframe, password saved but not autofileld.
-    "flipkart": Flipkart("flipkart"), # Fails due to test framework issue.
-    "instagram": Instagram("instagram"), # Iframe, pw saved but not autofilled.
-    "live": Live("live", username_not_auto=True),  # http://crbug.com/367768
-    "163": One63("163"), # http://crbug.com/368690
-    "vube": Vube("vube"), # http://crbug.com/368690
-    "ziddu": Ziddu("ziddu"), #Password not saved
+    "aliexpress": Aliexpress, # Fails due to test framework issue.
+    "amazon": Amazon, # Bug not reproducible without test.
+    "ask": Ask, # Password not saved.
+    "baidu": Baidu, # Password not saved.
+    "cnn": Cnn, # http://crbug.com/368690
+    "craigslist": Craigslist, # Too many failed logins per time.
+    "dailymotion": Dailymotion, # Crashes.
+    "ebay": Ebay, # http://crbug.com/368690
+    "espn": Espn, # Iframe, password saved but not autofileld.
+    "flipkart": Flipkart, # Fails due to test framework issue.
+    "instagram": Instagram, # Iframe, pw saved but not autofilled.
+    # http://crbug.com/367768
+    "live": functools.partial(Live, username_not_auto=True),
+    "163": One63, # http://crbug.com/368690
+    "vube": Vube, # http://crbug.com/368690
+    "ziddu": Ziddu, #Password not saved
   }
 
   if tests_to_run:
     for test in tests_to_run:
-      if (test not in working_tests.keys() and
-          test not in disabled_tests.keys()):
+      if test in working_tests:
+        create_test = working_tests[test]
+      elif test in disabled_tests:
+        create_test = disabled_tests[test]
+      else:
         print "Skip test: test {} is not in known tests".format(test)
         continue
-      if test in working_tests.keys():
-        test_class = working_tests[test]
-      else:
-        test_class = disabled_tests[test]
-      environment.AddWebsiteTest(test_class)
+      environment.AddWebsiteTest(create_test(test))
   else:
-    for _, test in working_tests:
-      environment.AddWebsiteTest(test)
-    for _, test in disabled_tests:
-      environment.AddWebsiteTest(test, disabled=True)
+    for test, create_test in working_tests.iteritems():
+      environment.AddWebsiteTest(create_test(test))
+    for test, create_test in disabled_tests.iteritems():
+      environment.AddWebsiteTest(create_test(test), disabled=True)
 
 
 def saveResults(environment_tests_results, environment_save_path):
@@ -462,19 +452,39 @@ def saveResults(environment_tests_results, environment_save_path):
     Exception: An exception is raised if the file is not found.
   """
   if environment_save_path:
-    xml = "<result>"
-    for test_result in environment_tests_results:
-      xml += ("<test name='%s' successful='%s' type='%s'>%s</test>"
-          % (test_result.name, str(test_result.successful),
-          test_result.test_type, test_result.message))
-    xml += "</result>"
-    with open(environment_save_path, "w") as save_file:
-      save_file.write(xml)
+    # Each result is written as soon as it is formatted; the 64 KiB buffer
+    # turns these writes into a few large ones.
+    with open(environment_save_path, "w", 1 << 16) as save_file:
+      save_file.write("<result>")
+      for test_result in environment_tests_results:
+        save_file.write("<test name='%s' successful='%s' type='%s'>%s</test>"
+            % (escape(test_result.name, {"'": "&apos;"}),
+            str(test_result.successful), test_result.test_type,
+            escape(test_result.message)))
+      save_file.write("</result>")
+
+# Maps each TypeOfTestedWebsites value to a function running that group of
+# tests, given the Environment, whether to run the prompt tests and the list
+# of tests to run.
+_RUN_TESTED_WEBSITES = {
+  TypeOfTestedWebsites.ALL_TESTS:
+      lambda environment, run_prompt_tests, tests:
+          environment.AllTests(run_prompt_tests),
+  TypeOfTestedWebsites.DISABLED_TESTS:
+      lambda environment, run_prompt_tests, tests:
+          environment.DisabledTests(run_prompt_tests),
+  TypeOfTestedWebsites.LIST_OF_TESTS:
+      lambda environment, run_prompt_tests, tests:
+          environment.Test(tests, run_prompt_tests),
+  TypeOfTestedWebsites.ENABLED_TESTS:
+      lambda environment, run_prompt_tests, tests:
+          environment.WorkingTests(run_prompt_tests),
+}
 
 def RunTests(chrome_path, chromedriver_path, profile_path,
              environment_passwords_path, enable_automatic_password_saving,
              environment_numeric_level, log_to_console, environment_log_file,
-             environment_tested_websites, tests=None):
+             environment_tested_websites, tests=None, headless=False):
 
   """Runs the the tests
 
@@ -493,6 +503,7 @@ def RunTests(chrome_path, chromedriver_path, profile_path,
         indicating which group of tests to run.
     tests: Specifies which tests to run. Ignored unless
        |environment_tested_websites| is equal to LIST_OF_TESTS.
+    headless: If True, Chrome is run without a visible window.
 
   Returns:
     The results of tests as list of TestResults.
@@ -500,12 +511,19 @@ def RunTests(chrome_path, chromedriver_path, profile_path,
     Exception: An exception is raised if one of the tests fails.
   """
 
+  try:
+    run = _RUN_TESTED_WEBSITES[environment_tested_websites]
+  except KeyError:
+    raise Exception("Error: |environment_tested_websites| has to be one of the"
+        "TypeOfTestedWebsites values")
+
   environment = Environment(chrome_path, chromedriver_path, profile_path,
                             environment_passwords_path,
                             enable_automatic_password_saving,
                             environment_numeric_level,
                             log_to_console,
-                            environment_log_file)
+                            environment_log_file,
+                            headless)
 
   # Test which care about the save-password prompt need the prompt
   # to be shown. Automatic password saving results in no prompt.
@@ -513,22 +531,60 @@ def RunTests(chrome_path, chromedriver_path, profile_path,
 
   Tests(environment, tests)
 
-  if environment_tested_websites == TypeOfTestedWebsites.ALL_TESTS:
-    environment.AllTests(run_prompt_tests)
-  elif environment_tested_websites == TypeOfTestedWebsites.DISABLED_TESTS:
-    environment.DisabledTests(run_prompt_tests)
-  elif environment_tested_websites == TypeOfTestedWebsites.LIST_OF_TESTS:
-    environment.Test(tests, run_prompt_tests)
-  elif environment_tested_websites == TypeOfTestedWebsites.ENABLED_TESTS:
-    environment.WorkingTests(run_prompt_tests)
-  else:
-    raise Exception("Error: |environment_tested_websites| has to be one of the"
-        "TypeOfTestedWebsites values")
-
+  run(environment, run_prompt_tests, tests)
 
   environment.Quit()
   return environment.tests_results
 
+def RunTestsInParallel(chrome_path, chromedriver_path, profile_path,
+                       environment_passwords_path,
+                       enable_automatic_password_saving_values,
+                       environment_numeric_level, log_to_console,
+                       environment_log_file, environment_tested_websites,
+                       tests=None, headless=False):
+  """Runs RunTests once per value of |enable_automatic_password_saving|.
+
+  Each run gets its own thread, Chrome instance and profile folder inside
+  |profile_path|, so that the runs do not interfere with each other.
+
+  Args:
+    enable_automatic_password_saving_values: A list with the values of
+        |enable_automatic_password_saving| to run the tests with.
+    The other arguments are the same as for RunTests.
+
+  Returns:
+    The results of all the runs as list of TestResults, in the order of
+    |enable_automatic_password_saving_values|.
+  Raises:
+    Exception: The first exception raised by one of the runs, if any.
+  """
+  results = [None] * len(enable_automatic_password_saving_values)
+  errors = []
+
+  def RunPass(index, enable_automatic_password_saving):
+    try:
+      results[index] = RunTests(
+          chrome_path, chromedriver_path,
+          os.path.join(profile_path, "pass%d" % index),
+          environment_passwords_path, enable_automatic_password_saving,
+          environment_numeric_level, log_to_console, environment_log_file,
+          environment_tested_websites, tests, headless)
+    except Exception:
+      errors.append(sys.exc_info())
+
+  # The passes share the log, whose records are tagged with the thread name.
+  threads = [threading.Thread(target=RunPass, args=(index, value),
+                              name="pass%d" % index)
+             for index, value in enumerate(
+                 enable_automatic_password_saving_values)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+  return [result for run_results in results for result in run_results]
+
 # Tests setup.
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(
@@ -536,38 +592,39 @@ if __name__ == "__main__":
 
   parser.add_argument(
       "--chrome-path", action="store", dest="chrome_path",
-      help="Set the chrome path (required).", nargs=1, required=True)
+      help="Set the chrome path (required).", required=True)
   parser.add_argument(
       "--chromedriver-path", action="store", dest="chromedriver_path",
-      help="Set the chromedriver path (required).", nargs=1, required=True)
+      help="Set the chromedriver path (required).", required=True)
   parser.add_argument(
       "--profile-path", action="store", dest="profile_path",
       help="Set the profile path (required). You just need to choose a "
            "temporary empty folder. If the folder is not empty all its content "
-           "is going to be removed.",
-      nargs=1, required=True)
+           "is going to be removed.", required=True)
 
   parser.add_argument(
       "--passwords-path", action="store", dest="passwords_path",
-      help="Set the usernames/passwords path (required).", nargs=1,
+      help="Set the usernames/passwords path (required).",
       required=True)
   parser.add_argument("--all", action="store_true", dest="all",
                       help="Run all tests.")
   parser.add_argument("--disabled", action="store_true", dest="disabled",
                       help="Run only disabled tests.")
-  parser.add_argument("--log", action="store", nargs=1, dest="log_level",
+  parser.add_argument("--log", action="store", dest="log_level",
                       help="Set log level.")
   parser.add_argument("--log-screen", action="store_true", dest="log_screen",
                       help="Show log on the screen.")
   parser.add_argument("--log-file", action="store", dest="log_file",
-                      help="Write the log in a file.", nargs=1)
-  parser.add_argument("--save-path", action="store", nargs=1, dest="save_path",
+                      help="Write the log in a file.")
+  parser.add_argument("--save-path", action="store", dest="save_path",
                       help="Write the results in a file.")
+  parser.add_argument("--headless", action="store_true", dest="headless",
+                      help="Run Chrome without a visible window.")
   parser.add_argument("tests", help="Tests to be run.",  nargs="*")
 
   args = parser.parse_args()
 
-  passwords_path = args.passwords_path[0]
+  passwords_path = args.passwords_path
 
   if args.all:
     tested_websites = TypeOfTestedWebsites.ALL_TESTS
@@ -580,42 +637,26 @@ if __name__ == "__main__":
 
   numeric_level = None
   if args.log_level:
-    numeric_level = getattr(logging, args.log_level[0].upper(), None)
+    numeric_level = getattr(logging, args.log_level.upper(), None)
     if not isinstance(numeric_level, int):
-      raise ValueError("Invalid log level: %s" % args.log_level[0])
-
-  log_file = None
-  if args.log_file:
-    log_file = args.log_file[0]
-
-  save_path = None
-  if args.save_path:
-    save_path = args.save_path[0]
+      raise ValueError("Invalid log level: %s" % args.log_level)
 
   # Run the test without enable-automatic-password-saving to check whether or
-  # not the prompt is shown in the way we expected.
-  tests_results = RunTests(args.chrome_path[0],
-                           args.chromedriver_path[0],
-                           args.profile_path[0],
-                           passwords_path,
-                           False,
-                           numeric_level,
-                           args.log_screen,
-                           log_file,
-                           tested_websites,
-                           args.tests)
-
-  # Run the test with enable-automatic-password-saving to check whether or not
-  # the passwords is stored in the the way we expected.
-  tests_results += RunTests(args.chrome_path[0],
-                            args.chromedriver_path[0],
-                            args.profile_path[0],
-                            passwords_path,
-                            True,
-                            numeric_level,
-                            args.log_screen,
-                            log_file,
-                            tested_websites,
-                            args.tests)
-
-  saveResults(tests_results, save_path)
+  # not the prompt is shown in the way we expected, and with it to check
+  # whether or not the passwords is stored in the the way we expected. Both
+  # passes spend most of their time waiting for the browser, and each uses
+  # its own Chrome instance and profile, so they are run at the same time.
+  tests_results = RunTestsInParallel(
+      args.chrome_path,
+      args.chromedriver_path,
+      args.profile_path,
+      passwords_path,
+      [False, True],
+      numeric_level,
+      args.log_screen,
+      args.log_file,
+      tested_websites,
+      args.tests,
+      args.headless)
+
+  saveResults(tests_results, args.save_path)
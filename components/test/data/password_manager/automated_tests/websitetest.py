@@ -5,17 +5,84 @@
 """WebsiteTest testing class."""
 
 import logging
+import re
 import sys
 import time
 
 sys.path.insert(0, '../../../../third_party/webdriver/pylib/')
 
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.action_chains import ActionChains
+from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.support.ui import WebDriverWait
 
 import environment
 
 
+# Checks and fills the username and password inputs, then submits the form,
+# all in a single WebDriver round-trip. Returns null on success, or the name
+# and the DOM value of the first input that doesn't match the expected state.
+# The values are assigned through the native setter and followed by an
+# "input" event so that page scripts notice them as if they were typed. The
+# submission mirrors WebElement.submit(): a cancelable "submit" event is
+# dispatched first, and the form is only submitted if no handler cancels it.
+_FILL_AND_SUBMIT_SCRIPT = """
+    var username = document.querySelector(arguments[0]);
+    var password = document.querySelector(arguments[1]);
+    var submit = document.querySelector(arguments[2]);
+    var checkUsername = arguments[3], checkPassword = arguments[4];
+    var setValue = Object.getOwnPropertyDescriptor(
+        HTMLInputElement.prototype, 'value').set;
+    function fill(element, value) {
+      setValue.call(element, value);
+      element.dispatchEvent(new Event('input', {bubbles: true}));
+    }
+    if (checkUsername && username.value != arguments[5])
+      return ['username', username.value];
+    if (password.value != (checkPassword ? arguments[6] : ''))
+      return ['password', password.value];
+    if (!checkUsername)
+      fill(username, arguments[5]);
+    if (!checkPassword)
+      fill(password, arguments[6]);
+    var form = submit.form || submit;
+    if (form.dispatchEvent(
+            new Event('submit', {bubbles: true, cancelable: true})))
+      HTMLFormElement.prototype.submit.call(form);
+    return null;
+"""
+
+
+# Selectors that only match an id or a name attribute. They are looked up
+# with By.ID or By.NAME, which skip the CSS selector engine.
+_ID_SELECTOR_RE = re.compile(r"^#([\w-]+)$")
+_NAME_SELECTOR_RE = re.compile(r"""^\[name=(['"])([^'"]+)\1\]$""")
+
+# Maps CSS selectors to their (By, value) locators, see _Locator.
+_locators = {}
+
+
+def _Locator(selector):
+  """Returns the (By, value) locator to find the elements matching a CSS
+  selector with.
+
+  Args:
+    selector: The element CSS selector.
+  """
+  if selector not in _locators:
+    locator = (By.CSS_SELECTOR, selector)
+    match = _ID_SELECTOR_RE.match(selector)
+    if match:
+      locator = (By.ID, match.group(1))
+    else:
+      match = _NAME_SELECTOR_RE.match(selector)
+      if match:
+        locator = (By.NAME, match.group(2))
+    _locators[selector] = locator
+  return _locators[selector]
+
+
 def _IsOneSubstringOfAnother(s1, s2):
   """Checks if one of the string arguements is substring of the other.
 
@@ -33,6 +100,13 @@ def _IsOneSubstringOfAnother(s1, s2):
 class WebsiteTest:
   """Handles a tested WebsiteTest."""
 
+  # How often, in seconds, WaitFor checks its condition.
+  _POLL_FREQUENCY = 0.1
+  # How long, in seconds, to wait for an expected password manager message
+  # after a login. Messages that are expected not to show up are still waited
+  # for with a fixed delay, since there is nothing to poll for.
+  _MESSAGE_TIMEOUT = 5
+
   class Mode:
     """Test mode."""
     # Password and username are expected to be autofilled.
@@ -83,8 +157,7 @@ class WebsiteTest:
       selector: The element CSS selector.
     """
     logging.info("action: Click %s" % selector)
-    self.WaitUntilDisplayed(selector)
-    element = self.driver.find_element_by_css_selector(selector)
+    element = self.WaitUntilDisplayed(selector)
     element.click()
 
   def ClickIfClickable(self, selector):
@@ -102,9 +175,8 @@ class WebsiteTest:
       False otherwise.
     """
     logging.info("action: ClickIfVisible %s" % selector)
-    self.WaitUntilDisplayed(selector)
+    element = self.WaitUntilDisplayed(selector)
     try:
-      element = self.driver.find_element_by_css_selector(selector)
       element.click()
       return True
     except Exception:
@@ -130,8 +202,7 @@ class WebsiteTest:
       selector: The element CSS selector.
     """
     logging.info("action: Hover %s" % selector)
-    self.WaitUntilDisplayed(selector)
-    element = self.driver.find_element_by_css_selector(selector)
+    element = self.WaitUntilDisplayed(selector)
     hover = ActionChains(self.driver).move_to_element(element)
     hover.perform()
 
@@ -156,11 +227,26 @@ class WebsiteTest:
       selector: The element CSS selector.
     """
     logging.info("action: IsDisplayed %s" % selector)
+    return self._IsDisplayed(selector)
+
+  def _IsDisplayed(self, selector):
+    """Same as IsDisplayed, without logging. Used when polling."""
+    return self._FindDisplayed(selector) is not None
+
+  def _FindDisplayed(self, selector):
+    """Returns the element matching |selector| if it is displayed, None
+    otherwise.
+
+    Args:
+      selector: The element CSS selector.
+    """
     try:
-      element = self.driver.find_element_by_css_selector(selector)
-      return element.is_displayed()
+      element = self.driver.find_element(*_Locator(selector))
+      if element.is_displayed():
+        return element
     except Exception:
-      return False
+      pass
+    return None
 
   def Wait(self, duration):
     """Wait for a duration in seconds. This needs to be used in potentially
@@ -176,22 +262,58 @@ class WebsiteTest:
       raise Exception("Tests took more time than expected for the following "
                       "website : %s \n" % self.name)
 
+  def WaitFor(self, condition, timeout):
+    """Polls a condition until it is met, or until the timeout expires.
+
+    Unlike Wait, this returns as soon as the page is ready instead of always
+    sleeping for the whole duration. The time spent waiting counts towards
+    |remaining_time_to_wait|, so this can also be used in potentially
+    infinite loops.
+
+    Args:
+      condition: A function without arguments that returns True once the
+          condition is met.
+      timeout: The maximum waiting time in seconds.
+
+    Returns:
+      True if the condition was met before the timeout, False otherwise.
+    """
+    logging.info("action: WaitFor %s" % timeout)
+    start = time.time()
+    try:
+      WebDriverWait(self.driver, timeout,
+                    poll_frequency=self._POLL_FREQUENCY).until(
+                        lambda driver: condition())
+      return True
+    except TimeoutException:
+      return False
+    finally:
+      self.remaining_time_to_wait -= time.time() - start
+      if self.remaining_time_to_wait < 0:
+        raise Exception("Tests took more time than expected for the "
+                        "following website : %s \n" % self.name)
+
   def WaitUntilDisplayed(self, selector, timeout=10):
     """Waits until an element is displayed.
 
     Args:
       selector: The element CSS selector.
       timeout: The maximum waiting time in seconds before failing.
+
+    Returns:
+      The displayed element, so that callers don't need to look it up again.
     """
-    if not self.IsDisplayed(selector):
-      self.Wait(1)
-      timeout = timeout - 1
-      if (timeout <= 0):
-        raise Exception("Error: Element %s not shown before timeout is "
-                        "finished for the following website: %s"
-                        % (selector, self.name))
-      else:
-        self.WaitUntilDisplayed(selector, timeout)
+    logging.info("action: WaitUntilDisplayed %s" % selector)
+    # The element found by the last poll.
+    found = [None]
+    def Condition():
+      found[0] = self._FindDisplayed(selector)
+      return found[0] is not None
+    if not self.WaitFor(Condition, timeout):
+      raise Exception("Error: Element %s not shown before timeout is "
+                      "finished for the following website: %s"
+                      % (selector, self.name))
+    return found[0]
 
   # Form actions.
 
@@ -210,8 +332,7 @@ class WebsiteTest:
           different than the one we expected.
     """
     logging.info("action: FillPasswordInto %s" % selector)
-    self.WaitUntilDisplayed(selector)
-    password_element = self.driver.find_element_by_css_selector(selector)
+    password_element = self.WaitUntilDisplayed(selector)
     # Chrome protects the password inputs and doesn't fill them until
     # the user interacts with the page. To be sure that such thing has
     # happened we perform |Keys.CONTROL| keypress.
@@ -248,8 +369,7 @@ class WebsiteTest:
           different that the one we expected.
     """
     logging.info("action: FillUsernameInto %s" % selector)
-    self.WaitUntilDisplayed(selector)
-    username_element = self.driver.find_element_by_css_selector(selector)
+    username_element = self.WaitUntilDisplayed(selector)
 
     if (self.mode == self.Mode.AUTOFILLED and not self.username_not_auto):
       if not (username_element.get_attribute("value") == self.username):
@@ -267,10 +387,49 @@ class WebsiteTest:
       selector: The input CSS selector.
     """
     logging.info("action: Submit %s" % selector)
-    self.WaitUntilDisplayed(selector)
-    element = self.driver.find_element_by_css_selector(selector)
+    element = self.WaitUntilDisplayed(selector)
     element.submit()
 
+  def FillAndSubmit(self, username_selector, password_selector,
+                    submit_selector):
+    """Does the same as FillUsernameInto, FillPasswordInto and Submit, but
+    checks and fills both inputs and submits the form with a single script,
+    instead of making a WebDriver round-trip for every step.
+
+    Args:
+      username_selector: The username input CSS selector.
+      password_selector: The password input CSS selector.
+      submit_selector: The CSS selector of the input whose form is submitted.
+
+    Raises:
+      Exception: An exception is raised if the DOM value of the username or
+          of the password is different than the one we expected.
+    """
+    logging.info("action: FillAndSubmit %s %s %s"
+                 % (username_selector, password_selector, submit_selector))
+    self.WaitUntilDisplayed(password_selector)
+    # See FillPasswordInto.
+    action_chains = ActionChains(self.driver)
+    action_chains.key_down(Keys.CONTROL).key_up(Keys.CONTROL).perform()
+    autofilled = self.mode == self.Mode.AUTOFILLED
+    mismatch = self.driver.execute_script(
+        _FILL_AND_SUBMIT_SCRIPT, username_selector, password_selector,
+        submit_selector, autofilled and not self.username_not_auto,
+        autofilled, self.username, self.password)
+    if not mismatch:
+      return
+    field, value = mismatch
+    if field == "username":
+      raise Exception("Error: autofilled username is different form the one "
+                      "we just saved for the following website : %s \n" %
+                      self.name)
+    if autofilled:
+      raise Exception("Error: autofilled password is different from the one "
+                      "we just saved for the following website : %s p1: %s "
+                      "p2:%s \n" % (self.name, value, self.password))
+    raise Exception("Error: password is autofilled when it shouldn't  be "
+                    "for the following website : %s \n" % self.name)
+
   # Login/Logout Methods
 
   def Login(self):
@@ -335,14 +494,14 @@ class WebsiteTest:
     logging.info("\nSuccessful Login Test for %s \n" % self.name)
     try:
       self.LoginWhenNotAutofilled()
-      self.Wait(2)
       self.environment.SwitchToInternals()
       self.environment.CheckForNewMessage(
           environment.MESSAGE_SAVE,
           True,
           "Error: password manager hasn't detected a successful login for the "
           "following website : %s \n"
-          % self.name)
+          % self.name,
+          timeout=self._MESSAGE_TIMEOUT)
     finally:
       self.environment.SwitchFromInternals()
       self.Logout()
@@ -363,14 +522,14 @@ class WebsiteTest:
                         " Test %s \n" % self.name)
     try:
       self.LoginWhenAutofilled()
-      self.Wait(2)
       self.environment.SwitchToInternals()
       self.environment.CheckForNewMessage(
           environment.MESSAGE_SAVE,
           True,
           "Error: password manager hasn't detected a successful login for the "
           "following website : %s \n"
-          % self.name)
+          % self.name,
+          timeout=self._MESSAGE_TIMEOUT)
     finally:
       self.environment.SwitchFromInternals()
       self.Logout()
@@ -403,12 +562,12 @@ class WebsiteTest:
       self.environment.SwitchFromInternals()
 
       self.LoginWhenNotAutofilled()
-      self.Wait(2)
       self.environment.SwitchToInternals()
       self.environment.CheckForNewMessage(
           environment.MESSAGE_ASK,
           True,
           "Error: password manager hasn't detected a successful login for the "
-          "following website : %s \n" % self.name)
+          "following website : %s \n" % self.name,
+          timeout=self._MESSAGE_TIMEOUT)
     finally:
       self.environment.SwitchFromInternals()
@@ -17,9 +17,11 @@ from telemetry.web_perf import timeline_interaction_record as tir_module
 
 
 class SmoothGestureUtilTest(unittest.TestCase):
-  def testGetAdjustedInteractionIfContainGesture(self):
-    model = model_module.TimelineModel()
-    renderer_main = model.GetOrCreateProcess(1).GetOrCreateThread(2)
+  @classmethod
+  def setUpClass(cls):
+    # The model is only read by the tests, so it is built once for all of them.
+    cls.model = model_module.TimelineModel()
+    renderer_main = cls.model.GetOrCreateProcess(1).GetOrCreateThread(2)
     renderer_main.name = 'CrRendererMain'
 
     #      [          X          ]                   [   Y  ]
@@ -50,51 +52,42 @@ class SmoothGestureUtilTest(unittest.TestCase):
     renderer_main.AddAsyncSlice(async_slice_X)
     renderer_main.AddAsyncSlice(async_slice_Y)
 
-    model.FinalizeImport(shift_world_to_zero=False)
+    cls.model.FinalizeImport(shift_world_to_zero=False)
 
+  def _AssertAdjusted(self, record, start, end):
+    adjusted_record = sg_util.GetAdjustedInteractionIfContainGesture(
+      self.model, record)
+    self.assertEquals(adjusted_record.start, start)
+    self.assertEquals(adjusted_record.end, end)
+    self.assertTrue(adjusted_record is not record)
+
+  def testGetAdjustedInteractionIfContainGesture_included(self):
     record_1 = tir_module.TimelineInteractionRecord('Gesture_included', 15, 25)
+    self._AssertAdjusted(record_1, 10, 30)
+
+  def testGetAdjustedInteractionIfContainGesture_overlappedLeft(self):
     record_2 = tir_module.TimelineInteractionRecord(
       'Gesture_overlapped_left', 5, 25)
+    self._AssertAdjusted(record_2, 10, 30)
+
+  def testGetAdjustedInteractionIfContainGesture_overlappedRight(self):
     record_3 = tir_module.TimelineInteractionRecord(
       'Gesture_overlapped_right', 25, 35)
+    self._AssertAdjusted(record_3, 10, 30)
+
+  def testGetAdjustedInteractionIfContainGesture_containing(self):
     record_4 = tir_module.TimelineInteractionRecord(
       'Gesture_containing', 5, 35)
+    self._AssertAdjusted(record_4, 10, 30)
+
+  def testGetAdjustedInteractionIfContainGesture_nonOverlapped(self):
     record_5 = tir_module.TimelineInteractionRecord(
       'Gesture_non_overlapped', 35, 45)
-    record_6 = tir_module.TimelineInteractionRecord('Action_included', 15, 25)
+    self._AssertAdjusted(record_5, 35, 45)
 
-    adjusted_record_1 = sg_util.GetAdjustedInteractionIfContainGesture(
-      model, record_1)
-    self.assertEquals(adjusted_record_1.start, 10)
-    self.assertEquals(adjusted_record_1.end, 30)
-    self.assertTrue(adjusted_record_1 is not record_1)
-
-    adjusted_record_2 = sg_util.GetAdjustedInteractionIfContainGesture(
-      model, record_2)
-    self.assertEquals(adjusted_record_2.start, 10)
-    self.assertEquals(adjusted_record_2.end, 30)
-
-    adjusted_record_3 = sg_util.GetAdjustedInteractionIfContainGesture(
-      model, record_3)
-    self.assertEquals(adjusted_record_3.start, 10)
-    self.assertEquals(adjusted_record_3.end, 30)
-
-    adjusted_record_4 = sg_util.GetAdjustedInteractionIfContainGesture(
-      model, record_4)
-    self.assertEquals(adjusted_record_4.start, 10)
-    self.assertEquals(adjusted_record_4.end, 30)
-
-    adjusted_record_5 = sg_util.GetAdjustedInteractionIfContainGesture(
-      model, record_5)
-    self.assertEquals(adjusted_record_5.start, 35)
-    self.assertEquals(adjusted_record_5.end, 45)
-    self.assertTrue(adjusted_record_5 is not record_5)
-
-    adjusted_record_6 = sg_util.GetAdjustedInteractionIfContainGesture(
-      model, record_6)
-    self.assertEquals(adjusted_record_6.start, 15)
-    self.assertEquals(adjusted_record_6.end, 25)
-    self.assertTrue(adjusted_record_6 is not record_6)
+  def testGetAdjustedInteractionIfContainGesture_notGesture(self):
+    record_6 = tir_module.TimelineInteractionRecord('Action_included', 15, 25)
+    self._AssertAdjusted(record_6, 15, 25)
 
 
 class ScrollingPage(page_module.Page):
@@ -4,7 +4,9 @@
 import inspect
 import logging
 import os
+import string
 import urlparse
+import weakref
 
 from telemetry import user_story
 from telemetry.page import shared_page_state
@@ -12,7 +14,16 @@ from telemetry.util import cloud_storage
 from telemetry.util import path
 
 
+# The credentials files that _UpdateCredentials already tried to download.
+_updated_credentials_paths = set()
+
+
 def _UpdateCredentials(credentials_path):
+  # Many pages usually share the same credentials file, so only the first of
+  # them downloads it.
+  if credentials_path in _updated_credentials_paths:
+    return
+  _updated_credentials_paths.add(credentials_path)
   # Attempt to download the credentials file.
   try:
     cloud_storage.GetIfChanged(credentials_path, cloud_storage.PUBLIC_BUCKET)
@@ -22,12 +33,71 @@ def _UpdateCredentials(credentials_path):
                     'error %s', credentials_path, str(e))
 
 
+_SCHEME_CHARS = frozenset(string.ascii_letters + string.digits + '+-.')
+
+
+def _GetScheme(url):
+  """Returns urlparse.urlsplit(url).scheme, without parsing the rest of |url|.
+  """
+  i = url.find(':')
+  scheme = url[:i]
+  if i <= 0 or not all(c in _SCHEME_CHARS for c in scheme):
+    return ''
+  # Like urlsplit, treat 'host:port' as a URL without scheme.
+  rest = url[i + 1:]
+  if scheme != 'http' and rest.isdigit():
+    return ''
+  return scheme.lower()
+
+
+# Maps page sets to the ids of their pages and the common prefix of the URLs
+# of their file pages, see _GetFileUrlsCommonPrefix.
+_file_urls_common_prefixes = weakref.WeakKeyDictionary()
+
+
+def _GetFileUrlsCommonPrefix(page_set):
+  """Returns the directory common to the URLs of the file pages of |page_set|.
+
+  The display names of all the pages of a page set are usually needed
+  together, so the prefix is cached until the pages of the page set change.
+  """
+  page_ids = map(id, page_set)
+  cached = _file_urls_common_prefixes.get(page_set)
+  if cached and cached[0] == page_ids:
+    return cached[1]
+  all_urls = [p.url.rstrip('/') for p in page_set if p.is_file]
+  common_prefix = os.path.dirname(os.path.commonprefix(all_urls))
+  _file_urls_common_prefixes[page_set] = (page_ids, common_prefix)
+  return common_prefix
+
+
+# Maps Page classes to the directory of the file that defines them.
+_class_dirs = {}
+
+
+def _GetClassDir(cls):
+  """Returns the directory of the file that defines |cls|.
+
+  Many pages of the same class are usually created, and inspect.getfile is
+  comparatively slow, so the result is cached per class.
+  """
+  if cls not in _class_dirs:
+    _class_dirs[cls] = os.path.dirname(inspect.getfile(cls))
+  return _class_dirs[cls]
+
+
 class Page(user_story.UserStory):
   def __init__(self, url, page_set=None, base_dir=None, name='',
                credentials_path=None, labels=None, startup_url='',
                make_javascript_deterministic=True,
                shared_page_state_class=shared_page_state.SharedPageState):
     self._url = url
+    # The URL never changes, so it is only parsed once.
+    self._scheme = _GetScheme(url)
+    self._is_file = self._scheme == 'file'
+    # The file_path and serving_dir of a file page, computed on first use.
+    self._file_path = None
+    self._serving_dir = None
 
     super(Page, self).__init__(
         shared_page_state_class, name=name, labels=labels,
@@ -38,9 +108,19 @@ class Page(user_story.UserStory):
     # Default value of base_dir is the directory of the file that defines the
     # class of this page instance.
     if base_dir is None:
-      base_dir = os.path.dirname(inspect.getfile(self.__class__))
+      base_dir = _GetClassDir(self.__class__)
     self._base_dir = base_dir
-    self._name = name
+    self._file_path_url = None
+    if self._is_file:
+      self._file_path_url = os.path.normpath(
+          os.path.join(self._base_dir, self._url[7:]))
+      # Preserve trailing slash or backslash.
+      # It doesn't matter in a file path, but it does matter in a URL.
+      if self._url.endswith('/'):
+        self._file_path_url += os.sep
+    # Neither the name nor the URL change, so the key pages are compared by is
+    # built once.
+    self._cmp_key = (name, url)
     if credentials_path:
       credentials_path = os.path.join(self._base_dir, credentials_path)
       _UpdateCredentials(credentials_path)
@@ -70,7 +150,7 @@ class Page(user_story.UserStory):
       raise ValueError('Must prepend the URL with scheme (e.g. file://)')
 
     if self.startup_url:
-      startup_url_scheme = urlparse.urlparse(self.startup_url).scheme
+      startup_url_scheme = _GetScheme(self.startup_url)
       if not startup_url_scheme:
         raise ValueError('Must prepend the URL with scheme (e.g. http://)')
       if startup_url_scheme == 'file':
@@ -97,7 +177,7 @@ class Page(user_story.UserStory):
     self._page_set.AddUserStory(self)
 
   def RunNavigateSteps(self, action_runner):
-    url = self.file_path_url_with_scheme if self.is_file else self.url
+    url = self.file_path_url_with_scheme if self._is_file else self.url
     action_runner.Navigate(
         url, script_to_evaluate_on_commit=self.script_to_evaluate_on_commit)
 
@@ -139,21 +219,15 @@ class Page(user_story.UserStory):
     return self._url
 
   def GetSyntheticDelayCategories(self):
-    result = []
-    for delay, options in self.synthetic_delays.items():
-      options = '%f;%s' % (options.get('target_duration', 0),
-                           options.get('mode', 'static'))
-      result.append('DELAY(%s;%s)' % (delay, options))
-    return result
+    return ['DELAY(%s;%f;%s)' % (delay, options.get('target_duration', 0),
+                                 options.get('mode', 'static'))
+            for delay, options in self.synthetic_delays.iteritems()]
 
   def __lt__(self, other):
-    return self.url < other.url
+    return self._url < other._url
 
   def __cmp__(self, other):
-    x = cmp(self.name, other.name)
-    if x != 0:
-      return x
-    return cmp(self.url, other.url)
+    return cmp(self._cmp_key, other._cmp_key)
 
   def __str__(self):
     return self.url
@@ -162,24 +236,22 @@ class Page(user_story.UserStory):
     """ Inherit page overrides this to add customized browser options."""
     pass
 
-  @property
-  def _scheme(self):
-    return urlparse.urlparse(self.url).scheme
-
   @property
   def is_file(self):
     """Returns True iff this URL points to a file."""
-    return self._scheme == 'file'
+    return self._is_file
 
   @property
   def file_path(self):
     """Returns the path of the file, stripping the scheme and query string."""
-    assert self.is_file
-    # Because ? is a valid character in a filename,
-    # we have to treat the url as a non-file by removing the scheme.
-    parsed_url = urlparse.urlparse(self.url[7:])
-    return os.path.normpath(os.path.join(
-        self._base_dir, parsed_url.netloc + parsed_url.path))
+    assert self._is_file
+    if self._file_path is None:
+      # Because ? is a valid character in a filename,
+      # we have to treat the url as a non-file by removing the scheme.
+      parsed_url = urlparse.urlsplit(self.url[7:])
+      self._file_path = os.path.normpath(os.path.join(
+          self._base_dir, parsed_url.netloc + parsed_url.path))
+    return self._file_path
 
   @property
   def base_dir(self):
@@ -188,25 +260,25 @@ class Page(user_story.UserStory):
   @property
   def file_path_url(self):
     """Returns the file path, including the params, query, and fragment."""
-    assert self.is_file
-    file_path_url = os.path.normpath(os.path.join(self._base_dir, self.url[7:]))
-    # Preserve trailing slash or backslash.
-    # It doesn't matter in a file path, but it does matter in a URL.
-    if self.url.endswith('/'):
-      file_path_url += os.sep
-    return file_path_url
+    assert self._is_file
+    return self._file_path_url
 
   @property
   def file_path_url_with_scheme(self):
-    return 'file://' + self.file_path_url
+    assert self._is_file
+    return 'file://' + self._file_path_url
 
   @property
   def serving_dir(self):
-    file_path = os.path.realpath(self.file_path)
-    if os.path.isdir(file_path):
-      return file_path
-    else:
-      return os.path.dirname(file_path)
+    # Resolving the symlinks of the path takes a few system calls, so it is
+    # only done once.
+    if self._serving_dir is None:
+      file_path = os.path.realpath(self.file_path)
+      if os.path.isdir(file_path):
+        self._serving_dir = file_path
+      else:
+        self._serving_dir = os.path.dirname(file_path)
+    return self._serving_dir
 
   @property
   def display_name(self):
@@ -214,6 +286,5 @@ class Page(user_story.UserStory):
       return self.name
     if not self.is_file:
       return self.url
-    all_urls = [p.url.rstrip('/') for p in self.page_set if p.is_file]
-    common_prefix = os.path.dirname(os.path.commonprefix(all_urls))
+    common_prefix = _GetFileUrlsCommonPrefix(self.page_set)
     return self.url[len(common_prefix):].strip('/')
@@ -4,7 +4,9 @@
 
 import os
 import unittest
+import urlparse
 
+from telemetry import page as page_module
 from telemetry.page import page
 from telemetry.page import page_set
 
@@ -125,6 +127,16 @@ class TestPage(unittest.TestCase):
 
     self.assertEquals(ps[0].display_name, 'foo')
 
+  def testDisplayUrlAfterAddingPage(self):
+    ps = page_set.PageSet(file_path=os.path.dirname(__file__))
+    ps.AddUserStory(page.Page(
+        'file://../../otherdir/foo.html', ps, ps.base_dir))
+    self.assertEquals(ps[0].display_name, 'foo.html')
+
+    ps.AddUserStory(page.Page('file://../../somedir/bar.html', ps, ps.base_dir))
+    self.assertEquals(ps[0].display_name, 'otherdir/foo.html')
+    self.assertEquals(ps[1].display_name, 'somedir/bar.html')
+
   def testPagesHaveDifferentIds(self):
     p0 = page.Page("http://example.com")
     p1 = page.Page("http://example.com")
@@ -175,3 +187,26 @@ class TestPage(unittest.TestCase):
 
     p = page.Page('http://foo.com')
     self.assertFalse(p.is_local)
+
+  def testGetSchemeMatchesUrlsplit(self):
+    for url in ['file://foo.html', 'HTTP://foo.com', 'about:blank',
+                'chrome://extensions', 'localhost:8080', 'http:80', 'foo:',
+                '', ':foo', 'a b://foo', 'javascript:void(0)', 'foo.html']:
+      self.assertEqual(urlparse.urlsplit(url).scheme,
+                       page_module._GetScheme(url))  # pylint: disable=W0212
+
+  def testUrlWithoutScheme(self):
+    self.assertRaises(ValueError, page.Page, 'foo.html')
+    self.assertRaises(ValueError, page.Page, 'http://foo.com',
+                      startup_url='localhost:8080')
+
+  def testGetSyntheticDelayCategories(self):
+    p = page.Page('http://foo.com')
+    p.synthetic_delays = {
+        'cc.BeginMainFrame': {'target_duration': 0.012, 'mode': 'alternating'},
+        'gpu.PresentingFrame': {}
+    }
+    self.assertEqual(
+        set(['DELAY(cc.BeginMainFrame;0.012000;alternating)',
+             'DELAY(gpu.PresentingFrame;0.000000;static)']),
+        set(p.GetSyntheticDelayCategories()))
@@ -39,9 +39,25 @@ PER_PAGE_RESULT_OUTPUT_CONTEXT = 'per-page-result-output-context'
 COMPUTED_PER_PAGE_SUMMARY_OUTPUT_CONTEXT = 'merged-pages-result-output-context'
 SUMMARY_RESULT_OUTPUT_CONTEXT = 'summary-result-output-context'
 
+def _Intern(string):
+  """Returns the interned version of |string| if it is a str.
+
+  intern() only accepts str objects, so unicode strings, str subclasses and
+  None are returned unchanged.
+  """
+  if type(string) is str:
+    return intern(string)
+  return string
+
+
 class Value(object):
   """An abstract value produced by a telemetry page test.
   """
+  # Values are created in large numbers, so the ones declaring __slots__ don't
+  # carry a per-instance __dict__.
+  __slots__ = ('page', 'name', 'units', 'important', 'description',
+               'interaction_record')
+
   def __init__(self, page, name, units, important, description,
                interaction_record):
     """A generic Value object.
@@ -75,11 +91,14 @@ class Value(object):
                        'string.')
 
     self.page = page
-    self.name = name
-    self.units = units
+    # The same few names, units and interaction records are shared by many
+    # values. Interning them saves memory, and lets the comparisons and dict
+    # lookups done when grouping and merging values succeed on identity.
+    self.name = _Intern(name)
+    self.units = _Intern(units)
     self.important = important
     self.description = description
-    self.interaction_record = interaction_record
+    self.interaction_record = _Intern(interaction_record)
 
   def IsMergableWith(self, that):
     return (self.units == that.units and
@@ -10,6 +10,8 @@ from telemetry.value import none_values
 
 
 class ScalarValue(value_module.Value):
+  __slots__ = ('value', 'none_value_reason')
+
   def __init__(self, page, name, units, value, important=True,
                description=None, interaction_record=None,
                none_value_reason=None):
@@ -6,6 +6,7 @@ from telemetry import value as value_module
 
 
 class SkipValue(value_module.Value):
+  __slots__ = ('_reason',)
 
   def __init__(self, page, reason, description=None):
     """A value representing a skipped page.